@@ -1,11 +1,13 @@
 """IsoCor package initialisation.
 
-We expose the Factory and the *metabolite corrector* classes at the package level
-for conveniance.
+We expose the Factory (and its pooled version), the *metabolite corrector* classes
+and the isotope table at the package level for conveniance.
 """
 
 # Version number MUST be maintained here (x.y.z format)
 __version__ = '2.2.0'
 
-from isocor.mscorrectors import MetaboliteCorrectorFactory
+from isocor.mscorrectors import MetaboliteCorrectorFactory, CorrectorPool
 from isocor.mscorrectors import LowResMetaboliteCorrector, HighResMetaboliteCorrector
+from isocor.mscorrectors import MultiTracerMetaboliteCorrector
+from isocor.base import IsotopeTable
@@ -0,0 +1,115 @@
+"""Asynchronous (:py:mod:`asyncio`) interface of IsoCor *correctors*.
+
+Computing correction matrices (in particular at high resolution) and correcting
+large batches of samples block for a while, hence coroutines of this module run
+them in an executor (by default, the thread pool of the event loop) to keep the
+event loop responsive::
+
+    corrected_area, isotopologue_fraction, residuum, enrichment = await acorrect(corrector, measurement)
+
+Concurrent requests for correctors with the same correction matrix wait for a single
+computation of the matrix. Requests can be cancelled: a cancelled request does not
+wait for its computations (which cannot be interrupted once started), and a
+correction matrix is still computed (and cached) for the other requests.
+
+Correctors are used by the threads of the executor, hence process pools are not
+supported (see :py:mod:`isocor.parallel` to use several processes).
+"""
+
+import asyncio
+import functools
+import weakref
+import isocor.cache
+from isocor.parallel import precompute_correction_matrices
+
+# correction matrices being computed in each event loop, indexed by fingerprint
+_pending_matrices = weakref.WeakKeyDictionary()
+
+
+def _has_correction_matrix(corrector, use_cache=False):
+    """Return True if the matrices used by the corrector to correct measurements are computed.
+
+    If use_cache is True, matrices are also taken from the (in-memory) cache
+    (without counting lookups in its statistics).
+    """
+    for corrector in getattr(corrector, "tracer_correctors", [corrector]):
+        if corrector._correction_matrix is None and use_cache:
+            entry = isocor.cache.correction_matrix_cache.peek(corrector._fingerprint())
+            if entry is not None:
+                corrector._set_cached_matrix(entry)
+        if corrector._correction_matrix is None:
+            return False
+    return True
+
+
+async def aget_correction_matrix(corrector, executor=None):
+    """Compute the correction matrix of a corrector in an executor (if needed).
+
+    Concurrent calls for correctors with the same fingerprint share a single
+    computation.
+
+    Args:
+        corrector: the corrector
+        executor (concurrent.futures.Executor): pool of threads (default: the
+            default executor of the event loop)
+    """
+    if _has_correction_matrix(corrector, use_cache=True):
+        return
+    loop = asyncio.get_event_loop()
+    pending = _pending_matrices.setdefault(loop, {})
+    key = corrector._fingerprint()
+    if key is None:
+        key = id(corrector)
+    future = pending.get(key)
+    if future is None:
+        future = loop.run_in_executor(executor, precompute_correction_matrices, [corrector])
+        pending[key] = future
+
+        def forget(done):
+            if pending.get(key) is done:
+                del pending[key]
+        future.add_done_callback(forget)
+    # the computation goes on for other requests if this one is cancelled
+    await asyncio.shield(future)
+    if not _has_correction_matrix(corrector, use_cache=True):
+        # the computation failed (the error is raised at correction), or the matrix
+        # is no longer cached
+        await loop.run_in_executor(executor, precompute_correction_matrices, [corrector])
+
+
+async def acorrect(corrector, measurement, return_path=False, executor=None):
+    """Return the corrected measurement vector of a sample.
+
+    Args:
+        corrector: the corrector
+        measurement (list): measured areas
+        return_path (bool): also return the path used to correct the sample
+        executor (concurrent.futures.Executor): pool of threads (default: the
+            default executor of the event loop)
+
+    Returns:
+        tuple: see :py:meth:`~isocor.mscorrectors.LowResMetaboliteCorrector.correct`
+    """
+    await aget_correction_matrix(corrector, executor)
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        executor, functools.partial(corrector.correct, measurement, return_path=return_path))
+
+
+async def acorrect_many(corrector, measurements, return_paths=False, executor=None):
+    """Return the corrected measurement vectors of a batch of samples.
+
+    Args:
+        corrector: the corrector
+        measurements (array): measured areas, one row per sample
+        return_paths (bool): also return the path used to correct each sample
+        executor (concurrent.futures.Executor): pool of threads (default: the
+            default executor of the event loop)
+
+    Returns:
+        tuple: see :py:meth:`~isocor.mscorrectors.LowResMetaboliteCorrector.correct_many`
+    """
+    await aget_correction_matrix(corrector, executor)
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        executor, functools.partial(corrector.correct_many, measurements, return_paths=return_paths))
@@ -6,12 +6,139 @@ However, all *correctors* classes should inherit from the classes:
     * :py:class:`~LabelledChemical` that stores data related to the metabolite
       to correct and checks the inputs,
     * :py:class:`~InterfaceMSCorrector` that contractualize what any corrector should be able to do.
+
+Elemental formulas are represented by :py:class:`~Formula` objects, and isotopic
+data by :py:class:`~IsotopeTable` objects.
 """
 
 import re
 import collections
+import collections.abc
+import hashlib
 import math
+import types
 from decimal import Decimal as D
+import numpy as np
+import isocor.cache
+import isocor.solvers
+
+
+class Formula(object):
+    """An immutable elemental formula (e.g. "C6H12O6").
+
+    Formulas behave as read-only counters of atoms (the number of atoms of an absent
+    element is 0), with elements in canonical (alphabetical) order. They are
+    interned: equal formulas are the same object, hence they are cheap to hash and
+    compare, and can be used as keys of caches. Formulas can be added and
+    subtracted (e.g. to combine the metabolite and derivative moieties).
+
+    Formulas should be built with :py:meth:`~parse` (parsing is memoized), or from a
+    mapping of the number of atoms of each element.
+
+    Args:
+        atoms (dict): number of atoms of each element (elements with no atom are ignored)
+
+    Raises:
+        ValueError: negative number of atoms
+    """
+
+    __slots__ = ("_atoms", "_counts", "_hash")
+
+    # all formulas instantiated so far, indexed by their atoms
+    _interned = {}
+    # formulas parsed so far, indexed by string
+    _parsed = {}
+
+    def __new__(cls, atoms=()):
+        atoms = tuple(sorted((element, int(n)) for element, n in dict(atoms).items() if n))
+        formula = cls._interned.get(atoms)
+        if formula is None:
+            for element, n in atoms:
+                if n < 0:
+                    raise ValueError("Negative number of atoms for {} ({}).".format(element, n))
+            formula = object.__new__(cls)
+            formula._atoms = atoms
+            formula._counts = dict(atoms)
+            formula._hash = hash(atoms)
+            formula = cls._interned.setdefault(atoms, formula)
+        return formula
+
+    @classmethod
+    def parse(cls, str_formula):
+        """Return the formula of a string.
+
+        Args:
+            str_formula (str): elemental formula (e.g. "H2O")
+
+        Returns:
+            Formula: the formula (e.g. {'H': 2, 'O': 1})
+        """
+        formula = cls._parsed.get(str_formula)
+        if formula is None:
+            counter = collections.Counter()
+            for element, cnt in re.findall(r'([A-Z][a-z]*)(\d*)', str_formula):
+                counter[element] += int(cnt) if cnt else 1
+            formula = cls._parsed.setdefault(str_formula, cls(counter))
+        return formula
+
+    def __getitem__(self, element):
+        return self._counts.get(element, 0)
+
+    def get(self, element, default=None):
+        return self._counts.get(element, default)
+
+    def __contains__(self, element):
+        return element in self._counts
+
+    def __iter__(self):
+        return iter(self._counts)
+
+    def __len__(self):
+        return len(self._atoms)
+
+    def keys(self):
+        return self._counts.keys()
+
+    def values(self):
+        return self._counts.values()
+
+    def items(self):
+        return self._counts.items()
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        if isinstance(other, Formula):
+            return self is other
+        if isinstance(other, collections.abc.Mapping):
+            return self._atoms == tuple(sorted((el, n) for el, n in other.items() if n))
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __add__(self, other):
+        counts = dict(self._counts)
+        for element, n in other.items():
+            counts[element] = counts.get(element, 0) + n
+        return Formula(counts)
+
+    def __sub__(self, other):
+        counts = dict(self._counts)
+        for element, n in other.items():
+            counts[element] = counts.get(element, 0) - n
+        return Formula(counts)
+
+    def __reduce__(self):
+        return (Formula, (self._counts,))
+
+    def __str__(self):
+        return "".join(element if n == 1 else "{}{}".format(element, n) for element, n in self._atoms)
+
+    def __repr__(self):
+        return "Formula('{}')".format(self)
 
 
 class LabelledChemical(object):
@@ -28,6 +155,8 @@ class LabelledChemical(object):
     Warning:
         Except specified otherwise, you should never set any attribute at runtime.
         Always make a new instance if you wish to change the parameters.
+        Attributes are stored in slots (instances have no `__dict__`), hence new
+        attributes cannot be set.
 
     Args:
         formula (str): elemental formula of the metabolite moiety (e.g. "C3H7O6P")
@@ -39,8 +168,8 @@ class LabelledChemical(object):
         charge (int): charge of the detected ion
         label (str): metabolite abbreviation (e.g. "G3P")
         data_isotopes (dict): isotopic data with mass and abundance
-            as in :py:attr:`~LabelledChemical.DEFAULT_ISODATA`.
-            If set to `None`, default isotopic data are used.
+            as in :py:attr:`~LabelledChemical.DEFAULT_ISODATA`, or an :py:class:`~IsotopeTable`
+            (whose data are not checked again). If set to `None`, default isotopic data are used.
         derivative_formula (str): elemental formula of the derivative moiety
         tracer_purity (list): proportion of each isotope of the tracer element (metabolite moiety)
             The list must have the same length as the list of isotopes for the relevant
@@ -68,12 +197,19 @@ class LabelledChemical(object):
                        "Si": {"abundance": [0.92223, 0.04685, 0.03092],
                               "mass": [D('27.976926535'), D('28.976494665'), D('29.9737701')]}}
 
+    __slots__ = ("_data_isotopes", "_molecular_weight", "_tracer_purity", "_correct_NA_tracer",
+                 "_formula", "_inchi", "_isotopic_inchi", "_derivative_formula",
+                 "_correction_formula", "_mzshift_tracer", "_str_formula", "_str_derivative_formula",
+                 "_str_tracer_code", "_charge", "_tracer_el", "_idx_tracer", "label")
+
+    # table of the default isotopic data (built at first use)
+    _default_isotope_table = None
+
     def __init__(self, formula, tracer, derivative_formula, tracer_purity,
                  correct_NA_tracer, data_isotopes, charge=None, label=None, inchi=None):
         """Initialize a new LabelledChemical with its associated data."""
         # Load data_isotope first as it is critical for the other attributes
-        self._data_isotopes = self.DEFAULT_ISODATA if data_isotopes is None else data_isotopes
-        self._check_data_isotopes(self._data_isotopes)
+        self._data_isotopes = self._get_isotope_table(data_isotopes)
         # Pseudo-private attributes (mostly to work with properties)
         self._molecular_weight = None
         self._tracer_purity = tracer_purity
@@ -112,9 +248,40 @@ class LabelledChemical(object):
             raise ValueError("The isotopic tracer ({}) must be present in the"
                              " metabolite {}.".format(self._tracer_el, self._str_formula))
 
+    @classmethod
+    def _get_isotope_table(cls, data_isotopes):
+        """Return the (validated) isotope table of some isotopic data.
+
+        Args:
+            data_isotopes (dict or IsotopeTable): isotopic data, or None for the
+                default isotopic data (whose table is built once)
+
+        Returns:
+            IsotopeTable: the table
+        """
+        if isinstance(data_isotopes, IsotopeTable):
+            return data_isotopes
+        if data_isotopes is None:
+            if LabelledChemical._default_isotope_table is None:
+                LabelledChemical._default_isotope_table = IsotopeTable(cls.DEFAULT_ISODATA)
+            return LabelledChemical._default_isotope_table
+        return IsotopeTable(data_isotopes)
+
+    @staticmethod
+    def _check_data_isotopes(data_isotopes):
+        """Check :py:attr:`~data_isotopes` validity
+
+        Isotopic data are checked by :py:class:`IsotopeTable` (see
+        :py:meth:`IsotopeTable._check`), hence correctors do not call this method.
+
+        Raises:
+            ValueError: :py:attr:`~data_isotopes` is corrupted in some way.
+        """
+        IsotopeTable._check(data_isotopes)
+
     @property
     def data_isotopes(self):
-        """dict of dicts: isotopic data with mass and abundance
+        """IsotopeTable: isotopic data with mass and abundance
 
         See :py:attr:`~LabelledChemical.DEFAULT_ISODATA` for an example.
         """
@@ -122,7 +289,7 @@ class LabelledChemical(object):
 
     @property
     def formula(self):
-        """Counter: elemental formula of the metabolite moiety"""
+        """Formula: elemental formula of the metabolite moiety"""
         if self._formula is None:
             self._formula = self._parse_strformula(self._str_formula)
         return self._formula
@@ -156,8 +323,9 @@ class LabelledChemical(object):
             tracer_mass = tracer_info["mass"][self._idx_tracer]
             tracer_isotope_designation = round(tracer_mass - average_iso_mass)
             isotope_designation_0 = round(tracer_info["mass"][0] - average_iso_mass)
-            # generate isotopic inchis
-            self._isotopic_inchi = []
+            # generate isotopic inchis (the list is set once complete, since it
+            # may be accessed concurrently)
+            isotopic_inchi = []
             for j in range(self.formula[self._tracer_el] + 1):
                 if j == 0:
                     tmp = '{}/a({}{}{:+d})'.format(self._inchi, self._tracer_el, self.formula[self._tracer_el], isotope_designation_0)
@@ -165,12 +333,13 @@ class LabelledChemical(object):
                     tmp = '{}/a({}{}{:+d})'.format(self._inchi, self._tracer_el, self.formula[self._tracer_el], tracer_isotope_designation)
                 else:
                     tmp = '{}/a({}{}{:+d}),({}{}{:+d})'.format(self._inchi, self._tracer_el, j, tracer_isotope_designation, self._tracer_el, self.formula[self._tracer_el] - j, isotope_designation_0)
-                self._isotopic_inchi.append(tmp)
+                isotopic_inchi.append(tmp)
+            self._isotopic_inchi = isotopic_inchi
         return self._isotopic_inchi
 
     @property
     def derivative_formula(self):
-        """Counter: elemental formula of the derivative moiety."""
+        """Formula: elemental formula of the derivative moiety."""
         if self._derivative_formula is None:
             self._derivative_formula = self._parse_strformula(
                 self._str_derivative_formula)
@@ -226,14 +395,15 @@ class LabelledChemical(object):
         if self._mzshift_tracer is None:
             tracer_mass = self.data_isotopes[self._tracer_el]["mass"][self._idx_tracer]
             m0_mass = self.data_isotopes[self._tracer_el]["mass"][0]
-            self._mzshift_tracer = tracer_mass - m0_mass
-            assert self._mzshift_tracer > 0, "Unexpected negative tracer mass shift: {}".format(
-                self._mzshift_tracer)
+            mzshift_tracer = tracer_mass - m0_mass
+            assert mzshift_tracer > 0, "Unexpected negative tracer mass shift: {}".format(
+                mzshift_tracer)
+            self._mzshift_tracer = mzshift_tracer
         return self._mzshift_tracer
 
     @property
     def correction_formula(self):
-        """Counter: molecular formula on which the correction will be applied
+        """Formula: molecular formula on which the correction will be applied
 
         This formula is the one on which the correction vector is based.
         Remember that for the correction vector we need **non-tracers atoms**
@@ -241,14 +411,8 @@ class LabelledChemical(object):
         and **all atoms** from the derivative (including the tracer element).
         """
         if self._correction_formula is None:
-            self._correction_formula = {}
-            for element, n_atoms in self.formula.items():
-                if element != self._tracer_el:
-                    self._correction_formula[element] = n_atoms
-            if self.derivative_formula is not None:
-                for element, n_atoms in self.derivative_formula.items():
-                    self._correction_formula[element] = self._correction_formula.get(
-                        element, 0) + n_atoms
+            tracer_atoms = Formula({self._tracer_el: self.formula[self._tracer_el]})
+            self._correction_formula = self.formula - tracer_atoms + self.derivative_formula
         return self._correction_formula
 
     @staticmethod
@@ -259,18 +423,12 @@ class LabelledChemical(object):
             str_formula (str): molecular formula (e.g. "H2O").
 
         Returns:
-            dict: the number of each element in a dictionnary-like
-                counter (e.g. {'H':2,'O':1}).
+            Formula: the number of each element in a read-only counter
+                (e.g. {'H':2,'O':1}), see :py:meth:`Formula.parse`.
         """
         if str_formula is None:
             return None
-        pformula = re.findall(r'([A-Z][a-z]*)(\d*)', str_formula)
-        counter = collections.Counter()
-        for element, cnt in pformula:
-            if cnt == '':
-                cnt = 1
-            counter[element] += int(cnt)
-        return counter
+        return Formula.parse(str_formula)
 
     def _parse_strtracer(self, str_tracer):
         """Parse the tracer code.
@@ -303,12 +461,143 @@ class LabelledChemical(object):
         assert best_diff < 0.5, unexpected_msg
         return (tracer_el, idx_tracer)
 
+    def _get_chemical_parameters(self):
+        """Return the parameters of the chemical, as keyword arguments of its constructor.
+
+        Returns:
+            dict: parameters (isotopic data are None if they are the default ones)
+        """
+        data_isotopes = self._data_isotopes
+        if data_isotopes is self._default_isotope_table:
+            data_isotopes = None
+        return {"formula": self._str_formula,
+                "tracer": self._str_tracer_code,
+                "derivative_formula": self._str_derivative_formula or None,
+                "tracer_purity": self._tracer_purity,
+                "correct_NA_tracer": self._correct_NA_tracer,
+                "data_isotopes": data_isotopes,
+                "charge": self._charge,
+                "label": self.label,
+                "inchi": self._inchi or None}
+
+    def _fingerprint_isotopes(self, elements):
+        """Return a canonical fingerprint of the isotopic data of some elements.
+
+        Args:
+            elements (iterable): elements to consider
+
+        Returns:
+            tuple: masses (as str) and abundances (as float) of each element,
+            sorted by element (see :py:meth:`IsotopeTable.fingerprint`)
+        """
+        return self.data_isotopes.fingerprint(elements)
+
+
+class IsotopeTable(collections.abc.Mapping):
+    """An immutable table of isotopic data, validated once and for all.
+
+    The table is a read-only mapping with the same structure as
+    :py:attr:`LabelledChemical.DEFAULT_ISODATA` (masses and abundances of the
+    isotopes of each element), which can be given as `data_isotopes` to all
+    correctors. Since the data are checked at instantiation, correctors built with
+    the same table do not check them again.
+
+    Masses and abundances are also available as (read-only) numpy arrays, and the
+    table has a stable hash (see :py:attr:`~key`).
+
+    Args:
+        data_isotopes (dict): isotopic data with mass and abundance
+
+    Raises:
+        ValueError: the isotopic data are corrupted in some way.
+    """
+
+    __slots__ = ("_data", "_masses", "_abundances", "_fingerprints", "_key")
+
+    def __init__(self, data_isotopes):
+        self._check(data_isotopes)
+        data = {}
+        self._masses = {}
+        self._abundances = {}
+        self._fingerprints = {}
+        for element in sorted(data_isotopes):
+            masses = tuple(data_isotopes[element]["mass"])
+            abundances = tuple(data_isotopes[element]["abundance"])
+            data[element] = types.MappingProxyType({"mass": masses, "abundance": abundances})
+            self._masses[element] = np.array(masses, dtype=float)
+            self._masses[element].setflags(write=False)
+            self._abundances[element] = np.array(abundances, dtype=float)
+            self._abundances[element].setflags(write=False)
+            self._fingerprints[element] = (element,
+                                           tuple(str(mass) for mass in masses),
+                                           tuple(float(abundance) for abundance in abundances))
+        self._data = types.MappingProxyType(data)
+        content = repr(tuple(self._fingerprints[element] for element in data)).encode("utf-8")
+        self._key = hashlib.sha256(content).hexdigest()
+
+    def __getitem__(self, element):
+        return self._data[element]
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __hash__(self):
+        return hash(self._key)
+
+    def __eq__(self, other):
+        if isinstance(other, IsotopeTable):
+            return self._key == other._key
+        return collections.abc.Mapping.__eq__(self, other)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __reduce__(self):
+        return (IsotopeTable, (self.to_dict(),))
+
+    def __repr__(self):
+        return "IsotopeTable({})".format(self.to_dict())
+
+    @property
+    def key(self):
+        """str: stable hash (hexadecimal) of the masses and abundances of all elements."""
+        return self._key
+
+    def masses(self, element):
+        """Return the masses of the isotopes of an element (read-only float array)."""
+        return self._masses[element]
+
+    def abundances(self, element):
+        """Return the abundances of the isotopes of an element (read-only float array)."""
+        return self._abundances[element]
+
+    def fingerprint(self, elements):
+        """Return a canonical fingerprint of the isotopic data of some elements.
+
+        Args:
+            elements (iterable): elements to consider
+
+        Returns:
+            tuple: masses (as str) and abundances (as float) of each element,
+            sorted by element
+        """
+        return tuple(self._fingerprints[element] for element in sorted(elements))
+
+    def to_dict(self):
+        """Return the isotopic data as a (new) dict of lists."""
+        return {element: {"mass": list(data_el["mass"]), "abundance": list(data_el["abundance"])}
+                for element, data_el in self._data.items()}
+
     @staticmethod
-    def _check_data_isotopes(data_isotopes):
-        """Check :py:attr:`~data_isotopes` validity
+    def _check(data_isotopes):
+        """Check the validity of isotopic data
 
         Raises:
-            ValueError: :py:attr:`~data_isotopes` is corrupted in some way.
+            ValueError: isotopic data are corrupted in some way.
         """
         tol_isomass = 1.2  # arbitrary max mass allowed between two isotope masses (in u)
         for element, data_el in data_isotopes.items():
@@ -320,7 +609,7 @@ class LabelledChemical(object):
                                  " isotopes mass and abundance in data_isotopes."
                                  " This is not the case for {}.".format(element))
             # Mass specific checks
-            if sorted(data_el["mass"]) != data_el["mass"]:
+            if sorted(data_el["mass"]) != list(data_el["mass"]):
                 raise ValueError("Isotopes masses in data_isotopes should"
                                  " ALWAYS be in increasing number. This is not"
                                  " the case for {}.".format(element))
@@ -353,30 +642,133 @@ class InterfaceMSCorrector(object):
     This class defines the minimal methods that a corrector should implement.
     Keep in mind that a corrector must inherit from both :py:class:`~InterfaceMSCorrector`
     and :py:class:`~LabelledChemical`.
+
+    Note:
+        This class has no slots, so that it can be mixed with :py:class:`~LabelledChemical`.
+        Correctors must declare the slots `_correction_matrix` and
+        `_dense_correction_matrix`.
     """
 
+    __slots__ = ()
+
     class ImproperUsageError(Exception):
         """Raised when the corrector is used incorrectly."""
         pass
 
     def __init__(self):
         self._correction_matrix = None
+        self._dense_correction_matrix = None
 
     @property
-    def correction_matrix(self):
-        """Correction matrix.
+    def compact_correction_matrix(self):
+        """Correction matrix, in its compact representation.
 
         The correction matrix will be set once and for all using
-        :py:meth:`~compute_correction_matrix` during the first access.
+        :py:meth:`~compute_correction_matrix` during the first access, and stored as
+        a :py:class:`~isocor.solvers.BandedMatrix` if its non-zero entries are close
+        to the diagonal (see :py:func:`isocor.solvers.compress_matrix`), or as an
+        array otherwise. This is the matrix used by the solvers.
         Use `del x.correction_matrix` if you wish to reset it.
+
+        Correction matrices are shared (read-only) between all the correctors of the
+        process which have the same :py:meth:`~_fingerprint`, and can be saved on disk
+        (see :py:func:`isocor.cache.get_correction_matrix`). If several threads access
+        the matrix concurrently, it is only computed once.
         """
         if self._correction_matrix is None:
-            self._correction_matrix = self.compute_correction_matrix()
+            self._set_cached_matrix(isocor.cache.get_correction_matrix(
+                self._fingerprint(), self._compute_cached_matrix))
         return self._correction_matrix
 
+    def _compute_cached_matrix(self):
+        """Compute the correction matrix (compact) and return it with the probability
+        discarded by the threshold (see :py:class:`isocor.cache.CachedMatrix`)."""
+        matrix = isocor.solvers.compress_matrix(self.compute_correction_matrix())
+        return matrix, getattr(self, "discarded_p", 0.)
+
+    def _set_cached_matrix(self, entry):
+        """Use a correction matrix taken from the caches (a :py:class:`isocor.cache.CachedMatrix`)."""
+        self._correction_matrix = entry.matrix
+
+    @property
+    def correction_matrix(self):
+        """Correction matrix (dense array, read-only).
+
+        See :py:attr:`~compact_correction_matrix`.
+        """
+        matrix = self.compact_correction_matrix
+        if not isinstance(matrix, isocor.solvers.BandedMatrix):
+            return matrix
+        if self._dense_correction_matrix is None:
+            self._dense_correction_matrix = matrix.toarray()
+            self._dense_correction_matrix.setflags(write=False)
+        return self._dense_correction_matrix
+
     @correction_matrix.deleter
     def correction_matrix(self):
         self._correction_matrix = None
+        self._dense_correction_matrix = None
+
+    def get_parameters(self):
+        """Return the parameters of the corrector.
+
+        Returns:
+            dict: keyword arguments of the constructor of the corrector
+        """
+        raise NotImplementedError(
+            "This method must be overloaded in a child class.")
+
+    def to_dict(self, include_matrix=True):
+        """Return a compact and picklable representation of the corrector.
+
+        Correctors are sent to other processes (e.g. workers of a
+        :py:class:`concurrent.futures.ProcessPoolExecutor`) in this form, which
+        does not depend on functions that cannot be pickled (e.g. lambdas used as
+        resolution formulas).
+
+        Args:
+            include_matrix (bool): include the correction matrix, if it has already
+                been computed, so that it is not computed again
+
+        Returns:
+            dict: parameters of the corrector (see :py:meth:`~get_parameters`),
+            correction matrix as a raw buffer (see :py:func:`isocor.solvers.matrix_to_buffer`)
+            or None, and probability discarded by the threshold during its computation
+        """
+        matrix = self._correction_matrix if include_matrix else None
+        return {"parameters": self.get_parameters(),
+                "matrix": None if matrix is None else isocor.solvers.matrix_to_buffer(matrix),
+                "discarded_p": getattr(self, "discarded_p", 0.)}
+
+    @classmethod
+    def from_dict(cls, data):
+        """Return a new corrector from its representation (see :py:meth:`~to_dict`).
+
+        Args:
+            data (dict): representation of the corrector
+
+        Returns:
+            the corrector, with its correction matrix if it was included
+        """
+        corrector = cls(**data["parameters"])
+        if data["matrix"] is not None:
+            corrector._set_cached_matrix(isocor.cache.CachedMatrix(
+                isocor.solvers.matrix_from_buffer(data["matrix"]), data.get("discarded_p", 0.)))
+        return corrector
+
+    def __reduce__(self):
+        return (self.__class__.from_dict, (self.to_dict(),))
+
+    def _fingerprint(self):
+        """Returns a canonical fingerprint of all the parameters the correction matrix depends on.
+
+        Correctors with the same fingerprint share the same correction matrix.
+
+        Returns:
+            tuple: hashable fingerprint, or None if the correction matrix should
+            not be shared
+        """
+        return None
 
     def compute_correction_matrix(self):
         """Returns the correction matrix taking into account all parameters.
@@ -406,3 +798,21 @@ class InterfaceMSCorrector(object):
         """
         raise NotImplementedError(
             "This method must be overloaded in a child class.")
+
+    def correct_many(self, measurements):
+        """Return corrected measurement vectors for a batch of samples.
+
+        Args:
+            measurements (array): measured areas, one row per sample
+                (n_samples x n_isotopologues)
+
+        Returns:
+            tuple:
+                - corrected_area (array): Corrected area for each sample and peak.
+                - isotopologue_fraction (array): The abundance of each tracer
+                  isotopologue for each sample (corrected area normalized to 1).
+                - residuum (array)
+                - mean enrichment (array)
+        """
+        raise NotImplementedError(
+            "This method must be overloaded in a child class.")
@@ -0,0 +1,341 @@
+"""Caches shared by all IsoCor *correctors* of a process.
+
+Correction matrices only depend on the correction parameters (formulas, tracer,
+isotopic data, resolution, etc.), hence correctors built with the same parameters
+(e.g. during successive runs of the CLI or GUI, or by successive calls to the
+:py:class:`~isocor.mscorrectors.MetaboliteCorrectorFactory`) can share them.
+
+Correctors look up :py:data:`~correction_matrix_cache` with a canonical
+fingerprint of their parameters before computing their correction matrix.
+Cached matrices are read-only since they are shared between correctors, and are
+stored with the probability discarded by the threshold during their computation
+(see :py:class:`~CachedMatrix`).
+
+Correction matrices can also be saved on disk (opt-in, see
+:py:func:`~set_correction_matrix_store`) to be reused by later runs.
+"""
+
+import collections
+import threading
+import hashlib
+import logging
+import os
+import tempfile
+from pathlib import Path
+import numpy as np
+from isocor.solvers import BandedMatrix
+
+logger = logging.getLogger(__name__)
+
+CacheInfo = collections.namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+#: Cached correction matrix, with the probability discarded by the threshold during its
+#: computation (see :py:attr:`~isocor.mscorrectors.LowResMetaboliteCorrector.discarded_p`).
+CachedMatrix = collections.namedtuple("CachedMatrix", ["matrix", "discarded_p"])
+
+
+class LRUCache(object):
+    """A thread-safe, bounded, Least-Recently-Used cache.
+
+    Args:
+        maxsize (int): maximal number of items in the cache. The least recently
+            used items are evicted when this size is reached. If set to 0,
+            nothing is cached.
+    """
+
+    def __init__(self, maxsize=128):
+        self._maxsize = self._check_maxsize(maxsize)
+        self._data = collections.OrderedDict()
+        self._lock = threading.RLock()
+        self._hits = 0
+        self._misses = 0
+
+    @staticmethod
+    def _check_maxsize(maxsize):
+        try:
+            maxsize = int(maxsize)
+        except (TypeError, ValueError):
+            raise ValueError("Cache size should be an integer ({}).".format(maxsize))
+        if maxsize < 0:
+            raise ValueError("Cache size should be >=0 ({}).".format(maxsize))
+        return maxsize
+
+    @property
+    def maxsize(self):
+        """int: maximal number of items in the cache.
+
+        Items are evicted if the cache is shrinked below its current size.
+        """
+        return self._maxsize
+
+    @maxsize.setter
+    def maxsize(self, maxsize):
+        with self._lock:
+            self._maxsize = self._check_maxsize(maxsize)
+            self._evict()
+
+    def _evict(self):
+        while len(self._data) > self._maxsize:
+            self._data.popitem(last=False)
+
+    def get(self, key, default=None):
+        """Return the item stored for key (and mark it as recently used), or default."""
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self._misses += 1
+                return default
+            self._data.move_to_end(key)
+            self._hits += 1
+            return value
+
+    def peek(self, key, default=None):
+        """Return the item stored for key, or default (statistics and order are not updated)."""
+        with self._lock:
+            return self._data.get(key, default)
+
+    def put(self, key, value):
+        """Store an item, evicting the least recently used items if needed."""
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            self._evict()
+
+    def clear(self):
+        """Remove all items and reset statistics."""
+        with self._lock:
+            self._data.clear()
+            self._hits = 0
+            self._misses = 0
+
+    def cache_info(self):
+        """Return cache statistics.
+
+        Returns:
+            CacheInfo: named tuple with number of hits and misses, maximal and current size
+        """
+        with self._lock:
+            return CacheInfo(self._hits, self._misses, self._maxsize, len(self._data))
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+
+class MatrixStore(object):
+    """Persistent store of correction matrices, as a directory of `.npz` files.
+
+    Each matrix is saved in a file named after a hash of the fingerprint of the
+    corrector and of the version of IsoCor, hence matrices computed by another
+    version are never reused.
+
+    Args:
+        path (str): directory where matrices are saved (created if needed)
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    @staticmethod
+    def get_key(fingerprint):
+        """Return the content hash used to identify a correction matrix.
+
+        Args:
+            fingerprint (tuple): fingerprint of the corrector
+
+        Returns:
+            str: hexadecimal hash of the fingerprint and of the version of IsoCor
+        """
+        import isocor
+        content = repr((isocor.__version__, fingerprint)).encode("utf-8")
+        return hashlib.sha256(content).hexdigest()
+
+    def _get_file(self, fingerprint):
+        return self.path.joinpath(self.get_key(fingerprint) + ".npz")
+
+    def load(self, fingerprint):
+        """Return the correction matrix saved for fingerprint (as a :py:class:`~CachedMatrix`), or None.
+
+        Files saved without the probability discarded by the threshold are not used.
+        """
+        matrix_file = self._get_file(fingerprint)
+        entry = None
+        if matrix_file.is_file():
+            try:
+                with np.load(str(matrix_file)) as data:
+                    if "discarded_p" in data:
+                        if "bands" in data:
+                            matrix = BandedMatrix(data["bands"], data["lower"], data["upper"])
+                        else:
+                            matrix = data["matrix"]
+                        entry = CachedMatrix(matrix, float(data["discarded_p"]))
+            except Exception as err:
+                logger.warning("Cannot load correction matrix from '%s', it will be"
+                               " recomputed: %s", matrix_file, err)
+        with self._lock:
+            if entry is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+        return entry
+
+    def save(self, fingerprint, matrix, discarded_p=0.):
+        """Save a correction matrix (the file is written atomically).
+
+        Banded matrices are saved in their compact representation, with the
+        probability discarded by the threshold during their computation.
+        """
+        matrix_file = self._get_file(fingerprint)
+        tmp_file = None
+        try:
+            fd, tmp_file = tempfile.mkstemp(suffix=".tmp", dir=str(self.path))
+            with os.fdopen(fd, "wb") as fp:
+                if isinstance(matrix, BandedMatrix):
+                    np.savez(fp, bands=matrix.bands, lower=matrix.lower, upper=matrix.upper,
+                             discarded_p=discarded_p)
+                else:
+                    np.savez(fp, matrix=matrix, discarded_p=discarded_p)
+            os.replace(tmp_file, str(matrix_file))
+        except OSError as err:
+            logger.warning("Cannot save correction matrix in '%s': %s", matrix_file, err)
+            if tmp_file is not None and os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+    def clear(self):
+        """Remove all saved matrices and reset statistics."""
+        for matrix_file in self.path.glob("*.npz"):
+            matrix_file.unlink()
+        with self._lock:
+            self._hits = 0
+            self._misses = 0
+
+    def cache_info(self):
+        """Return store statistics.
+
+        Returns:
+            CacheInfo: named tuple with number of hits and misses, and number of
+            saved matrices (maxsize is None since the store is not bounded)
+        """
+        with self._lock:
+            return CacheInfo(self._hits, self._misses, None, len(list(self.path.glob("*.npz"))))
+
+
+#: Correction matrices shared by all correctors, indexed by the fingerprint of their parameters.
+correction_matrix_cache = LRUCache(maxsize=256)
+
+#: Persistent store of correction matrices (disabled by default).
+correction_matrix_store = None
+
+# locks of the correction matrices being computed, indexed by fingerprint
+_computing = {}
+_computing_lock = threading.Lock()
+
+
+def set_correction_matrix_store(path):
+    """Enable (or disable) the persistent store of correction matrices.
+
+    Args:
+        path (str): directory where matrices are saved, or None to disable the store
+
+    Returns:
+        MatrixStore: the store (None if disabled)
+    """
+    global correction_matrix_store
+    correction_matrix_store = None if path is None else MatrixStore(path)
+    return correction_matrix_store
+
+
+def lookup_correction_matrix(fingerprint):
+    """Return a correction matrix from the caches, or None.
+
+    The matrix is looked up in :py:data:`~correction_matrix_cache`, then in
+    :py:data:`~correction_matrix_store` (if enabled), in which case it is added
+    to the cache.
+
+    Args:
+        fingerprint (tuple): fingerprint of the corrector
+
+    Returns:
+        CachedMatrix: the correction matrix (read-only) and the probability
+        discarded by the threshold, or None
+    """
+    entry = correction_matrix_cache.get(fingerprint)
+    if entry is not None:
+        return entry
+    store = correction_matrix_store
+    if store is not None:
+        entry = store.load(fingerprint)
+        if entry is not None:
+            entry.matrix.setflags(write=False)
+            correction_matrix_cache.put(fingerprint, entry)
+    return entry
+
+
+def register_correction_matrix(fingerprint, matrix, discarded_p=0.):
+    """Save a correction matrix computed for fingerprint in the caches.
+
+    Args:
+        fingerprint (tuple): fingerprint of the corrector
+        matrix (array or BandedMatrix): the correction matrix (set read-only)
+        discarded_p (float): probability discarded by the threshold during the
+            computation of the matrix
+
+    Returns:
+        CachedMatrix: the correction matrix and the probability discarded
+    """
+    if correction_matrix_store is not None:
+        correction_matrix_store.save(fingerprint, matrix, discarded_p)
+    matrix.setflags(write=False)
+    entry = CachedMatrix(matrix, discarded_p)
+    correction_matrix_cache.put(fingerprint, entry)
+    return entry
+
+
+def get_correction_matrix(fingerprint, compute):
+    """Return a correction matrix from the caches, or compute it.
+
+    The matrix is looked up in :py:data:`~correction_matrix_cache`, then in
+    :py:data:`~correction_matrix_store` (if enabled). If it is not found, it is
+    computed and saved in both. Concurrent calls (from several threads) with the
+    same fingerprint wait for the matrix to be computed once.
+
+    Args:
+        fingerprint (tuple): fingerprint of the corrector (if None, the matrix is
+            computed and not cached)
+        compute (func): function returning the correction matrix (array or
+            :py:class:`~isocor.solvers.BandedMatrix`) and the probability discarded
+            by the threshold during its computation
+
+    Returns:
+        CachedMatrix: the correction matrix (read-only) and the probability discarded
+    """
+    if fingerprint is None:
+        matrix, discarded_p = compute()
+        matrix.setflags(write=False)
+        return CachedMatrix(matrix, discarded_p)
+    entry = lookup_correction_matrix(fingerprint)
+    if entry is not None:
+        return entry
+    # the matrix is computed by a single thread, others wait for it
+    with _computing_lock:
+        lock = _computing.setdefault(fingerprint, threading.Lock())
+    try:
+        with lock:
+            if fingerprint in correction_matrix_cache:
+                entry = correction_matrix_cache.get(fingerprint)
+            if entry is None:
+                entry = register_correction_matrix(fingerprint, *compute())
+    finally:
+        with _computing_lock:
+            if _computing.get(fingerprint) is lock:
+                del _computing[fingerprint]
+    return entry
@@ -10,13 +10,23 @@ import math
 import functools
 import itertools as it
 import logging
+import collections
+import threading
 from decimal import Decimal as D
 import numpy as np
 from scipy.optimize import fmin_l_bfgs_b
-from isocor.base import LabelledChemical, InterfaceMSCorrector
+from scipy.special import gammaln, xlogy
+import isocor.cache
+import isocor.solvers
+from isocor.base import LabelledChemical, InterfaceMSCorrector, Formula, IsotopeTable
+from isocor.solvers import ActiveSetNNLS, UnconstrainedLeastSquares, KroneckerLeastSquares, KroneckerNNLS, \
+    kronecker_dot
 
 logger = logging.getLogger(__name__)
 
+# solver statistics of correctors may be updated by several threads
+_solver_stats_lock = threading.Lock()
+
 
 class MetaboliteCorrectorFactory(object):
     """A Factory that returns the right *metabolite corrector* given the correction options.
@@ -27,7 +37,10 @@ class MetaboliteCorrectorFactory(object):
             h2-11H,1H2/t2-,3-,4+,5-,6+/m1/s1" for alpha- D -glucopyranose).
             Note that the InChI might represents the metabolite moiety (e.g. a fragment
             ion) or the metabolite, hence its formula may differ from :py:attr:`~formula`.
-        tracer (str): the isotopic tracer (e.g. "13C")
+        tracer (str): the isotopic tracer (e.g. "13C"). Several tracers can be given as
+            a list or a comma-separated string (e.g. "13C,15N"), in which case a
+            :py:class:`~MultiTracerMetaboliteCorrector` is returned (high-resolution
+            parameters are then not supported).
         label (str): metabolite abbreviation (e.g. "G3P")
         data_isotopes (dict): isotopic data with mass and abundance
             as in :py:attr:`~LabelledChemical.DEFAULT_ISODATA` (default values)
@@ -36,7 +49,8 @@ class MetaboliteCorrectorFactory(object):
         tracer_purity (list): proportion of each isotope of the tracer element (metabolite moiety)
             The list must have the same length as the list of isotopes for the relevant
             isotope in :py:attr:`~data_isotopes`. Must be normalized to one.
-            Default is perfect purity.
+            Default is perfect purity. With several tracers, a dict of purities
+            indexed by tracer code.
         correct_NA_tracer (bool): flag to correct tracer natural abundance or not.
             If set to True, tracer elements of the metabolite moiety will be
             corrected for the natural isotopic abundance of the tracer.
@@ -51,6 +65,20 @@ class MetaboliteCorrectorFactory(object):
             the correction limit among the presets: "orbitrap" (default), "ft-icr", and "constant".
             This formula depends on your mass spectrometer.
         charge (int): charge state of the metabolite (e.g. "-2").
+        solver (str): code of the solver used to correct measurements among the
+            presets: "bfgs" (default) and "nnls".
+        fast_path (bool): try the unconstrained least-squares solution first and only
+            use the solver for samples with a negative component (default: True).
+        mass_engine (str): code of the engine used to compute masses of high-resolution
+            isotopic clusters among the presets: "fixed" (default) and "decimal".
+        threshold_p (float): probability threshold under which isotopic species are
+            neglected (None: keep all species). Default is "auto": no threshold at
+            low-resolution, and at high-resolution no threshold for molecules lighter
+            than 500 Da and 1e-10 otherwise.
+        max_heavy_isotopes (int): high-resolution only, maximal number of atoms of minor
+            isotopes in the isotopic species of each element (default: None, no limit).
+        max_cluster_size (int): high-resolution only, maximal number of peaks of isotopic
+            clusters (default: None, no limit).
 
     Raises:
         ValueError: wrong input
@@ -65,13 +93,46 @@ class MetaboliteCorrectorFactory(object):
         derivative_formula = kwargs.pop("derivative_formula", None)
         tracer_purity = kwargs.pop("tracer_purity", None)
         correct_NA_tracer = kwargs.pop("correct_NA_tracer", False)
+        solver = kwargs.pop("solver", "bfgs")
+        fast_path = kwargs.pop("fast_path", True)
+        threshold_p = kwargs.pop("threshold_p", "auto")
+        lowres_threshold_p = None if threshold_p == "auto" else threshold_p
         # Gather up parameters used for specific correctors
         resolution = kwargs.pop("resolution", None)
         charge = kwargs.pop("charge", None)
         mz_of_resolution = kwargs.pop("mz_of_resolution", None)
         resolution_formula_code = kwargs.pop("resolution_formula_code", "orbitrap")
+        mass_engine = kwargs.pop("mass_engine", "fixed")
+        max_heavy_isotopes = kwargs.pop("max_heavy_isotopes", None)
+        max_cluster_size = kwargs.pop("max_cluster_size", None)
         # Choose a corrector
-        if resolution is None and mz_of_resolution is None:
+        if not isinstance(tracer, str) or "," in tracer:
+            logger.debug("MetaboliteCorrectorFactory chose to use a"
+                         " MultiTracerMetaboliteCorrector for %s.", formula)
+            # isotopologues of all the tracers are assumed to be resolved
+            highres_parameters = {"resolution": resolution is not None,
+                                  "mz_of_resolution": mz_of_resolution is not None,
+                                  "resolution_formula_code": resolution_formula_code != "orbitrap",
+                                  "mass_engine": mass_engine != "fixed",
+                                  "max_heavy_isotopes": max_heavy_isotopes is not None,
+                                  "max_cluster_size": max_cluster_size is not None}
+            unsupported = sorted(name for name, is_set in highres_parameters.items() if is_set)
+            if unsupported:
+                message = "High-resolution parameters ({}) are not supported with several" \
+                          " tracers (isotopologues of all the tracers are assumed to be" \
+                          " resolved).".format(", ".join(unsupported))
+                logger.error(message)
+                raise ValueError(message)
+            corrector = MultiTracerMetaboliteCorrector(formula, tracer, label=label,
+                                                       data_isotopes=data_isotopes,
+                                                       derivative_formula=derivative_formula,
+                                                       tracer_purity=tracer_purity,
+                                                       correct_NA_tracer=correct_NA_tracer,
+                                                       solver=solver,
+                                                       fast_path=fast_path,
+                                                       threshold_p=lowres_threshold_p,
+                                                       inchi=inchi)
+        elif resolution is None and mz_of_resolution is None:
             logger.debug("MetaboliteCorrectorFactory chose to use a"
                          " LowResMetaboliteCorrector for %s.", formula)
             corrector = LowResMetaboliteCorrector(formula, tracer, label=label,
@@ -79,6 +140,9 @@ class MetaboliteCorrectorFactory(object):
                                                   derivative_formula=derivative_formula,
                                                   tracer_purity=tracer_purity,
                                                   correct_NA_tracer=correct_NA_tracer,
+                                                  solver=solver,
+                                                  fast_path=fast_path,
+                                                  threshold_p=lowres_threshold_p,
                                                   inchi=inchi)
         elif resolution and mz_of_resolution and charge:
             logger.debug("MetaboliteCorrectorFactory chose to use a"
@@ -92,7 +156,13 @@ class MetaboliteCorrectorFactory(object):
                                                        correct_NA_tracer=correct_NA_tracer,
                                                        resolution_formula_code=resolution_formula_code,
                                                        charge=charge,
-                                                      inchi=inchi)
+                                                       mass_engine=mass_engine,
+                                                       max_heavy_isotopes=max_heavy_isotopes,
+                                                       max_cluster_size=max_cluster_size,
+                                                       solver=solver,
+                                                       fast_path=fast_path,
+                                                       threshold_p=threshold_p,
+                                                       inchi=inchi)
             except InterfaceMSCorrector.ImproperUsageError as reason:
                 logger.warning("Improper usage of HighResMetaboliteCorrector "
                                "by MetaboliteCorrectorFactory."
@@ -103,6 +173,9 @@ class MetaboliteCorrectorFactory(object):
                                                       derivative_formula=derivative_formula,
                                                       tracer_purity=tracer_purity,
                                                       correct_NA_tracer=correct_NA_tracer,
+                                                      solver=solver,
+                                                      fast_path=fast_path,
+                                                      threshold_p=lowres_threshold_p,
                                                       inchi=inchi)
         else:
             message = "MetaboliteCorrectorFactory was unable to select a" \
@@ -117,6 +190,134 @@ class MetaboliteCorrectorFactory(object):
         return corrector
 
 
+class CorrectorPool(object):
+    """A pooled :py:class:`~MetaboliteCorrectorFactory` which shares correctors built
+    with the same parameters.
+
+    Correctors are indexed by a canonical key of their parameters (e.g. formulas
+    are compared by their atoms, isotopic data by their content, and default
+    values can be omitted), hence processing the same data several times (e.g.
+    successive runs of the GUI) neither constructs the correctors nor computes
+    their correction matrices again.
+
+    Pooled correctors are shared, hence they must be used as read-only objects
+    (e.g. :py:attr:`~LowResMetaboliteCorrector.threshold_p` or
+    :py:attr:`~LabelledChemical.label` must not be modified).
+
+    Args:
+        maxsize (int): maximal number of correctors in the pool. The least
+            recently used correctors are evicted when this size is reached. If
+            set to 0, correctors are not pooled.
+
+    Example:
+        >>> pool = CorrectorPool(maxsize=1024)
+        >>> x = pool("C3H7O6P", "13C", label="G3P")
+        >>> pool("C3H7O6P", "13C", label="G3P", correct_NA_tracer=False) is x
+        True
+    """
+
+    # default values of the parameters of MetaboliteCorrectorFactory
+    _DEFAULTS = {"label": None, "inchi": None, "data_isotopes": None,
+                 "derivative_formula": Formula.parse(""), "tracer_purity": None,
+                 "correct_NA_tracer": False, "solver": "bfgs", "fast_path": True,
+                 "threshold_p": "auto", "resolution": None, "charge": None,
+                 "mz_of_resolution": None, "resolution_formula_code": "orbitrap",
+                 "mass_engine": "fixed", "max_heavy_isotopes": None, "max_cluster_size": None}
+
+    def __init__(self, maxsize=1024):
+        self._cache = isocor.cache.LRUCache(maxsize)
+
+    @property
+    def maxsize(self):
+        """int: maximal number of correctors in the pool."""
+        return self._cache.maxsize
+
+    @maxsize.setter
+    def maxsize(self, maxsize):
+        self._cache.maxsize = maxsize
+
+    @classmethod
+    def _canonical(cls, value):
+        """Return a hashable representation of a parameter value."""
+        if isinstance(value, IsotopeTable):
+            return value.key
+        if isinstance(value, collections.abc.Mapping):
+            return tuple(sorted((key, cls._canonical(val)) for key, val in value.items()))
+        if isinstance(value, (list, tuple, np.ndarray)):
+            return tuple(cls._canonical(val) for val in value)
+        if isinstance(value, np.generic):
+            return value.item()
+        return value
+
+    def get_key(self, formula, tracer, **kwargs):
+        """Return the canonical key of a set of parameters.
+
+        Args:
+            formula (str): elemental formula of the metabolite moiety
+            tracer (str): the isotopic tracer
+            kwargs: other parameters of :py:class:`~MetaboliteCorrectorFactory`
+
+        Returns:
+            tuple: hashable key (None if the parameters cannot be pooled)
+        """
+        params = [("formula", Formula.parse(formula) if isinstance(formula, str) else formula)]
+        if isinstance(tracer, str):
+            tracer = tuple(code.strip() for code in tracer.split(","))
+        params.append(("tracer", tuple(tracer)))
+        for name, value in sorted(kwargs.items()):
+            if name == "derivative_formula" and (value is None or isinstance(value, str)):
+                value = Formula.parse(value or "")
+            value = self._canonical(value)
+            if name in self._DEFAULTS and value == self._DEFAULTS[name]:
+                continue
+            params.append((name, value))
+        key = tuple(params)
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def __call__(self, formula, tracer, **kwargs):
+        """Return a corrector for the given parameters (see :py:class:`~MetaboliteCorrectorFactory`).
+
+        The corrector is taken from the pool if it has already been constructed
+        with the same parameters.
+
+        Raises:
+            ValueError: wrong input
+            ImproperUsageError: incoherent input
+        """
+        data_isotopes = kwargs.get("data_isotopes")
+        if isinstance(data_isotopes, collections.abc.Mapping):
+            # validate isotopic data once for all correctors
+            kwargs["data_isotopes"] = LabelledChemical._get_isotope_table(data_isotopes)
+        key = self.get_key(formula, tracer, **kwargs)
+        if key is None:
+            logger.debug("Parameters of %s cannot be pooled.", formula)
+            return MetaboliteCorrectorFactory(formula, tracer, **kwargs)
+        corrector = self._cache.get(key)
+        if corrector is None:
+            corrector = MetaboliteCorrectorFactory(formula, tracer, **kwargs)
+            self._cache.put(key, corrector)
+        return corrector
+
+    def clear(self):
+        """Remove all correctors and reset statistics."""
+        self._cache.clear()
+
+    def cache_info(self):
+        """Return pool statistics.
+
+        Returns:
+            CacheInfo: named tuple with number of hits and misses, maximal and current size
+        """
+        return self._cache.cache_info()
+
+    def __len__(self):
+        return len(self._cache)
+
+
 class LowResMetaboliteCorrector(LabelledChemical, InterfaceMSCorrector):
     """Metabolite *corrector* for low-resolution mass-spectrometry data.
 
@@ -143,21 +344,70 @@ class LowResMetaboliteCorrector(LabelledChemical, InterfaceMSCorrector):
             corrected for the natural isotopic abundance of the tracer.
             Note that tracer elements from the derivative moiety will always be
             corrected at natural abundance (by definition of a derivative moiety).
+        solver (str): code of the solver used to correct measurements among the
+            presets: "bfgs" (L-BFGS-B optimization, default) and "nnls" (exact
+            active-set algorithm).
+        fast_path (bool): try the unconstrained least-squares solution first and only
+            use the solver for samples with a negative component (default: True).
+        threshold_p (float): probability threshold under which the trailing peaks of
+            the mass distribution vector are neglected (default: None, keep all peaks).
     """
+    # Registered solvers used to compute corrected areas
+    # each solver is a method taking measurements (one sample per row)
+    # and returning the corresponding corrected areas
+    SOLVERS = {
+        "bfgs": "_solve_with_bfgs",
+        "nnls": "_solve_with_nnls"
+    }
+
+    __slots__ = ("_correction_matrix", "_dense_correction_matrix", "_solver", "_fast_path",
+                 "_nnls", "_unconstrained", "threshold_p", "discarded_p", "solver_stats")
 
-    def __init__(self, formula, tracer, **kwargs):
+    def __init__(self, formula, tracer, solver="bfgs", fast_path=True, threshold_p=None, **kwargs):
         LabelledChemical.__init__(self, formula, tracer, **kwargs)
         InterfaceMSCorrector.__init__(self)
+        if solver not in self.SOLVERS:
+            raise NotImplementedError("No solver registered for code '{}'.".format(solver))
+        self._solver = solver
+        self._fast_path = bool(fast_path)
+        self._nnls = None
+        self._unconstrained = None
+        # Public attribute: probability threshold under which isotopic species
+        # are neglected (None: keep all species)
+        if threshold_p is not None:
+            try:
+                threshold_p = float(threshold_p)
+            except (TypeError, ValueError):
+                raise ValueError("Parameter 'threshold_p' should be numeric ({}).".format(threshold_p))
+            if not 0. <= threshold_p <= 1.:
+                raise ValueError("Parameter 'threshold_p' should be within [0, 1] ({}).".format(threshold_p))
+        self.threshold_p = threshold_p
+        # Public attribute: probability of the isotopic species neglected (below
+        # threshold_p) during the last computation of a mass distribution vector,
+        # isotopic cluster or correction matrix (maximum over its columns)
+        self.discarded_p = 0.
+        # Public attribute: number of samples corrected by each path
+        # ("fast" or solver code), can be reset at runtime
+        self.solver_stats = collections.Counter()
         # Log if direct instanciation
         if self.__class__.__name__ == LowResMetaboliteCorrector.__name__:
             self._log_on_init()
 
     def _log_on_init(self):
-        """Log instantiation of a new metabolite corrector object."""
-        key_debug_log = ["data_isotopes"]
+        """Log instantiation of a new metabolite corrector object.
+
+        Nothing is done if debug messages are not logged, since correctors may be
+        instantiated by thousands.
+        """
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
+        key_debug_log = ["_data_isotopes"]
         logme_info = []
         logme_debug = []
-        for k, v in vars(self).items():
+        slots = it.chain.from_iterable(getattr(cls, "__slots__", ())
+                                       for cls in reversed(type(self).__mro__))
+        for k in slots:
+            v = getattr(self, k, None)
             if k not in key_debug_log:
                 logme_info.append((k, v))
             else:
@@ -166,11 +416,50 @@ class LowResMetaboliteCorrector(LabelledChemical, InterfaceMSCorrector):
                     self.label, logme_info)
         logger.debug("%s additionally uses: %s", self.label, logme_debug)
 
-    def correct(self, measurement):
+    @property
+    def solver(self):
+        """str: code of the solver used to correct measurements (see :attr:`~SOLVERS`)."""
+        return self._solver
+
+    def get_parameters(self):
+        """Return the parameters of the corrector.
+
+        Returns:
+            dict: keyword arguments of the constructor of the corrector
+        """
+        parameters = self._get_chemical_parameters()
+        parameters.update(solver=self._solver, fast_path=self._fast_path,
+                          threshold_p=self.threshold_p)
+        return parameters
+
+    def _fingerprint(self):
+        """Returns a canonical fingerprint of all the parameters the correction matrix depends on.
+
+        Returns:
+            tuple: formulas, tracer, tracer purity, correction of tracer natural abundance,
+            isotopic data of all elements and probability threshold
+        """
+        return (self.__class__.__name__,
+                self.formula,
+                self.derivative_formula,
+                self._tracer_el,
+                self._idx_tracer,
+                tuple(float(p) for p in self.tracer_purity),
+                bool(self.correct_NA_tracer),
+                self._fingerprint_isotopes(set(self.formula) | set(self.derivative_formula)),
+                self.threshold_p)
+
+    @property
+    def fast_path(self):
+        """bool: try the unconstrained least-squares solution before the solver."""
+        return self._fast_path
+
+    def correct(self, measurement, return_path=False):
         """Return corrected measurement vector.
 
         Args:
             measurement (list): measured areas
+            return_path (bool): also return the path used to correct the sample
 
         Returns:
             tuple:
@@ -179,6 +468,8 @@ class LowResMetaboliteCorrector(LabelledChemical, InterfaceMSCorrector):
                   isotopologue (corrected area normalized to 1).
                 - residuum
                 - mean enrichment
+                - path (str): only if `return_path` is True; "fast" if the unconstrained
+                  solution was used, the code of the solver otherwise
         """
         logger.debug("New correction for %s with: measurement=%s.",
                      self.label, measurement)
@@ -190,12 +481,54 @@ class LowResMetaboliteCorrector(LabelledChemical, InterfaceMSCorrector):
                              " be traced)".format(len(measurement),
                                                   self.formula[self._tracer_el] + 1))
         # Perform the actual correction
-        corrected_area, iso_fraction, residuum, enrichment = self._correct_with_bfgs(
-            measurement)
+        corrected_area, paths = self._solve(np.array(measurement, dtype=float)[np.newaxis, :])
+        corrected_area = corrected_area[0]
+        iso_fraction, residuum, enrichment = self._summarize(measurement, corrected_area)
         logger.debug(
-            "Finished correction. Residuum (normalized to 1): %s", residuum)
+            "Finished correction (%s path). Residuum (normalized to 1): %s", paths[0], residuum)
+        if return_path:
+            return corrected_area, iso_fraction, residuum, enrichment, paths[0]
         return corrected_area, iso_fraction, residuum, enrichment
 
+    def correct_many(self, measurements, return_paths=False):
+        """Return corrected measurement vectors for a batch of samples.
+
+        With the "bfgs" solver, all samples are corrected during a single optimization
+        run, which avoids paying the start-up cost of the optimizer for each sample
+        (as when :py:meth:`~correct` is called in a loop). With the "nnls" solver,
+        samples which share the same passive set are solved at once.
+
+        Args:
+            measurements (array): measured areas, one row per sample and one
+                column per isotopologue (n_samples x n_isotopologues)
+            return_paths (bool): also return the path used to correct each sample
+
+        Returns:
+            tuple:
+                - corrected_area (array): Corrected area for each sample and peak.
+                - isotopologue_fraction (array): The abundance of each tracer
+                  isotopologue for each sample (corrected area normalized to 1).
+                - residuum (array): residuum of each sample (normalized to 1)
+                - mean enrichment (array): mean enrichment of each sample
+                - paths (array): only if `return_paths` is True; path used for each
+                  sample (see :py:meth:`~correct`)
+        """
+        v_mes = np.array(measurements, dtype=float)
+        n_isotopologues = self.formula[self._tracer_el] + 1
+        if v_mes.ndim != 2:
+            raise ValueError("Measurements should be a 2-D array (n_samples x n_isotopologues),"
+                             " got an array with {} dimension(s).".format(v_mes.ndim))
+        if v_mes.shape[1] != n_isotopologues:
+            raise ValueError("The length of the measured isotopic cluster ({}) is different"
+                             " than the required number of measurements: {}"
+                             " (i.e. N + 1, where N is the number of atoms that could"
+                             " be traced)".format(v_mes.shape[1], n_isotopologues))
+        logger.debug("New correction of %s samples for %s.", v_mes.shape[0], self.label)
+        corrected_area, paths = self._solve(v_mes)
+        if return_paths:
+            return self._summarize_many(v_mes, corrected_area) + (paths,)
+        return self._summarize_many(v_mes, corrected_area)
+
     @staticmethod
     def _get_cost_function(mid, v_mes, mat_cor):
         """Cost function used for optimization.
@@ -205,34 +538,58 @@ class LowResMetaboliteCorrector(LabelledChemical, InterfaceMSCorrector):
         Args:
             mid: isotopologue_fraction
             v_mes (array): measurement vector
-            mat_cor (array): correction matrix
+            mat_cor (array or BandedMatrix): correction matrix
 
         Returns:
             float: (sum(v_mes - mat_cor * mid)^2, gradient)
         """
-        x = v_mes - np.dot(mat_cor, mid)
+        x = v_mes - mat_cor.dot(mid)
         # calculate sum of square differences and gradient
-        return (np.dot(x, x), np.dot(mat_cor.transpose(), x)*-2)
+        return (np.dot(x, x), mat_cor.transpose().dot(x)*-2)
+
+    def _solve(self, v_mes):
+        """Compute corrected areas.
 
-    def _correct_with_bfgs(self, measurement):
-        """Perform the correction of the measurement vector using a L-BFGS-B algorithm.
+        If :attr:`~fast_path` is set, the unconstrained least-squares solution is
+        computed first (a single matrix product with the cached pseudo-inverse of the
+        correction matrix). The solver selected at instantiation is only used for samples
+        with a negative component, or for all samples if the correction matrix is
+        ill-conditioned.
+
+        Args:
+            v_mes (array): measurement vectors (n_samples x n_isotopologues)
+
+        Returns:
+            tuple:
+                - (array) corrected areas (n_samples x n_isotopologues)
+                - (array) path used for each sample ("fast" or solver code)
+        """
+        paths = np.full(v_mes.shape[0], self.solver, dtype=object)
+        if self.fast_path:
+            if self._unconstrained is None or \
+                    self._unconstrained.matrix is not self.compact_correction_matrix:
+                self._unconstrained = UnconstrainedLeastSquares(self.compact_correction_matrix)
+            corrected_area, is_fast = self._unconstrained.solve_many(v_mes)
+            paths[is_fast] = "fast"
+            if not is_fast.all():
+                corrected_area[~is_fast] = getattr(self, self.SOLVERS[self.solver])(v_mes[~is_fast])
+        else:
+            corrected_area = getattr(self, self.SOLVERS[self.solver])(v_mes)
+        with _solver_stats_lock:
+            self.solver_stats.update(paths)
+        return corrected_area, paths
+
+    def _summarize(self, measurement, corrected_area):
+        """Normalize the corrected areas and calculate the residuum of one sample.
 
         Args:
             measurement (list): measurement vector
+            corrected_area (array): corrected areas
+
+        Returns:
+            tuple: isotopologue_fraction, residuum, enrichment
         """
-        # perform correction and calculate residuum
-        v_mes = np.array(measurement).transpose()
-        length_result = self.formula[self._tracer_el] + 1
-        corrected_area, _, _ = fmin_l_bfgs_b(self._get_cost_function,
-                                             np.zeros(length_result),
-                                             fprime=None,
-                                             approx_grad=0,
-                                             args=(
-                                                 v_mes, self.correction_matrix),
-                                             factr=1000,
-                                             pgtol=1e-10,
-                                             bounds=[(0., float('inf'))] * length_result)
-        resi = v_mes - np.dot(self.correction_matrix, corrected_area)
+        resi = np.array(measurement) - self.compact_correction_matrix.dot(corrected_area)
         # normalize mid and residuum
         sum_p = math.fsum(corrected_area)
         if sum_p != 0:
@@ -240,15 +597,162 @@ class LowResMetaboliteCorrector(LabelledChemical, InterfaceMSCorrector):
             enrichment = math.fsum(
                 p*i for i, p in enumerate(isotopologue_fraction))/self.formula[self._tracer_el]
         else:
-            isotopologue_fraction = [np.NaN for p in corrected_area]
-            enrichment = np.NaN
+            isotopologue_fraction = [np.nan for p in corrected_area]
+            enrichment = np.nan
         sum_m = math.fsum(measurement)
         if sum_m != 0:
             residuum = [v/sum_m for v in resi]
         else:
-            residuum = [np.NaN for v in resi]
+            residuum = [np.nan for v in resi]
+        return isotopologue_fraction, residuum, enrichment
+
+    @staticmethod
+    def _get_cost_function_many(mids, v_mes, mat_cor):
+        """Cost function used for the optimization of a batch of samples.
+
+        Samples are independent, hence the cost is the sum of the cost of each
+        sample (see :py:meth:`~_get_cost_function`).
+
+        Args:
+            mids: flattened isotopologue_fraction of all samples
+            v_mes (array): measurement vectors (n_samples x n_isotopologues)
+            mat_cor (array or BandedMatrix): correction matrix
+
+        Returns:
+            float: (sum(v_mes - mids * mat_cor^T)^2, flattened gradient)
+        """
+        x = v_mes - mat_cor.dot(mids.reshape(v_mes.shape).transpose()).transpose()
+        return (np.vdot(x, x), (mat_cor.transpose().dot(x.transpose()).transpose()*-2).ravel())
+
+    def _solve_with_bfgs(self, v_mes):
+        """Perform the correction of measurement vectors using a L-BFGS-B algorithm.
+
+        Several measurement vectors are corrected with a single L-BFGS-B run.
+        Each measurement vector is scaled to unity before optimization so that
+        samples of different magnitudes converge equally well (the problem is
+        linear, hence the solution is simply scaled back afterwards). A lower
+        `factr` than for a single sample is used since the convergence criterion
+        applies to the sum of the costs of all samples.
+
+        Args:
+            v_mes (array): measurement vectors (n_samples x n_isotopologues)
+
+        Returns:
+            array: corrected areas (n_samples x n_isotopologues)
+        """
+        if v_mes.shape[0] == 0:
+            return np.zeros(v_mes.shape)
+        if v_mes.shape[0] == 1:
+            length_result = v_mes.shape[1]
+            corrected_area, _, _ = fmin_l_bfgs_b(self._get_cost_function,
+                                                 np.zeros(length_result),
+                                                 fprime=None,
+                                                 approx_grad=0,
+                                                 args=(
+                                                     v_mes[0], self.compact_correction_matrix),
+                                                 factr=1000,
+                                                 pgtol=1e-10,
+                                                 bounds=[(0., float('inf'))] * length_result)
+            return corrected_area[np.newaxis, :]
+        scale = np.abs(v_mes).sum(axis=1)
+        scale[scale == 0] = 1.
+        v_scaled = v_mes / scale[:, np.newaxis]
+        corrected_area, _, _ = fmin_l_bfgs_b(self._get_cost_function_many,
+                                             np.zeros(v_mes.size),
+                                             fprime=None,
+                                             approx_grad=0,
+                                             args=(
+                                                 v_scaled, self.compact_correction_matrix),
+                                             factr=10,
+                                             pgtol=1e-10,
+                                             bounds=[(0., float('inf'))] * v_mes.size)
+        return corrected_area.reshape(v_mes.shape) * scale[:, np.newaxis]
+
+    def _solve_with_nnls(self, v_mes):
+        """Perform the correction of measurement vectors using an exact active-set NNLS algorithm.
+
+        Factorizations of the correction matrix (restricted to the passive sets of
+        the samples) are cached, and reused for all subsequent samples.
+
+        Args:
+            v_mes (array): measurement vectors (n_samples x n_isotopologues)
+
+        Returns:
+            array: corrected areas (n_samples x n_isotopologues)
+        """
+        if self._nnls is None or self._nnls.matrix is not self.compact_correction_matrix:
+            self._nnls = ActiveSetNNLS(self.compact_correction_matrix)
+        return self._nnls.solve_many(v_mes)
+
+    def _summarize_many(self, v_mes, corrected_area):
+        """Compute normalized results for a batch of corrected samples.
+
+        Same as the normalization performed in :py:meth:`~_summarize`,
+        but vectorized over samples.
+
+        Args:
+            v_mes (array): measurement vectors (n_samples x n_isotopologues)
+            corrected_area (array): corrected areas (n_samples x n_isotopologues)
+
+        Returns:
+            tuple: corrected_area, isotopologue_fraction, residuum, enrichment
+        """
+        resi = v_mes - self.compact_correction_matrix.dot(corrected_area.transpose()).transpose()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sum_p = corrected_area.sum(axis=1)
+            isotopologue_fraction = corrected_area / sum_p[:, np.newaxis]
+            isotopologue_fraction[sum_p == 0, :] = np.nan
+            enrichment = np.dot(isotopologue_fraction, np.arange(v_mes.shape[1])) / \
+                self.formula[self._tracer_el]
+            sum_m = v_mes.sum(axis=1)
+            residuum = resi / sum_m[:, np.newaxis]
+            residuum[sum_m == 0, :] = np.nan
         return corrected_area, isotopologue_fraction, residuum, enrichment
 
+    @staticmethod
+    def _trim_tail(distribution, threshold_p):
+        """Remove the trailing peaks of a distribution below the probability threshold.
+
+        Args:
+            distribution (array): mass distribution vector
+            threshold_p (float): probability threshold (no trimming if None)
+
+        Returns:
+            array: trimmed distribution (at least one peak is kept)
+        """
+        if threshold_p is None:
+            return distribution
+        above = np.flatnonzero(distribution > threshold_p)
+        last = above[-1] + 1 if above.size else 1
+        return distribution[:last]
+
+    @classmethod
+    def _get_distribution_power(cls, abundances, n_atoms, threshold_p=None):
+        """Return the mass distribution vector of n atoms of an element.
+
+        The distribution is the n-fold convolution of the isotopic abundances of the
+        element, which is computed by repeated squaring, i.e. with log2(n) convolutions
+        instead of n.
+
+        Args:
+            abundances (list): isotopic abundances of the element
+            n_atoms (int): number of atoms
+            threshold_p (float): if not None, trailing peaks below this probability
+                are removed after each convolution
+
+        Returns:
+            array: mass distribution vector
+        """
+        result = np.ones(1)
+        power = np.array(abundances, dtype=float)
+        while n_atoms:
+            if n_atoms & 1:
+                result = cls._trim_tail(np.convolve(result, power), threshold_p)
+            n_atoms >>= 1
+            if n_atoms:
+                power = cls._trim_tail(np.convolve(power, power), threshold_p)
+        return result
+
     def get_mass_distribution_vector(self):
         """Get low resolution mass distribution vector (at natural abundance) for non-tracers elements.
 
@@ -257,49 +761,99 @@ class LowResMetaboliteCorrector(LabelledChemical, InterfaceMSCorrector):
 
         Calculation is based on convolution of isotopic vectors of individual elements (IsoCor,
         Millard et al., 2012), which is much faster than the combinatorial approach implemented for
-        simulation at high resolution.
+        simulation at high resolution. The distribution of each element is computed by repeated
+        squaring (see :py:meth:`~_get_distribution_power`), and trailing peaks below
+        :attr:`~threshold_p` (if set) are removed.
 
         Returns:
             list: mass distribution vector
         """
         result = [1.]  # mass are normalized to 1; also default value if no correction_formula
         for el, n in self.correction_formula.items():
-            for _ in range(n):
-                result = np.convolve(
-                    result, self.data_isotopes[el]["abundance"])
+            result = np.convolve(result, self._get_distribution_power(self.data_isotopes.abundances(el),
+                                                                      n, self.threshold_p))
+            result = self._trim_tail(result, self.threshold_p)
+        self.discarded_p = 0.
+        self._update_discarded_p(result)
         logger.debug("Done computing mass distribution vector for non-tracers "
                      "elements of %s (convolution method): %s", self.label, result)
         return list(result)
 
+    def _set_cached_matrix(self, entry):
+        """Use a correction matrix taken from the caches, and the probability
+        discarded during its computation."""
+        self._correction_matrix = entry.matrix
+        self.discarded_p = entry.discarded_p
+
+    def _update_discarded_p(self, abundances):
+        """Update :attr:`~discarded_p` after the computation of a distribution or isotopic cluster.
+
+        The probability discarded is estimated as 1 minus the total abundance of
+        the species which were kept (isotopic abundances are normalized to one).
+        """
+        if self._is_pruned():
+            self.discarded_p = max(self.discarded_p, 1. - math.fsum(abundances), 0.)
+
+    def _is_pruned(self):
+        """Return True if isotopic species may be neglected (see :attr:`~discarded_p`)."""
+        return self.threshold_p is not None
+
+    @staticmethod
+    def _get_truncated_powers(abundances, n_max, length):
+        """Return the mass distribution vectors of 0 to n_max atoms, truncated to their first peaks.
+
+        Each distribution is computed from the previous one, by convolution with
+        the abundances of a single atom.
+
+        Args:
+            abundances (list): isotopic abundances (or purity) of the element
+            n_max (int): maximal number of atoms
+            length (int): number of peaks to keep
+
+        Returns:
+            list: mass distribution vectors of 0, 1, ..., n_max atoms
+        """
+        powers = [np.ones(1)]
+        for _ in range(n_max):
+            powers.append(np.convolve(powers[-1], abundances)[:length])
+        return powers
+
     def _correctionmatrix_convolution(self):
         """Return the correction matrix build with the convolution algorithm.
 
-        Each column is constructed by iterative convolution of the correction vector.
+        Column i is the convolution of the correction vector with the distributions of
+        the tracer purity for i atoms, and of the natural abundance of the tracer for
+        the other atoms. These distributions are computed incrementally for all numbers
+        of atoms, and truncated to the peaks which contribute to the matrix. All the
+        columns are then computed with a single matrix product.
 
         Returns:
             array: correction_matrix
         """
         correction_vector = self.get_mass_distribution_vector()
-        n_isotopologues = self.formula[self._tracer_el] + 1
-        # create correction matrix
-        correction_matrix = np.zeros((n_isotopologues, n_isotopologues))
+        n_tracers = self.formula[self._tracer_el]
+        n_isotopologues = n_tracers + 1
         # Peaks to keep after convolution
-        mask = [n * self._idx_tracer for n in range(n_isotopologues)]
-        # For each atom with the same element as the tracer
+        mask = np.arange(n_isotopologues) * self._idx_tracer
+        length = mask[-1] + 1
+        # Correction of tracer purity and natural abundance of tracer element (if relevant)
+        purity_powers = self._get_truncated_powers(self.tracer_purity, n_tracers, length)
+        if self.correct_NA_tracer:
+            na_powers = self._get_truncated_powers(self.data_isotopes.abundances(self._tracer_el),
+                                                   n_tracers, length)
+        else:
+            na_powers = [np.ones(1)] * n_isotopologues
+        tracer_distributions = np.zeros((length, n_isotopologues))
         for i in range(n_isotopologues):
-            column = correction_vector
-            # Correction of tracer purity
-            for _ in range(i):
-                column = np.convolve(column, self.tracer_purity)
-            # Correct natural abundance of tracer element (if relevant)
-            if self.correct_NA_tracer:
-                for _ in range(n_isotopologues-i-1):
-                    column = np.convolve(
-                        column, self.data_isotopes[self._tracer_el]["abundance"])
-            if len(column) < max(mask)+1:
-                column += [0.]*(max(mask)-len(column)+1)
-            column = [column[j] for j in mask]
-            correction_matrix[:, i] = column
+            distribution = np.convolve(purity_powers[i], na_powers[n_tracers - i])[:length]
+            tracer_distributions[:len(distribution), i] = distribution
+        # shifted_vector[j, k] is the peak of the correction vector which is shifted to
+        # the j-th kept peak by the peak k of the tracer distributions
+        padded_vector = np.zeros(length)
+        padded_vector[:min(length, len(correction_vector))] = correction_vector[:length]
+        shift = mask[:, np.newaxis] - np.arange(length)[np.newaxis, :]
+        shifted_vector = np.where(shift >= 0, padded_vector[np.maximum(shift, 0)], 0.)
+        correction_matrix = np.dot(shifted_vector, tracer_distributions)
         logger.debug("Done computing correction matrix (convolution) for %s: %s",
                      self.label, correction_matrix.tolist())
         return correction_matrix
@@ -314,9 +868,29 @@ class LowResMetaboliteCorrector(LabelledChemical, InterfaceMSCorrector):
             array: the correction matrix
         """
         logger.debug("Computing correction matrix for %s...", self.label)
+        self.discarded_p = 0.
         return self._correctionmatrix_convolution()
 
 
+class ConstantResolutionFormula(object):
+    """A (picklable) resolution formula which returns the same correction limit for all metabolites.
+
+    Args:
+        limit (float): correction limit (in Da) per unit of charge
+    """
+
+    __slots__ = ("limit",)
+
+    def __init__(self, limit):
+        self.limit = float(limit)
+
+    def __call__(self, mw, res, at_mz):
+        return self.limit
+
+    def __reduce__(self):
+        return (self.__class__, (self.limit,))
+
+
 class HighResMetaboliteCorrector(LowResMetaboliteCorrector):
     """Metabolite *corrector* for high-resolution mass-spectrometry data.
 
@@ -358,7 +932,54 @@ class HighResMetaboliteCorrector(LowResMetaboliteCorrector):
             Use the same format as in :attr:`~RES_FORMULAS`.
             :attr:`~resolution_formula` has precedence over :attr:`~resolution_formula_code`.
         charge (int): charge state of the metabolite (e.g. "-2").
+        solver (str): code of the solver used to correct measurements among the
+            presets: "bfgs" (L-BFGS-B optimization, default) and "nnls" (exact
+            active-set algorithm).
+        fast_path (bool): try the unconstrained least-squares solution first and only
+            use the solver for samples with a negative component (default: True).
+        mass_engine (str): code of the engine used to compute masses of isotopic clusters
+            (see :attr:`~MASS_ENGINES`):
+
+            * "fixed" (default): masses are handled as arrays of integers, in units of
+              1e-12 Da (:attr:`~MASS_SCALE`). Peaks are merged exactly as with
+              the "decimal" engine when isotopic masses have at most 12 decimals (as in
+              the default isotopic data); otherwise, each isotopic mass is rounded to the
+              nearest 1e-12 Da. Abundances only differ from the "decimal" engine
+              by floating-point summation errors (relative difference below 1e-12).
+              Masses must be below 9e6 Da.
+            * "decimal": reference implementation, where masses are
+              :py:class:`~decimal.Decimal` objects (much slower).
+        threshold_p (float): probability threshold under which isotopic species are
+            neglected (None: keep all species). Species are removed from the blocks of
+            each element and after each combination of blocks, which bounds the size
+            of isotopic clusters of large molecules. Default is "auto": None if the
+            molecular weight is lower than 500 Da, 1e-10 otherwise.
+        max_heavy_isotopes (int): maximal number of atoms of minor isotopes (i.e. other
+            than the most abundant isotope) in the isotopic species of each element
+            (default: None, no limit). Requires the "fixed" mass engine.
+        max_cluster_size (int): maximal number of peaks of isotopic clusters. Only the
+            most abundant peaks are kept after each combination of blocks (default:
+            None, no limit). Requires the "fixed" mass engine.
+
+    Large molecules:
+        The number of isotopic species grows very quickly with the number of atoms.
+        For large molecules (e.g. lipids, glycans or peptides with 50-200 carbons),
+        isotopic clusters are bounded by :attr:`~threshold_p` (1e-10 by default above
+        500 Da), which can be complemented or replaced by a budget of minor isotopes
+        (:attr:`~max_heavy_isotopes`, e.g. 20) and a cap on the size of the clusters
+        (:attr:`~max_cluster_size`, e.g. 10000, memory grows linearly with this cap).
+        The probability of the species neglected is reported in :attr:`~discarded_p`.
+        Target: the correction matrix of C200H400N50O80S5 is built in less than 5
+        seconds with less than 200 MB of memory for 13C, 15N, 2H, 34S and 18O tracers,
+        either with the default settings or with these limits and no threshold (see
+        the benchmark in test_large_molecules.py).
     """
+    # Registered engines used to compute masses of isotopic clusters
+    MASS_ENGINES = ("fixed", "decimal")
+    # Masses are represented as integers in units of 10**-MASS_DECIMALS Da by the "fixed" engine
+    MASS_DECIMALS = 12
+    MASS_SCALE = 10**MASS_DECIMALS
+
     # Registered resolution formulas to compute local resolution
     # parameters: molecular weight (mw), resolution (res) at mass-to-charge ratio (at_mz)
     RES_FORMULAS = {
@@ -368,8 +989,24 @@ class HighResMetaboliteCorrector(LowResMetaboliteCorrector):
         "datafile": lambda mw, res, at_mz: 1.66*mw/res
     }
 
-    def __init__(self, formula, tracer, resolution, mz_of_resolution, resolution_formula_code, charge, **kwargs):
-        LowResMetaboliteCorrector.__init__(self, formula, tracer, charge=charge, **kwargs)
+    __slots__ = ("_mass_engine", "_max_heavy_isotopes", "_max_cluster_size", "_resolution",
+                 "_mz_of_resolution", "_resolution_formula_code", "_resolution_formula",
+                 "_correction_limit")
+
+    def __init__(self, formula, tracer, resolution, mz_of_resolution, resolution_formula_code, charge,
+                 mass_engine="fixed", threshold_p="auto", max_heavy_isotopes=None, max_cluster_size=None,
+                 resolution_formula=None, **kwargs):
+        LowResMetaboliteCorrector.__init__(self, formula, tracer, charge=charge,
+                                           threshold_p=None if threshold_p == "auto" else threshold_p,
+                                           **kwargs)
+        if mass_engine not in self.MASS_ENGINES:
+            raise NotImplementedError("No mass engine registered for code '{}'.".format(mass_engine))
+        self._mass_engine = mass_engine
+        self._max_heavy_isotopes = self._check_limit("max_heavy_isotopes", max_heavy_isotopes, 0)
+        self._max_cluster_size = self._check_limit("max_cluster_size", max_cluster_size, 1)
+        if mass_engine != "fixed" and (max_heavy_isotopes is not None or max_cluster_size is not None):
+            raise ValueError("Parameters 'max_heavy_isotopes' and 'max_cluster_size' require the"
+                             " 'fixed' mass engine.")
         # Some checks on the inputs
         try:
             resolution = float(resolution)
@@ -383,16 +1020,21 @@ class HighResMetaboliteCorrector(LowResMetaboliteCorrector):
         if mz_of_resolution <= 0.:
             raise ValueError(
                 "'mz_of_resolution' parameter should be >0 ({})".format(mz_of_resolution))
+        self._resolution = resolution
+        self._mz_of_resolution = mz_of_resolution
+        self._resolution_formula_code = resolution_formula_code
+        self._resolution_formula = resolution_formula
         try:
-            resolution_formula = kwargs.get("resolution_formula",
-                                            self.RES_FORMULAS[resolution_formula_code])
+            if resolution_formula is None:
+                resolution_formula = self.RES_FORMULAS[resolution_formula_code]
         except KeyError:
             raise NotImplementedError("No resolution formula registered for code '{}'. "
                                       "Please provide the formula as resolution_formula"
                                       "parameter.".format(resolution_formula_code))
         # Check correction limit
         self._correction_limit = resolution_formula(float(self.molecular_weight)/self.charge, resolution, mz_of_resolution) * self.charge
-        self.threshold_p = None if self.molecular_weight < 500 else 1e-10
+        if threshold_p == "auto":
+            self.threshold_p = None if self.molecular_weight < 500 else 1e-10
         precision_machine = 10**3 * np.finfo(float).eps
         if self.correction_limit >= 0.5:
             raise self.ImproperUsageError("The correction limit is expected to be sufficent"
@@ -416,6 +1058,76 @@ class HighResMetaboliteCorrector(LowResMetaboliteCorrector):
         """
         return self._correction_limit
 
+    @staticmethod
+    def _check_limit(name, value, minimum):
+        """Return a limit on the size of isotopic clusters as an int (or None), or raise ValueError."""
+        if value is None:
+            return None
+        try:
+            limit = int(value)
+        except (TypeError, ValueError):
+            raise ValueError("Parameter '{}' should be an integer ({}).".format(name, value))
+        if limit != value or limit < minimum:
+            raise ValueError("Parameter '{}' should be an integer >={} ({}).".format(name, minimum, value))
+        return limit
+
+    @property
+    def max_heavy_isotopes(self):
+        """int: maximal number of atoms of minor isotopes in the species of each element (None: no limit)."""
+        return self._max_heavy_isotopes
+
+    @property
+    def max_cluster_size(self):
+        """int: maximal number of peaks of isotopic clusters (None: no limit)."""
+        return self._max_cluster_size
+
+    def _is_pruned(self):
+        """Return True if isotopic species may be neglected (see :attr:`~discarded_p`)."""
+        return (LowResMetaboliteCorrector._is_pruned(self) or self.max_heavy_isotopes is not None
+                or self.max_cluster_size is not None)
+
+    @property
+    def mass_engine(self):
+        """str: code of the engine used to compute masses (see :attr:`~MASS_ENGINES`)."""
+        return self._mass_engine
+
+    def get_parameters(self):
+        """Return the parameters of the corrector.
+
+        A custom :attr:`~resolution_formula` is replaced by a (picklable) formula
+        returning the same correction limit.
+
+        Returns:
+            dict: keyword arguments of the constructor of the corrector
+        """
+        parameters = LowResMetaboliteCorrector.get_parameters(self)
+        parameters.update(resolution=self._resolution, mz_of_resolution=self._mz_of_resolution,
+                          resolution_formula_code=self._resolution_formula_code,
+                          mass_engine=self._mass_engine,
+                          max_heavy_isotopes=self._max_heavy_isotopes,
+                          max_cluster_size=self._max_cluster_size)
+        if self._resolution_formula is not None:
+            parameters["resolution_formula"] = ConstantResolutionFormula(
+                self._correction_limit / self.charge)
+        return parameters
+
+    def _fingerprint(self):
+        """Returns a canonical fingerprint of all the parameters the correction matrix depends on.
+
+        Returns:
+            tuple: same as :py:class:`~LowResMetaboliteCorrector`, plus resolution
+            parameters, charge, correction limit, mass engine and limits on the size
+            of isotopic clusters
+        """
+        return LowResMetaboliteCorrector._fingerprint(self) + (self._resolution,
+                                                               self._mz_of_resolution,
+                                                               self._resolution_formula_code,
+                                                               self.charge,
+                                                               self.correction_limit,
+                                                               self.mass_engine,
+                                                               self.max_heavy_isotopes,
+                                                               self.max_cluster_size)
+
     # @staticmethod
     # def _count_isoblocks(n_isotopes, n_atoms):
     #     return int(math.factorial(n_isotopes+n_atoms-1) / math.factorial(n_atoms) / math.factorial(n_isotopes-1))
@@ -485,33 +1197,191 @@ class HighResMetaboliteCorrector(LowResMetaboliteCorrector):
             assert all([x[1] >= 0 for x in data[element]]
                        ), "Unexpected negative probability."
             if self.threshold_p is not None:
-                for peak in data[element]:
-                    if peak[1] <= self.threshold_p:  # abundance
-                        del peak
+                data[element] = [peak for peak in data[element] if peak[1] > self.threshold_p]
         return data
 
     def _combine_blocks(self, groups):
-        """Combine blocks of isotopes together and compute the isotopic cluster."""
+        """Combine blocks of isotopes together and compute the isotopic cluster.
+
+        Blocks are combined two by two. If :attr:`~threshold_p` is set, peaks below
+        this threshold are removed from each block and after each combination.
+        """
         def helper(X, Y):
             for x, y in it.product(X, Y):
                 yield x[0] + y[0], x[1] * y[1]
-        # generator over the data, by element
-        g = (groups[element] for element in groups)
-        iso_clust = dict()  # {mass: proba, ...}
-        for mass, proba in functools.reduce(helper, g):
-            if mass not in iso_clust:
-                iso_clust[mass] = proba
+
+        def merge(peaks):
+            iso_clust = dict()  # {mass: proba, ...}
+            for mass, proba in peaks:
+                if mass not in iso_clust:
+                    iso_clust[mass] = proba
+                else:
+                    iso_clust[mass] += proba
+            # Trim out the peaks below probability
+            if self.threshold_p is not None:
+                iso_clust = {k: v for k, v in iso_clust.items() if v > self.threshold_p}
+            return iso_clust
+        iso_clust = None
+        for element in groups:
+            block = merge(groups[element])
+            if iso_clust is None:
+                iso_clust = block
             else:
-                iso_clust[mass] += proba
+                iso_clust = merge(helper(iso_clust.items(), block.items()))
+        self._update_discarded_p(iso_clust.values())
+        return iso_clust
+
+    @classmethod
+    def _to_fixed(cls, mass):
+        """Return a mass (in Da) as an integer number of 10**-MASS_DECIMALS Da ("fixed" engine)."""
+        return int((D(str(mass)) * cls.MASS_SCALE).to_integral_value())
+
+    @classmethod
+    def _from_fixed(cls, mass):
+        """Return a mass of the "fixed" engine as a Decimal (in Da)."""
+        return D(int(mass)).scaleb(-cls.MASS_DECIMALS)
+
+    def _merge_peaks(self, masses, abundances):
+        """Sum the abundances of peaks with the same mass and remove peaks below :attr:`~threshold_p`,
+        or beyond :attr:`~max_cluster_size` ("fixed" engine).
+
+        Returns:
+            tuple:
+                - (array) sorted unique masses
+                - (array) their abundances
+        """
+        unique_masses, idx = np.unique(masses, return_inverse=True)
+        abundances = np.bincount(idx.ravel(), weights=abundances, minlength=len(unique_masses))
         # Trim out the peaks below probability
         if self.threshold_p is not None:
-            to_del = []
-            for k in iso_clust:
-                if iso_clust[k] <= self.threshold_p:
-                    to_del.append(k)
-            for k in to_del:
-                del iso_clust[k]
-        return iso_clust
+            keep = abundances > self.threshold_p
+            unique_masses, abundances = unique_masses[keep], abundances[keep]
+        # Keep only the most abundant peaks
+        if self.max_cluster_size is not None and len(abundances) > self.max_cluster_size:
+            keep = np.sort(np.argpartition(-abundances, self.max_cluster_size - 1)[:self.max_cluster_size])
+            unique_masses, abundances = unique_masses[keep], abundances[keep]
+        return unique_masses, abundances
+
+    @staticmethod
+    def _get_compositions(n_atoms, n_isotopes):
+        """Return all the isotopic compositions of a block of n_atoms atoms.
+
+        Compositions are enumerated directly as arrays of isotope counts (one
+        composition per row), instead of combinations of isotopes.
+
+        Args:
+            n_atoms (int): number of atoms
+            n_isotopes (int): number of isotopes of the element
+
+        Returns:
+            array: number of atoms of each isotope (one column per isotope)
+        """
+        counts = np.zeros((1, 0), dtype=np.int64)
+        remaining = np.array([n_atoms], dtype=np.int64)
+        for _ in range(n_isotopes - 1):
+            # each composition is extended with 0 to 'remaining' atoms of the next isotope
+            n_choices = remaining + 1
+            parent = np.repeat(np.arange(len(remaining)), n_choices)
+            start = np.repeat(np.cumsum(n_choices) - n_choices, n_choices)
+            n_next = np.arange(len(parent)) - start
+            counts = np.column_stack((counts[parent], n_next))
+            remaining = remaining[parent] - n_next
+        return np.column_stack((counts, remaining))
+
+    @staticmethod
+    def _get_multinomial_probabilities(compositions, abundances):
+        """Return the probability of each isotopic composition of a block.
+
+        Probabilities are computed in log space to avoid the overflow of factorials.
+
+        Args:
+            compositions (array): number of atoms of each isotope (one composition per row)
+            abundances (list): abundances of the isotopes
+
+        Returns:
+            array: probability of each composition
+        """
+        abundances = np.asarray(abundances, dtype=float)
+        n_atoms = compositions.sum(axis=1)
+        log_p = gammaln(n_atoms + 1) - gammaln(compositions + 1).sum(axis=1) \
+            + xlogy(compositions, abundances).sum(axis=1)
+        return np.exp(log_p)
+
+    def _get_array_block(self, masses, abundances, n_atoms):
+        """Return all combinations of isotopes for n_atoms of an element ("fixed" engine).
+
+        Args:
+            masses (list): masses of the isotopes of the element
+            abundances (list): abundances of the isotopes of the element
+            n_atoms (int): number of atoms
+
+        Returns:
+            tuple:
+                - (array) masses of the block (in 10**-MASS_DECIMALS Da)
+                - (array) their abundances
+        """
+        fixed_masses = [self._to_fixed(mass) for mass in masses]
+        n_isotopes = len(fixed_masses)
+        max_minor = self.max_heavy_isotopes
+        if n_isotopes == 1:
+            block = self._get_block_1(fixed_masses[0], n_atoms)
+        elif n_isotopes == 2:
+            n_heavy = np.arange(n_atoms + 1, dtype=np.int64)
+            block_masses = fixed_masses[0] * (n_atoms - n_heavy) + fixed_masses[1] * n_heavy
+            block_abundances = self._get_distribution_power(abundances, n_atoms)
+            if max_minor is not None:
+                n_minor = n_heavy if abundances[0] >= abundances[1] else n_atoms - n_heavy
+                keep = n_minor <= max_minor
+                block_masses, block_abundances = block_masses[keep], block_abundances[keep]
+            return block_masses, block_abundances
+        else:
+            if max_minor is None or max_minor >= n_atoms:
+                compositions = self._get_compositions(n_atoms, n_isotopes)
+            else:
+                # enumerate the minor isotopes only, the other atoms are the most abundant isotope
+                major = int(np.argmax(abundances))
+                minor = self._get_compositions(max_minor, n_isotopes)[:, :-1]
+                compositions = np.insert(minor, major, n_atoms - minor.sum(axis=1), axis=1)
+            return np.dot(compositions, fixed_masses), self._get_multinomial_probabilities(compositions, abundances)
+        return np.array([x[0] for x in block], dtype=np.int64), np.array([x[1] for x in block], dtype=float)
+
+    def _combine_array_blocks(self, groups):
+        """Combine blocks of isotopes together and compute the isotopic cluster ("fixed" engine).
+
+        Returns:
+            tuple:
+                - (array) sorted masses of the isotopic cluster (in 10**-MASS_DECIMALS Da)
+                - (array) their abundances
+        """
+        masses, abundances = None, None
+        for block_masses, block_abundances in groups.values():
+            block = self._merge_peaks(block_masses, block_abundances)
+            if masses is None:
+                masses, abundances = block
+            else:
+                masses, abundances = self._convolve_array_blocks((masses, abundances), block)
+        self._update_discarded_p(abundances)
+        return masses, abundances
+
+    def _convolve_array_blocks(self, block_1, block_2):
+        """Combine two blocks of isotopes ("fixed" engine).
+
+        Returns:
+            tuple:
+                - (array) sorted masses of the combined block (in 10**-MASS_DECIMALS Da)
+                - (array) their abundances
+        """
+        return self._merge_peaks(np.add.outer(block_1[0], block_2[0]).ravel(),
+                                 np.multiply.outer(block_1[1], block_2[1]).ravel())
+
+    def _get_isotopic_cluster_arrays(self):
+        """Return the isotopic cluster of the compound (for non-tracer elements) as arrays ("fixed" engine)."""
+        groups = {}
+        for element, n_atoms in self.correction_formula.items():
+            groups[element] = self._get_array_block(self.data_isotopes[element]["mass"],
+                                                    self.data_isotopes[element]["abundance"],
+                                                    n_atoms)
+        return self._combine_array_blocks(groups)
 
     def get_isotopic_cluster(self):
         """Return the full isotopic cluster of the compound (for non-tracer elements).
@@ -526,11 +1396,15 @@ class HighResMetaboliteCorrector(LowResMetaboliteCorrector):
         """
         assert self.threshold_p is None or (0 <= self.threshold_p <= 1), \
             "Unexpected probability for 'threshold_p': {}".format(self.threshold_p)
-        if self.correction_formula:
+        self.discarded_p = 0.
+        if not self.correction_formula:
+            return None  # no atom, no isotopic cluster
+        if self.mass_engine == "decimal":
             groups = self._get_isotopic_blocks()
             iso_clust = self._combine_blocks(groups)
         else:
-            iso_clust = None  # no atom, no isotopic cluster
+            masses, abundances = self._get_isotopic_cluster_arrays()
+            iso_clust = {self._from_fixed(m): a for m, a in zip(masses.tolist(), abundances.tolist())}
         return iso_clust
 
     def get_tracershifted_peaks_between(self, mz_min, mz_max):
@@ -566,12 +1440,60 @@ class HighResMetaboliteCorrector(LowResMetaboliteCorrector):
         """
         # NB: masses are not garanteed to be in isotopic_cluster; if no peak is
         # found nearby, a 0.0 is returned for this mass.
-        pooled = []
-        for peak in sorted(masses):
-            unresolved = [a for m, a in isotopic_cluster.items() if abs(
-                m - peak) <= self.correction_limit]
-            pooled.append(sum(unresolved))
-        return pooled
+        peaks = sorted(masses)
+        if not isotopic_cluster:
+            return [0.] * len(peaks)
+        cluster_masses = sorted(isotopic_cluster)
+        abundances = np.array([isotopic_cluster[m] for m in cluster_masses], dtype=float)
+        limit = self.correction_limit
+        if isinstance(cluster_masses[0], D):
+            limit = D(limit)
+        return self._pool_sorted_peaks(np.array(cluster_masses), abundances,
+                                       np.array([peak - limit for peak in peaks]),
+                                       np.array([peak + limit for peak in peaks])).tolist()
+
+    @staticmethod
+    def _pool_sorted_peaks(masses, abundances, lower, upper):
+        """Sum the abundances of the peaks within [lower, upper] mass ranges.
+
+        Peaks within each range are found by binary search, hence the cost only
+        depends on the number of ranges and of pooled peaks.
+
+        Args:
+            masses (array): sorted masses of the isotopic cluster
+            abundances (array): abundances of the isotopic cluster
+            lower (array): lower bounds of the ranges
+            upper (array): upper bounds of the ranges
+
+        Returns:
+            array: total abundance within each range
+        """
+        start = np.searchsorted(masses, lower, side="left")
+        stop = np.searchsorted(masses, upper, side="right")
+        if not len(start):
+            return np.zeros(0)
+        # NB: each range is summed separately (rather than as a difference of cumulative
+        # sums), so that the abundance of minor peaks is not lost in round-off errors.
+        # reduceat sums abundances between successive bounds: sums of the ranges are
+        # found at even positions (except for empty ranges, where it returns a single peak)
+        bounds = np.column_stack((start, stop)).ravel()
+        sums = np.add.reduceat(np.append(abundances, 0.), bounds)[::2]
+        return np.where(stop > start, sums, 0.)
+
+    def _pool_peaks(self, masses, abundances, peaks):
+        """Sum unresolved peaks of an isotopic cluster ("fixed" engine version of :meth:`~get_peaks_around`).
+
+        Args:
+            masses (array): masses of the isotopic cluster (in 10**-MASS_DECIMALS Da)
+            abundances (array): abundances of the isotopic cluster
+            peaks (list): m/z (in Da) around which peaks will be pooled
+
+        Returns:
+            array: abundances for each input mass, after sorting the mass
+        """
+        targets = np.array([self._to_fixed(peak) for peak in sorted(peaks)], dtype=np.int64)
+        limit = math.floor(D(self.correction_limit) * self.MASS_SCALE)
+        return self._pool_sorted_peaks(masses, abundances, targets - limit, targets + limit)
 
     def get_mass_distribution_vector(self):
         """Get mass distribution vector (at natural abundancy) for non-tracers elements.
@@ -585,19 +1507,76 @@ class HighResMetaboliteCorrector(LowResMetaboliteCorrector):
         Returns:
             list: mass distribution vector
         """
-        iso_clust = self.get_isotopic_cluster()
-        if iso_clust is None:  # all atoms are either tracer or ignored
+        self.discarded_p = 0.
+        if not self.correction_formula:  # all atoms are either tracer or ignored
             return [1.]     # same behavior as LowRes.
         minimum_mass = D(0)
         for element, n_elements in self.correction_formula.items():
             minimum_mass += n_elements * self.data_isotopes[element]["mass"][0]
-        id_map = self.get_tracershifted_peaks_between(
-            minimum_mass, max(iso_clust.keys()))
-        mid = self.get_peaks_around(iso_clust, id_map)
+        if self.mass_engine == "decimal":
+            iso_clust = self.get_isotopic_cluster()
+            id_map = self.get_tracershifted_peaks_between(
+                minimum_mass, max(iso_clust.keys()))
+            mid = self.get_peaks_around(iso_clust, id_map)
+        else:
+            masses, abundances = self._get_isotopic_cluster_arrays()
+            id_map = self.get_tracershifted_peaks_between(
+                minimum_mass, self._from_fixed(masses[-1]))
+            mid = self._pool_peaks(masses, abundances, id_map)
         logger.debug("Done computing mass distribution vector for non-tracers "
                      "elements of %s (high-resolution method): %s", self.label, mid)
         return [float(x) for x in mid]
 
+    def _get_atom_block(self, masses, abundances):
+        """Return the block of a single atom of an element, with the masses of the mass engine.
+
+        Returns:
+            tuple:
+                - (array) masses of the block (:py:class:`~decimal.Decimal` objects with the
+                  "decimal" engine, in 10**-MASS_DECIMALS Da with the "fixed" engine)
+                - (array) their abundances
+        """
+        if self.mass_engine == "decimal":
+            return np.array(masses, dtype=object), np.array(abundances, dtype=float)
+        return self._get_array_block(masses, abundances, 1)
+
+    def _get_tracer_blocks(self):
+        """Return the blocks of the tracer element of each column of the correction matrix.
+
+        The block of column k combines the purity of k traced atoms and the natural
+        abundance of the n-k other atoms of the tracer element. Powers of the purity
+        and natural abundance blocks are computed incrementally, i.e. by adding one
+        atom to the previous power, and reused for all columns.
+
+        Returns:
+            list: (masses, abundances) of the tracer block of each column (see
+            :meth:`~_get_atom_block`)
+        """
+        n_tracers = self.formula[self._tracer_el]
+        data_tracer = self.data_isotopes[self._tracer_el]
+        purity_atom = self._get_atom_block(data_tracer["mass"], self.tracer_purity)
+        if self.correct_NA_tracer:
+            na_atom = self._get_atom_block(data_tracer["mass"], data_tracer["abundance"])
+        else:
+            na_atom = self._get_atom_block(data_tracer["mass"][:1], [1.])
+        # isotopes which are absent (e.g. perfect purity) do not contribute to the cluster
+        purity_atom, na_atom = [(masses[abundances > 0.], abundances[abundances > 0.])
+                                for masses, abundances in (purity_atom, na_atom)]
+        if self.mass_engine == "decimal":
+            no_atom = (np.array([D(0)], dtype=object), np.ones(1))
+        else:
+            no_atom = (np.zeros(1, dtype=np.int64), np.ones(1))
+        purity_powers = [no_atom]
+        na_powers = [no_atom]
+        for _ in range(n_tracers):
+            purity_powers.append(self._convolve_array_blocks(purity_powers[-1], purity_atom))
+            na_powers.append(self._convolve_array_blocks(na_powers[-1], na_atom))
+        tracer_blocks = []
+        for n_traced_atoms in range(n_tracers + 1):
+            tracer_blocks.append(self._convolve_array_blocks(purity_powers[n_traced_atoms],
+                                                             na_powers[n_tracers - n_traced_atoms]))
+        return tracer_blocks
+
     def _correctionmatrix_combination(self):
         """Return the correction matrix constructed from the high-resolution correction vector (isotopic cluster).
 
@@ -606,50 +1585,59 @@ class HighResMetaboliteCorrector(LowResMetaboliteCorrector):
           are already corrected in the correction_vector.
         * By default, we assume a perfect purity (see __init__).
 
+        The isotopic cluster of each column is not computed explicitly. Since the
+        pooling of unresolved peaks is linear, the abundance of a measured peak in
+        column k is the sum, over all the peaks of the tracer block of this column
+        (see :meth:`~_get_tracer_blocks`), of their abundance times the abundance of
+        the peaks of the non-tracer cluster within the correction limit of the measured
+        peak minus their mass. The pooled abundances of the non-tracer cluster are
+        computed once for each distinct mass of the tracer blocks and shared by all
+        columns.
+
+        Note that the peaks of the isotopic clusters of the columns are thus never
+        pruned (only the blocks are), hence the matrix can differ from the combination
+        of the full isotopic clusters by up to :attr:`~threshold_p` per pooled peak when
+        a threshold is set.
+
         Returns:
             array: correction_matrix
         """
         n_tracers = self.formula[self._tracer_el]
-        data_tracer = self.data_isotopes[self._tracer_el]
-        n_tracer_isotopes = len(data_tracer["mass"])
-        # Mass distribution vector without tracer
-        isoclust_notracer = self.get_isotopic_cluster()
-        if isoclust_notracer is not None:
-            correction_vector = np.array(
-                [(i, j) for i, j in isoclust_notracer.items()])
         main_peaks = self.get_tracershifted_peaks_between(self.molecular_weight,
                                                           self.molecular_weight + self.mzshift_tracer * n_tracers + D(0.5))
+        # Isotopic cluster without tracer
+        if self.mass_engine == "decimal":
+            iso_clust = self.get_isotopic_cluster()
+            if iso_clust:
+                masses = np.array(sorted(iso_clust), dtype=object)
+                abundances = np.array([iso_clust[mass] for mass in masses], dtype=float)
+            else:
+                masses, abundances = np.array([D(0)], dtype=object), np.ones(1)
+            targets = np.array(sorted(main_peaks), dtype=object)
+            limit = D(self.correction_limit)
+        else:
+            if self.correction_formula:
+                masses, abundances = self._get_isotopic_cluster_arrays()
+            else:
+                masses, abundances = np.zeros(1, dtype=np.int64), np.ones(1)
+            targets = np.array([self._to_fixed(peak) for peak in sorted(main_peaks)], dtype=np.int64)
+            limit = math.floor(D(self.correction_limit) * self.MASS_SCALE)
+        tracer_blocks = self._get_tracer_blocks()
+        # Pool the non-tracer cluster around each measured peak, shifted by each tracer mass
+        tracer_masses = np.unique(np.concatenate([block[0] for block in tracer_blocks]))
+        shifted_targets = (targets[np.newaxis, :] - tracer_masses[:, np.newaxis]).ravel()
+        pooled = self._pool_sorted_peaks(masses, abundances, shifted_targets - limit, shifted_targets + limit)
+        pooled = pooled.reshape(len(tracer_masses), len(targets))
         # Prepare the Correction matrix
         n_isotopologues = n_tracers + 1
         correction_matrix = np.zeros((n_isotopologues, n_isotopologues))
-        # For each measured peak, we compute the corresponding isotopic_cluster
-        for n_traced_atoms in range(n_isotopologues):
-            data = {}
-            if isoclust_notracer is not None:
-                data["cluster_notracer"] = correction_vector
-            # Correct the tracer purity and natural abundance
-            if n_traced_atoms:
-                data["purity_tracer"] = self._get_block_n(data_tracer["mass"],
-                                                          self.tracer_purity,
-                                                          n_atoms=n_traced_atoms,
-                                                          n_isotopes=n_tracer_isotopes)
-            if n_tracers-n_traced_atoms:
-                if self.correct_NA_tracer:
-                    data["NA_tracer"] = self._get_block_n(data_tracer["mass"],
-                                                          data_tracer["abundance"],
-                                                          n_atoms=n_tracers-n_traced_atoms,
-                                                          n_isotopes=n_tracer_isotopes)
-                else:
-                    data["NA_tracer"] = self._get_block_1(data_tracer["mass"][0],
-                                                          n_tracers-n_traced_atoms)
-            # Isotopic cluster with this combination of tracers
-            iso_clust = self._combine_blocks(data)
-            # Pool together unresolved peaks
-            column = self.get_peaks_around(iso_clust, main_peaks)
-            # Fill the corresponding column of the correction matrix
-            correction_matrix[:, n_traced_atoms] = column
-        logger.debug("Done computing correction matrix (isotopic-cluster method)"
-                     " for %s: %s", self.label, correction_matrix.tolist())
+        total_abundance = math.fsum(abundances)
+        for n_traced_atoms, (block_masses, block_abundances) in enumerate(tracer_blocks):
+            idx = np.searchsorted(tracer_masses, block_masses)
+            correction_matrix[:, n_traced_atoms] = np.dot(block_abundances, pooled[idx])
+            self._update_discarded_p([total_abundance * math.fsum(block_abundances)])
+        logger.debug("Done computing correction matrix (isotopic-cluster method, %s masses)"
+                     " for %s: %s", self.mass_engine, self.label, correction_matrix.tolist())
         return correction_matrix
 
     def compute_correction_matrix(self):
@@ -662,6 +1650,7 @@ class HighResMetaboliteCorrector(LowResMetaboliteCorrector):
             array: the correction matrix
         """
         logger.debug("Computing correction matrix for %s...", self.label)
+        self.discarded_p = 0.
         n_tracer_isotopes = len(
             self.data_isotopes[self._tracer_el]["abundance"])
         assert n_tracer_isotopes > 1, "Unexpected number of isotopes for tracer ({}).".format(
@@ -671,3 +1660,388 @@ class HighResMetaboliteCorrector(LowResMetaboliteCorrector):
         else:
             correction_matrix = self._correctionmatrix_combination()
         return correction_matrix
+
+
+class MultiTracerMetaboliteCorrector(LabelledChemical, InterfaceMSCorrector):
+    """Metabolite *corrector* for experiments with several isotopic tracers (e.g. 13C and 15N).
+
+    The isotopologues of each tracer are assumed to be resolved from each other and
+    from the isotopic species of the other elements (e.g. at ultra-high resolution).
+    The elements of the tracers are corrected for tracer purity, natural abundance of
+    the derivative and, if :attr:`~correct_NA_tracer` is set, natural abundance of the
+    tracer element of the metabolite moiety. The species which contain a minor isotope
+    of the other elements (of the metabolite and of the derivative) are resolved from
+    the measured peaks, hence the natural abundance of these elements is corrected by
+    the probability that all their atoms are of the lightest isotope (see
+    :attr:`~nontracer_abundance`).
+
+    Isotopologues are indexed by the number of atoms of each tracer, the index of the
+    last tracer varying fastest (e.g. for 13C and 15N: C0N0, C0N1, ..., C1N0, ...).
+    The correction matrix is then the Kronecker product of the correction matrices of
+    each tracer (see :attr:`~factors`), computed by a
+    :py:class:`~LowResMetaboliteCorrector` of its element. Measurements are corrected
+    with products by the factors, hence the dense correction matrix (whose size is the
+    square of the product of the numbers of isotopologues of each tracer) is never
+    needed.
+
+    Args:
+        formula (str): elemental formula of the metabolite moiety (e.g. "C3H7NO2")
+        tracers (str or list): isotopic tracers, as a list or a comma-separated
+            string (e.g. "13C,15N")
+        label (str): metabolite abbreviation (e.g. "Ala")
+        data_isotopes (dict): isotopic data with mass and abundance
+            as in :py:attr:`~LabelledChemical.DEFAULT_ISODATA`
+        derivative_formula (str): elemental formula of the derivative moiety
+        tracer_purity (dict): proportion of each isotope of each tracer element, indexed
+            by tracer code (e.g. {"13C": [0.01, 0.99]}). Tracers which are missing are
+            assumed to have a perfect purity.
+        correct_NA_tracer (bool): flag to correct tracer natural abundance or not (for
+            all tracers).
+        solver (str): code of the solver used to correct measurements among the
+            presets: "bfgs" (L-BFGS-B optimization with products by the factors, default)
+            or "nnls" (exact active-set NNLS, see :py:class:`~isocor.solvers.KroneckerNNLS`,
+            limited to molecules with at most 1024 isotopologues).
+        fast_path (bool): try the unconstrained least-squares solution first and only
+            use the solver for samples with a negative component (default: True).
+        threshold_p (float): probability threshold used for the correction matrix of
+            each tracer (default: None, keep all peaks).
+    """
+    # Registered solvers used to compute corrected areas (see LowResMetaboliteCorrector)
+    SOLVERS = {
+        "bfgs": "_solve_with_bfgs",
+        "nnls": "_solve_with_nnls"
+    }
+
+    __slots__ = ("_correction_matrix", "_dense_correction_matrix", "_tracers", "_solver",
+                 "_fast_path", "_unconstrained", "_nnls", "_tracer_correctors", "_tracer_elements",
+                 "_nontracer_abundance", "solver_stats")
+
+    def __init__(self, formula, tracers, derivative_formula=None, tracer_purity=None,
+                 correct_NA_tracer=False, solver="bfgs", fast_path=True, threshold_p=None,
+                 label=None, **kwargs):
+        self._tracers = self._split_tracers(tracers)
+        if label is None:
+            label = "|".join([formula, derivative_formula or "", ",".join(self._tracers)])
+        tracer_purity = {} if tracer_purity is None else dict(tracer_purity)
+        unknown = set(tracer_purity) - set(self._tracers)
+        if unknown:
+            raise ValueError("Tracer purity given for unknown tracer(s): {}.".format(
+                ", ".join(sorted(unknown))))
+        LabelledChemical.__init__(self, formula, self._tracers[0],
+                                  derivative_formula=derivative_formula,
+                                  tracer_purity=tracer_purity.get(self._tracers[0]),
+                                  correct_NA_tracer=correct_NA_tracer, label=label, **kwargs)
+        InterfaceMSCorrector.__init__(self)
+        if solver not in self.SOLVERS:
+            raise NotImplementedError("No solver registered for code '{}'.".format(solver))
+        self._solver = solver
+        self._fast_path = bool(fast_path)
+        self._unconstrained = None
+        self._nnls = None
+        # One corrector per tracer, for the atoms of its element only
+        self._tracer_correctors = []
+        tracer_elements = []
+        for tracer in self._tracers:
+            tracer_el, _ = self._parse_strtracer(tracer)
+            if tracer_el in tracer_elements:
+                raise ValueError("Several tracers of the same element ({}).".format(tracer_el))
+            tracer_elements.append(tracer_el)
+            if not self.formula[tracer_el]:
+                raise ValueError("The isotopic tracer ({}) must be present in the"
+                                 " metabolite {}.".format(tracer_el, self._str_formula))
+            n_derivative = self.derivative_formula[tracer_el]
+            self._tracer_correctors.append(LowResMetaboliteCorrector(
+                "{}{}".format(tracer_el, self.formula[tracer_el]), tracer,
+                label="{}|{}".format(self.label, tracer),
+                data_isotopes=self.data_isotopes,
+                derivative_formula="{}{}".format(tracer_el, n_derivative) if n_derivative else None,
+                tracer_purity=tracer_purity.get(tracer),
+                correct_NA_tracer=correct_NA_tracer,
+                threshold_p=threshold_p))
+        self._tracer_elements = tuple(tracer_elements)
+        self._nontracer_abundance = 1.
+        for el in sorted(set(self.formula) | set(self.derivative_formula)):
+            if el not in self._tracer_elements:
+                n_atoms = self.formula[el] + self.derivative_formula[el]
+                self._nontracer_abundance *= float(self.data_isotopes[el]["abundance"][0]) ** n_atoms
+        if not self._nontracer_abundance > 0:
+            raise ValueError("Null probability of the lightest isotopic species of the elements"
+                             " which are not traced in {}.".format(self.label))
+        if self._solver == "nnls" and np.prod(self.shape) > KroneckerNNLS.MAX_VARIABLES:
+            raise ValueError("The 'nnls' solver is limited to {} isotopologues with several"
+                             " tracers ({} for {}), please use the 'bfgs' solver.".format(
+                                 KroneckerNNLS.MAX_VARIABLES, int(np.prod(self.shape)), self.label))
+        # Public attribute: number of samples corrected by each path
+        # ("fast" or solver code), can be reset at runtime
+        self.solver_stats = collections.Counter()
+        logger.debug("New %s, %s: tracers=%s, solver=%s, fast_path=%s.", self.__class__.__name__,
+                     self.label, self._tracers, self._solver, self._fast_path)
+
+    @staticmethod
+    def _split_tracers(tracers):
+        """Return the list of tracer codes from a list or a comma-separated string."""
+        if isinstance(tracers, str):
+            tracers = tracers.split(",")
+        tracers = [tracer.strip() for tracer in tracers]
+        if not tracers or not all(tracers):
+            raise ValueError("Invalid tracer codes: '{}'."
+                             " Please check your inputs.".format(tracers))
+        return tracers
+
+    @property
+    def tracers(self):
+        """tuple: codes of the isotopic tracers."""
+        return tuple(self._tracers)
+
+    @property
+    def tracer_correctors(self):
+        """tuple: corrector of each tracer (for the atoms of its element only)."""
+        return tuple(self._tracer_correctors)
+
+    @property
+    def shape(self):
+        """tuple: number of isotopologues of each tracer."""
+        return tuple(self.formula[el] + 1 for el in self._tracer_elements)
+
+    @property
+    def nontracer_abundance(self):
+        """float: probability that all the atoms of the elements which are not traced (in the
+        metabolite and derivative moieties) are of their lightest isotope."""
+        return self._nontracer_abundance
+
+    @property
+    def solver(self):
+        """str: code of the solver used to correct measurements (see :attr:`~SOLVERS`)."""
+        return self._solver
+
+    @property
+    def fast_path(self):
+        """bool: try the unconstrained least-squares solution before the solver."""
+        return self._fast_path
+
+    @property
+    def threshold_p(self):
+        """float: probability threshold used for the correction matrix of each tracer."""
+        return self._tracer_correctors[0].threshold_p
+
+    @property
+    def discarded_p(self):
+        """float: maximal probability neglected in the correction matrices of the tracers."""
+        return max(corrector.discarded_p for corrector in self._tracer_correctors)
+
+    @property
+    def factors(self):
+        """list: correction matrix of each tracer (shared with :attr:`~tracer_correctors`).
+
+        The correction matrix is the Kronecker product of the factors, scaled by
+        :attr:`~nontracer_abundance`.
+        """
+        return [corrector.correction_matrix for corrector in self._tracer_correctors]
+
+    def get_parameters(self):
+        """Return the parameters of the corrector.
+
+        Returns:
+            dict: keyword arguments of the constructor of the corrector
+        """
+        parameters = self._get_chemical_parameters()
+        del parameters["tracer"]
+        tracer_purity = {tracer: corrector._tracer_purity
+                         for tracer, corrector in zip(self._tracers, self._tracer_correctors)
+                         if corrector._tracer_purity is not None}
+        parameters.update(tracers=list(self._tracers), tracer_purity=tracer_purity or None,
+                          solver=self._solver, fast_path=self._fast_path,
+                          threshold_p=self.threshold_p)
+        return parameters
+
+    def to_dict(self, include_matrix=True):
+        """Return a compact and picklable representation of the corrector.
+
+        Same as :py:meth:`~isocor.base.InterfaceMSCorrector.to_dict`, plus the
+        correction matrices of the tracers (the factors) if they have been computed,
+        with the probability discarded during their computation.
+        """
+        data = InterfaceMSCorrector.to_dict(self, include_matrix)
+        data["factors"] = [corrector.to_dict(include_matrix) for corrector in self._tracer_correctors]
+        for factor in data["factors"]:
+            del factor["parameters"]
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        """Return a new corrector from its representation (see :py:meth:`~to_dict`)."""
+        corrector = super().from_dict(data)
+        for tracer_corrector, factor in zip(corrector._tracer_correctors, data.get("factors", ())):
+            if factor["matrix"] is not None:
+                tracer_corrector._set_cached_matrix(isocor.cache.CachedMatrix(
+                    isocor.solvers.matrix_from_buffer(factor["matrix"]), factor["discarded_p"]))
+        return corrector
+
+    def _fingerprint(self):
+        """Returns a canonical fingerprint of all the parameters the correction matrix depends on.
+
+        Returns:
+            tuple: fingerprints of the correctors of each tracer, formulas and isotopic
+            data of all elements
+        """
+        return (self.__class__.__name__,) + tuple(corrector._fingerprint()
+                                                 for corrector in self._tracer_correctors) + (
+            self.formula, self.derivative_formula,
+            self._fingerprint_isotopes(set(self.formula) | set(self.derivative_formula)))
+
+    def compute_correction_matrix(self):
+        """Returns the dense correction matrix, i.e. the Kronecker product of :attr:`~factors`
+        (scaled by :attr:`~nontracer_abundance`).
+
+        The dense matrix is only computed for inspection, measurements are corrected
+        using :attr:`~factors`.
+
+        Returns:
+            array: the correction matrix
+        """
+        logger.debug("Computing correction matrix for %s...", self.label)
+        return functools.reduce(np.kron, self.factors) * self._nontracer_abundance
+
+    def correct(self, measurement, return_path=False):
+        """Return corrected measurement vector.
+
+        Args:
+            measurement (array): measured areas, as a vector or as an array of
+                shape :attr:`~shape`
+            return_path (bool): also return the path used to correct the sample
+
+        Returns:
+            tuple:
+                - corrected_area (array): Corrected area for each isotopologue.
+                - isotopologue_fraction (array): The abundance of each tracer
+                  isotopologue (corrected area normalized to 1).
+                - residuum (array)
+                - mean enrichment (array): mean enrichment of each tracer
+                - path (str): only if `return_path` is True (see
+                  :py:meth:`LowResMetaboliteCorrector.correct`)
+        """
+        results = self.correct_many(np.ravel(measurement)[np.newaxis, :], return_paths=return_path)
+        return tuple(result[0] for result in results)
+
+    def correct_many(self, measurements, return_paths=False):
+        """Return corrected measurement vectors for a batch of samples.
+
+        Args:
+            measurements (array): measured areas, one row per sample (n_samples x
+                n_isotopologues, or n_samples x :attr:`~shape`)
+            return_paths (bool): also return the path used to correct each sample
+
+        Returns:
+            tuple:
+                - corrected_area (array): Corrected area for each sample and isotopologue.
+                - isotopologue_fraction (array): The abundance of each tracer
+                  isotopologue for each sample (corrected area normalized to 1).
+                - residuum (array): residuum of each sample (normalized to 1)
+                - mean enrichment (array): mean enrichment of each sample (row) and
+                  tracer (column)
+                - paths (array): only if `return_paths` is True
+        """
+        v_mes = np.array(measurements, dtype=float)
+        n_isotopologues = int(np.prod(self.shape))
+        if v_mes.ndim < 2 or int(np.prod(v_mes.shape[1:])) != n_isotopologues:
+            raise ValueError("Measurements should be an array of shape (n_samples, {}) or"
+                             " (n_samples,) + {}, got an array of shape {}.".format(
+                                 n_isotopologues, self.shape, v_mes.shape))
+        v_mes = v_mes.reshape(v_mes.shape[0], n_isotopologues)
+        logger.debug("New correction of %s samples for %s.", v_mes.shape[0], self.label)
+        factors = self.factors
+        paths = np.full(v_mes.shape[0], self.solver, dtype=object)
+        if self.fast_path:
+            if self._unconstrained is None or \
+                    any(a is not b for a, b in zip(self._unconstrained.factors, factors)):
+                self._unconstrained = KroneckerLeastSquares(factors)
+            corrected_area, is_fast = self._unconstrained.solve_many(v_mes)
+            paths[is_fast] = "fast"
+            if not is_fast.all():
+                corrected_area[~is_fast] = getattr(self, self.SOLVERS[self.solver])(v_mes[~is_fast])
+        else:
+            corrected_area = getattr(self, self.SOLVERS[self.solver])(v_mes)
+        corrected_area /= self._nontracer_abundance
+        with _solver_stats_lock:
+            self.solver_stats.update(paths)
+        results = self._summarize_many(v_mes, corrected_area)
+        if return_paths:
+            return results + (paths,)
+        return results
+
+    @staticmethod
+    def _get_cost_function_many(mids, v_mes, factors):
+        """Cost function used for the optimization of a batch of samples.
+
+        Same as :py:meth:`LowResMetaboliteCorrector._get_cost_function_many`, with
+        products by the factors of the correction matrix.
+        """
+        x = v_mes - kronecker_dot(factors, mids.reshape(v_mes.shape))
+        return (np.vdot(x, x), (kronecker_dot([f.transpose() for f in factors], x)*-2).ravel())
+
+    def _solve_with_bfgs(self, v_mes):
+        """Perform the correction of measurement vectors using a L-BFGS-B algorithm.
+
+        See :py:meth:`LowResMetaboliteCorrector._solve_with_bfgs`.
+
+        Args:
+            v_mes (array): measurement vectors (n_samples x n_isotopologues)
+
+        Returns:
+            array: corrected areas (n_samples x n_isotopologues)
+        """
+        if v_mes.shape[0] == 0:
+            return np.zeros(v_mes.shape)
+        scale = np.abs(v_mes).sum(axis=1)
+        scale[scale == 0] = 1.
+        v_scaled = v_mes / scale[:, np.newaxis]
+        corrected_area, _, _ = fmin_l_bfgs_b(self._get_cost_function_many,
+                                             np.zeros(v_mes.size),
+                                             fprime=None,
+                                             approx_grad=0,
+                                             args=(v_scaled, self.factors),
+                                             factr=10,
+                                             pgtol=1e-10,
+                                             bounds=[(0., float('inf'))] * v_mes.size)
+        return corrected_area.reshape(v_mes.shape) * scale[:, np.newaxis]
+
+    def _solve_with_nnls(self, v_mes):
+        """Perform the correction of measurement vectors using an exact active-set NNLS solver.
+
+        See :py:meth:`LowResMetaboliteCorrector._solve_with_nnls`. Products by the
+        correction matrix are computed with its factors, and only the restrictions of
+        its Gram matrix to the passive sets of the samples are formed.
+
+        Args:
+            v_mes (array): measurement vectors (n_samples x n_isotopologues)
+
+        Returns:
+            array: corrected areas (n_samples x n_isotopologues)
+        """
+        factors = self.factors
+        if self._nnls is None or any(a is not b for a, b in zip(self._nnls.factors, factors)):
+            self._nnls = KroneckerNNLS(factors)
+        return self._nnls.solve_many(v_mes)
+
+    def _summarize_many(self, v_mes, corrected_area):
+        """Compute normalized results for a batch of corrected samples.
+
+        See :py:meth:`LowResMetaboliteCorrector._summarize_many`. The mean enrichment
+        of each tracer is computed from the marginal distribution of its isotopologues.
+        """
+        resi = v_mes - kronecker_dot(self.factors, corrected_area) * self._nontracer_abundance
+        shape = self.shape
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sum_p = corrected_area.sum(axis=1)
+            isotopologue_fraction = corrected_area / sum_p[:, np.newaxis]
+            isotopologue_fraction[sum_p == 0, :] = np.nan
+            fractions = isotopologue_fraction.reshape((-1,) + shape)
+            enrichment = np.empty((v_mes.shape[0], len(shape)))
+            for i, n_isotopologues in enumerate(shape):
+                axes = tuple(j + 1 for j in range(len(shape)) if j != i)
+                marginal = fractions.sum(axis=axes)
+                enrichment[:, i] = np.dot(marginal, np.arange(n_isotopologues)) / (n_isotopologues - 1)
+            sum_m = v_mes.sum(axis=1)
+            residuum = resi / sum_m[:, np.newaxis]
+            residuum[sum_m == 0, :] = np.nan
+        return corrected_area, isotopologue_fraction, residuum, enrichment
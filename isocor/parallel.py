@@ -0,0 +1,298 @@
+"""Parallel computations of IsoCor *correctors* on a pool of processes or threads.
+
+Correction matrices are otherwise computed lazily, at the first correction of each
+corrector. High-resolution matrices are CPU-bound and independent, hence they can
+be computed on a pool of worker processes before correcting measurements (see
+:py:func:`~precompute_correction_matrices`). Measurements can then be corrected
+on a pool of processes, each worker correcting all the samples of a corrector
+(see :py:func:`~correct_series`), or by chunks of samples (see
+:py:func:`~correct_many`).
+
+Computations are done on a :py:class:`concurrent.futures.ProcessPoolExecutor`.
+Correctors are sent to the workers in their compact representation (see
+:py:meth:`~isocor.base.InterfaceMSCorrector.to_dict`), and matrices are sent back
+as raw buffers. Tasks are submitted by decreasing estimated cost (see
+:py:func:`~estimate_cost`), so that the largest tasks do not finish last.
+
+Measurements can also be corrected on a pool of threads (e.g. when IsoCor is
+embedded in a service), since correctors are thread-safe: concurrent accesses to
+the correction matrix compute it once, and solver statistics are updated under
+a lock.
+"""
+import collections
+import logging
+import numbers
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import numpy as np
+from scipy.special import comb
+import isocor.cache
+from isocor.mscorrectors import HighResMetaboliteCorrector, MultiTracerMetaboliteCorrector
+from isocor.solvers import compress_matrix, matrix_to_buffer, matrix_from_buffer
+
+logger = logging.getLogger(__name__)
+
+#: Registered pools of workers used to correct measurements.
+#: Threads are suited to embed IsoCor in a (long-running) service, where starting
+#: processes is undesirable.
+BACKENDS = {
+    "process": ProcessPoolExecutor,
+    "thread": ThreadPoolExecutor
+}
+
+
+def estimate_cost(corrector):
+    """Return the estimated cost of the computation of the correction matrix of a corrector.
+
+    The cost is the number of isotopic species of the correction formula (i.e. the
+    number of combinations of the isotopes of each element at high resolution, and
+    the number of nominal masses at low resolution), times the number of
+    isotopologues of the tracer. It is only used to order computations.
+
+    Args:
+        corrector (LowResMetaboliteCorrector): the corrector
+
+    Returns:
+        int: estimated cost (arbitrary unit)
+    """
+    n_isotopologues = corrector.formula[corrector._tracer_el] + 1
+    data_isotopes = corrector.data_isotopes
+    if isinstance(corrector, HighResMetaboliteCorrector):
+        n_species = 1
+        for el, n in corrector.correction_formula.items():
+            n_species *= comb(n + len(data_isotopes[el]["mass"]) - 1, n, exact=True)
+        if corrector.max_cluster_size is not None:
+            n_species = min(n_species, corrector.max_cluster_size)
+    else:
+        n_species = 1 + sum(n * (len(data_isotopes[el]["mass"]) - 1)
+                            for el, n in corrector.correction_formula.items())
+    return n_isotopologues * n_species
+
+
+def _get_executor_class(backend):
+    """Return the class of the pool of workers of a backend, or raise NotImplementedError."""
+    try:
+        return BACKENDS[backend]
+    except (KeyError, TypeError):
+        raise NotImplementedError("No backend registered for code '{}'.".format(backend))
+
+
+def _check_jobs(jobs):
+    """Return the number of worker processes (None: number of processors), or raise ValueError."""
+    if jobs is None:
+        return os.cpu_count() or 1
+    if isinstance(jobs, bool) or not isinstance(jobs, numbers.Integral) or jobs < 1:
+        raise ValueError("Number of jobs should be a positive integer ({}).".format(jobs))
+    return int(jobs)
+
+
+def _iter_correctors(correctors):
+    """Yield the correctors whose matrix is computed (i.e. each tracer of multi-tracer correctors)."""
+    for corrector in correctors:
+        if isinstance(corrector, MultiTracerMetaboliteCorrector):
+            yield from corrector.tracer_correctors
+        elif corrector is not None:
+            yield corrector
+
+
+def _compute_correction_matrix(cls, data):
+    """Compute a correction matrix in a worker process.
+
+    Returns:
+        tuple: the correction matrix as a raw buffer, and the probability
+        discarded by the threshold
+    """
+    matrix, discarded_p = cls.from_dict(data)._compute_cached_matrix()
+    return matrix_to_buffer(matrix), discarded_p
+
+
+def precompute_correction_matrices(correctors, jobs=1):
+    """Compute the correction matrices of correctors, on several processes.
+
+    Matrices already computed or found in the caches (see :py:mod:`isocor.cache`) are
+    not computed again, and each matrix is computed once for all the correctors
+    which share it. Computed matrices are saved in the caches. If the computation
+    of a matrix fails, a warning is logged and the matrix will be computed (and the
+    error raised) at the first correction.
+
+    Args:
+        correctors (iterable): correctors (None are skipped)
+        jobs (int): number of worker processes (None: number of processors;
+            1: matrices are computed in the current process)
+
+    Returns:
+        int: number of correction matrices computed
+
+    Raises:
+        ValueError: wrong number of jobs
+    """
+    jobs = _check_jobs(jobs)
+    # correctors sharing the same matrix, indexed by fingerprint
+    pending = collections.OrderedDict()
+    for corrector in _iter_correctors(correctors):
+        if corrector._correction_matrix is not None:
+            continue
+        fingerprint = corrector._fingerprint()
+        entry = isocor.cache.lookup_correction_matrix(fingerprint)
+        if entry is not None:
+            corrector._set_cached_matrix(entry)
+        else:
+            pending.setdefault(fingerprint, []).append(corrector)
+    # largest matrices first
+    fingerprints = sorted(pending, key=lambda fingerprint: estimate_cost(pending[fingerprint][0]),
+                          reverse=True)
+    logger.debug("Computing %s correction matrices with %s job(s)...", len(fingerprints), jobs)
+    if jobs == 1 or len(fingerprints) < 2:
+        computed = 0
+        for fingerprint in fingerprints:
+            try:
+                for corrector in pending[fingerprint]:
+                    corrector.compact_correction_matrix
+            except Exception as err:
+                logger.warning("Cannot compute correction matrix of %s: %s", corrector.label, err)
+                continue
+            computed += 1
+        return computed
+    computed = 0
+    with ProcessPoolExecutor(max_workers=min(jobs, len(fingerprints))) as executor:
+        futures = {}
+        for fingerprint in fingerprints:
+            corrector = pending[fingerprint][0]
+            future = executor.submit(_compute_correction_matrix, type(corrector),
+                                     corrector.to_dict(include_matrix=False))
+            futures[future] = fingerprint
+        for future in as_completed(futures):
+            fingerprint = futures[future]
+            try:
+                data, discarded_p = future.result()
+            except Exception as err:
+                logger.warning("Cannot compute correction matrix of %s: %s",
+                               pending[fingerprint][0].label, err)
+                continue
+            entry = isocor.cache.register_correction_matrix(fingerprint, matrix_from_buffer(data),
+                                                            discarded_p)
+            for corrector in pending[fingerprint]:
+                corrector._set_cached_matrix(entry)
+            computed += 1
+    return computed
+
+
+def _correct_series(corrector, series):
+    """Correct the measurements of a corrector (in a worker process).
+
+    Returns:
+        tuple: results of each sample (see :py:func:`~correct_series`), and the
+        solver statistics of the corrector
+    """
+    results = []
+    for sample, measurement in series:
+        try:
+            results.append((sample, corrector.correct(measurement, return_path=True), None))
+        except Exception as err:
+            results.append((sample, None, str(err)))
+    return results, corrector.solver_stats
+
+
+def correct_series(tasks, jobs=1, backend="process"):
+    """Correct the measurements of several correctors, on several processes or threads.
+
+    Each worker corrects all the samples of a corrector (correctors with the most
+    samples are submitted first). With the "process" backend, correction matrices
+    should be computed beforehand (see :py:func:`~precompute_correction_matrices`)
+    to be sent to the workers with the correctors, and solver statistics of the
+    workers are added to the ones of the correctors. Errors do not stop the
+    correction of other samples, they are returned with the results.
+
+    Args:
+        tasks (list): pairs of a corrector and of its series of measurements, i.e.
+            a list of (sample, measurement) pairs
+        jobs (int): number of workers (None: number of processors; 1: measurements
+            are corrected in the current thread)
+        backend (str): code of the pool of workers (see :py:data:`~BACKENDS`)
+
+    Returns:
+        list: for each task (in the same order), a list of (sample, result, error)
+        tuples, with the result of :py:meth:`~isocor.mscorrectors.LowResMetaboliteCorrector.correct`
+        (with the path) and None, or None and the error message
+
+    Raises:
+        ValueError: wrong number of jobs
+        NotImplementedError: unknown backend
+    """
+    executor_class = _get_executor_class(backend)
+    jobs = _check_jobs(jobs)
+    tasks = [(corrector, list(series)) for corrector, series in tasks]
+    if jobs == 1 or len(tasks) < 2:
+        return [_correct_series(corrector, series)[0] for corrector, series in tasks]
+    results = [None] * len(tasks)
+    order = sorted(range(len(tasks)), key=lambda i: len(tasks[i][1]), reverse=True)
+    with executor_class(max_workers=min(jobs, len(tasks))) as executor:
+        futures = {executor.submit(_correct_series, *tasks[i]): i for i in order}
+        for future in as_completed(futures):
+            i = futures[future]
+            corrector, series = tasks[i]
+            try:
+                results[i], solver_stats = future.result()
+            except Exception as err:
+                # e.g. the corrector could not be sent to the worker
+                results[i] = [(sample, None, str(err)) for sample, _ in series]
+                continue
+            if solver_stats is not corrector.solver_stats:
+                corrector.solver_stats.update(solver_stats)
+    return results
+
+
+def _correct_many(corrector, measurements, return_paths):
+    """Correct a batch of samples (in a worker).
+
+    Returns:
+        tuple: results of :py:meth:`~isocor.mscorrectors.LowResMetaboliteCorrector.correct_many`,
+        and the solver statistics of the corrector
+    """
+    return corrector.correct_many(measurements, return_paths=return_paths), corrector.solver_stats
+
+
+def correct_many(corrector, measurements, jobs=1, backend="process", return_paths=False):
+    """Correct a batch of samples of a corrector, on several processes or threads.
+
+    Samples are split in as many chunks as workers, which are corrected with
+    :py:meth:`~isocor.mscorrectors.LowResMetaboliteCorrector.correct_many`. The
+    correction matrix is computed beforehand (in the current process).
+
+    With the "thread" backend, no process is started and the correctors are not
+    copied. Most of the computation (products with the correction matrix and its
+    factorization) is done by NumPy and LAPACK routines which release the GIL, hence
+    the correction of large batches scales with the number of threads (the "nnls"
+    solver and the fast path scale better than the "bfgs" solver, whose optimizer
+    is driven by Python code).
+
+    Args:
+        corrector: the corrector
+        measurements (array): measured areas, one row per sample
+        jobs (int): number of workers (None: number of processors; 1: samples are
+            corrected in the current thread)
+        backend (str): code of the pool of workers (see :py:data:`~BACKENDS`)
+        return_paths (bool): also return the path used to correct each sample
+
+    Returns:
+        tuple: same as :py:meth:`~isocor.mscorrectors.LowResMetaboliteCorrector.correct_many`
+
+    Raises:
+        ValueError: wrong input
+        NotImplementedError: unknown backend
+    """
+    executor_class = _get_executor_class(backend)
+    jobs = _check_jobs(jobs)
+    v_mes = np.array(measurements, dtype=float)
+    n_chunks = min(jobs, v_mes.shape[0]) if v_mes.ndim > 1 else 1
+    if n_chunks < 2:
+        return corrector.correct_many(v_mes, return_paths=return_paths)
+    precompute_correction_matrices([corrector])
+    chunks = np.array_split(v_mes, n_chunks)
+    with executor_class(max_workers=n_chunks) as executor:
+        results = list(executor.map(_correct_many, [corrector] * n_chunks, chunks,
+                                    [return_paths] * n_chunks))
+    for _, solver_stats in results:
+        if solver_stats is not corrector.solver_stats:
+            corrector.solver_stats.update(solver_stats)
+    return tuple(np.concatenate(arrays) for arrays in zip(*(result for result, _ in results)))
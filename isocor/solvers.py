@@ -0,0 +1,660 @@
+"""Solvers used by IsoCor *correctors* to compute corrected isotopologue distributions.
+
+Correcting a measurement vector amounts to solving a small non-negative
+least-squares (NNLS) problem:
+
+    minimize ||v_mes - correction_matrix * x||^2 subject to x >= 0
+
+The correction matrix is the same for all the samples of a given metabolite,
+hence everything that only depends on this matrix is computed once and for all
+by the objects of this module, and then reused for every sample.
+
+Correction matrices whose non-zero entries are close to the diagonal (e.g. at
+high resolution, where few peaks are pooled) are stored as a
+:py:class:`~BandedMatrix` (see :py:func:`~compress_matrix`), which solvers use
+directly.
+"""
+
+import collections
+import threading
+import numpy as np
+from scipy.linalg.lapack import dgbtrf, dgbtrs, dgbcon, dpbtrf, dpbtrs, dpotrf, dpotrs
+
+
+class BandedMatrix(object):
+    """A square matrix whose non-zero entries are stored by diagonal (LAPACK band storage).
+
+    Entry (i, j) of the matrix is stored in ``bands[upper + i - j, j]``, for
+    ``-upper <= i - j <= lower``. Only the methods used by the solvers are
+    implemented, with the same semantic as for numpy arrays.
+
+    Args:
+        bands (array): diagonals of the matrix (lower + upper + 1 rows)
+        lower (int): number of sub-diagonals
+        upper (int): number of super-diagonals
+    """
+
+    def __init__(self, bands, lower, upper):
+        self.bands = np.asarray(bands, dtype=float)
+        self.lower = int(lower)
+        self.upper = int(upper)
+        if self.bands.ndim != 2 or self.bands.shape[0] != self.lower + self.upper + 1:
+            raise ValueError("Unexpected shape of bands ({}) for {} sub-diagonals and {}"
+                             " super-diagonals.".format(self.bands.shape, self.lower, self.upper))
+
+    @classmethod
+    def from_dense(cls, matrix, rtol=0.):
+        """Return the banded representation of a square matrix.
+
+        Args:
+            matrix (array): square matrix
+            rtol (float): entries smaller than rtol times the largest entry (in absolute
+                value) are neglected, i.e. they are not stored if they are outside of
+                the band
+
+        Returns:
+            BandedMatrix: the banded matrix
+        """
+        matrix = np.asarray(matrix, dtype=float)
+        n = matrix.shape[0]
+        magnitude = np.abs(matrix)
+        rows, cols = np.nonzero(magnitude > rtol * magnitude.max()) if n else ([], [])
+        rows, cols = np.asarray(rows, dtype=int), np.asarray(cols, dtype=int)
+        offsets = rows - cols
+        lower = max(int(offsets.max()), 0) if offsets.size else 0
+        upper = max(int(-offsets.min()), 0) if offsets.size else 0
+        bands = np.zeros((lower + upper + 1, n))
+        for row in range(lower + upper + 1):
+            offset = row - upper
+            bands[row, max(-offset, 0):n - max(offset, 0)] = np.diagonal(matrix, -offset)
+        return cls(bands, lower, upper)
+
+    @property
+    def shape(self):
+        """tuple: shape of the matrix."""
+        return (self.bands.shape[1], self.bands.shape[1])
+
+    @property
+    def nbytes(self):
+        """int: memory used by the stored diagonals."""
+        return self.bands.nbytes
+
+    def _diagonals(self):
+        """Yield the offset (i - j) and the slice of columns of each stored diagonal."""
+        n = self.shape[0]
+        for row in range(self.lower + self.upper + 1):
+            offset = row - self.upper
+            yield row, offset, slice(max(-offset, 0), n - max(offset, 0))
+
+    def toarray(self):
+        """Return the dense matrix."""
+        n = self.shape[0]
+        matrix = np.zeros((n, n))
+        for row, offset, cols in self._diagonals():
+            j = np.arange(cols.start, cols.stop)
+            matrix[j + offset, j] = self.bands[row, cols]
+        return matrix
+
+    def __array__(self, dtype=None, copy=None):
+        return self.toarray() if dtype is None else self.toarray().astype(dtype)
+
+    def dot(self, x):
+        """Return the product of the matrix with a vector (or with the columns of an array)."""
+        x = np.asarray(x, dtype=float)
+        result = np.zeros(x.shape)
+        band_shape = (-1,) + (1,) * (x.ndim - 1)
+        for row, offset, cols in self._diagonals():
+            result[cols.start + offset:cols.stop + offset] += \
+                self.bands[row, cols].reshape(band_shape) * x[cols]
+        return result
+
+    def transpose(self):
+        """Return the transposed matrix (as a new banded matrix)."""
+        n = self.shape[0]
+        bands = np.zeros_like(self.bands)
+        for row, offset, cols in self._diagonals():
+            # entry (j + offset, j) becomes (j, j + offset)
+            bands[self.lower + self.upper - row, cols.start + offset:cols.stop + offset] = \
+                self.bands[row, cols]
+        return BandedMatrix(bands, self.upper, self.lower)
+
+    def gram(self):
+        """Return the Gram matrix (M^T.M), which is symmetric with lower + upper diagonals
+        (at most n - 1)."""
+        n = self.shape[0]
+        full_width = self.lower + self.upper
+        width = max(min(full_width, n - 1), 0)
+        bands = np.zeros((2 * width + 1, n))
+        for d in range(width + 1):
+            # sum over rows of M[k, j] * M[k, j + d]
+            diagonal = (self.bands[d:, :n - d] * self.bands[:full_width + 1 - d, d:]).sum(axis=0)
+            bands[width - d, d:] = diagonal
+            bands[width + d, :n - d] = diagonal
+        return BandedMatrix(bands, width, width)
+
+    def setflags(self, write):
+        """Set the writeable flag of the stored diagonals."""
+        self.bands.setflags(write=write)
+
+    def lu_factor(self):
+        """Return the LU factorization of the matrix and its (estimated) condition number.
+
+        Returns:
+            tuple: factorization (None if the matrix is singular) and condition number
+            (1-norm)
+        """
+        n = self.shape[0]
+        ab = np.vstack([np.zeros((self.lower, n)), self.bands])
+        lu, piv, info = dgbtrf(ab, self.lower, self.upper)
+        if info != 0:
+            return None, np.inf
+        anorm = np.abs(self.bands).sum(axis=0).max() if n else 0.
+        rcond, info = dgbcon(self.lower, self.upper, lu, piv, anorm)
+        return (lu, piv), (1. / rcond if rcond > 0 else np.inf)
+
+    def lu_solve(self, factorization, b):
+        """Solve M.x = b for the columns of b, given the factorization of M."""
+        lu, piv = factorization
+        x, _ = dgbtrs(lu, self.lower, self.upper, np.asarray(b, dtype=float), piv)
+        return x
+
+
+def compress_matrix(matrix, max_density=0.5, rtol=np.finfo(float).eps):
+    """Return the compact representation of a correction matrix.
+
+    Entries below the round-off error of the largest entry (e.g. the contribution of
+    the impurity of many tracer atoms) are neglected.
+
+    Args:
+        matrix (array): square matrix
+        max_density (float): maximal ratio between the size of the band and the
+            size of the matrix for the banded representation to be used
+        rtol (float): relative threshold of negligible entries (see
+            :py:meth:`BandedMatrix.from_dense`)
+
+    Returns:
+        BandedMatrix or array: banded matrix if its band is small enough, the
+        matrix itself otherwise
+    """
+    if isinstance(matrix, BandedMatrix) or matrix.ndim != 2 or matrix.shape[0] != matrix.shape[1]:
+        return matrix
+    banded = BandedMatrix.from_dense(matrix, rtol)
+    if banded.bands.shape[0] <= max_density * matrix.shape[0]:
+        return banded
+    return matrix
+
+
+def matrix_to_buffer(matrix):
+    """Return a compact representation of a correction matrix, as a raw buffer.
+
+    Args:
+        matrix (array or BandedMatrix): correction matrix
+
+    Returns:
+        dict: raw buffer of the (C-contiguous) entries of the matrix (or of its
+        bands), with their dtype and shape, and the number of sub- and
+        super-diagonals of banded matrices
+    """
+    if isinstance(matrix, BandedMatrix):
+        data = matrix_to_buffer(matrix.bands)
+        data.update(lower=matrix.lower, upper=matrix.upper)
+        return data
+    matrix = np.ascontiguousarray(matrix)
+    return {"buffer": matrix.tobytes(), "dtype": matrix.dtype.str, "shape": matrix.shape}
+
+
+def matrix_from_buffer(data):
+    """Return the (read-only) correction matrix represented by :py:func:`~matrix_to_buffer`.
+
+    Args:
+        data (dict): representation of the matrix
+
+    Returns:
+        array or BandedMatrix: the correction matrix, whose entries share the buffer
+    """
+    matrix = np.frombuffer(data["buffer"], dtype=np.dtype(data["dtype"])).reshape(data["shape"])
+    if "lower" in data:
+        matrix = BandedMatrix(matrix, data["lower"], data["upper"])
+    matrix.setflags(write=False)
+    return matrix
+
+
+class ActiveSetNNLS(object):
+    """Exact active-set NNLS solver with cached factorizations of the correction matrix.
+
+    The solver implements the active-set algorithm of Lawson and Hanson in the
+    normal-equations form proposed by Bro and De Jong (fast NNLS):
+
+        Bro R. and De Jong S., A fast non-negativity-constrained least squares
+        algorithm, J. Chemometrics, 1997, 11:393-401
+
+    The Gram matrix (M^T.M) is computed once at instantiation, and the Cholesky
+    factorization of its restriction to each passive set (the variables which are
+    not constrained to zero) is cached. Samples of a given metabolite usually share
+    a few passive sets, hence later samples only require triangular solves. If the
+    correction matrix is a :py:class:`~BandedMatrix`, so are its Gram matrix and
+    the Cholesky factors.
+
+    Args:
+        matrix (array or BandedMatrix): the correction matrix (M)
+    """
+
+    #: int: maximal number of factorizations (i.e. of passive sets) kept in memory
+    MAX_FACTORIZATIONS = 256
+    #: int: maximal number of rounds of grouped solves (see :py:meth:`~solve_many`)
+    MAX_ROUNDS = 3
+
+    def __init__(self, matrix):
+        self.matrix = matrix
+        self._matrix_t = matrix.transpose()
+        self._banded = isinstance(matrix, BandedMatrix)
+        if self._banded:
+            self.gram = matrix.gram()
+            gram_max = np.abs(self.gram.bands).max() if self.gram.bands.size else 0.
+        else:
+            self.gram = np.dot(matrix.transpose(), matrix)
+            gram_max = np.abs(self.gram).max() if self.gram.size else 0.
+        n = self.gram.shape[0]
+        # tolerance on the (scaled) gradient used to check optimality
+        self.tol = 10 * max(n, 1) * np.finfo(float).eps * max(gram_max, 1.)
+        self.max_iter = 3 * n
+        # factorizations are shared by the threads correcting measurements
+        self._factorizations = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _mt_dot(self, v_mes):
+        """Return M^T.v_mes for several measurement vectors (one per row)."""
+        return self._matrix_t.dot(v_mes.transpose()).transpose()
+
+    def _gram_dot(self, x):
+        """Return M^T.M.x for several vectors (one per row)."""
+        return self.gram.dot(x.transpose()).transpose()
+
+    def _sub_gram(self, indices):
+        """Return the Gram matrix restricted to indices (upper band form if it is banded)."""
+        if not self._banded:
+            return self.gram[np.ix_(indices, indices)]
+        # distances between the selected variables are at least the distances between
+        # their indices, hence the restricted matrix is banded too
+        width = self.gram.upper
+        m = len(indices)
+        upper = min(width, m - 1)
+        bands = np.zeros((upper + 1, m))
+        for d in range(upper + 1):
+            offsets = indices[d:] - indices[:m - d]
+            inside = offsets <= width
+            bands[upper - d, d:][inside] = self.gram.bands[width - offsets[inside], indices[d:][inside]]
+        return bands
+
+    def _factorize(self, passive):
+        """Return the Cholesky factorization of the Gram matrix restricted to the passive set.
+
+        Returns:
+            array: upper Cholesky factor (in band storage if the Gram matrix is banded),
+            None if the restricted matrix is singular
+        """
+        key = np.packbits(passive).tobytes()
+        with self._lock:
+            if key in self._factorizations:
+                self._factorizations.move_to_end(key)
+                return self._factorizations[key]
+        sub_gram = self._sub_gram(np.flatnonzero(passive))
+        if self._banded:
+            factorization, info = dpbtrf(sub_gram)
+        else:
+            factorization, info = dpotrf(sub_gram)
+        if info != 0:
+            factorization = None
+        with self._lock:
+            self._factorizations[key] = factorization
+            while len(self._factorizations) > self.MAX_FACTORIZATIONS:
+                self._factorizations.popitem(last=False)
+        return factorization
+
+    def _solve_passive(self, mtb, passive):
+        """Solve the unconstrained problem restricted to the variables of the passive set.
+
+        Args:
+            mtb (array): M^T.v_mes of a sample, or of several samples (one per row)
+            passive (array): boolean mask of the passive set
+
+        Returns:
+            array: solutions (zero outside of the passive set)
+        """
+        z = np.zeros(mtb.shape)
+        if not passive.any():
+            return z
+        rhs = mtb[..., passive].transpose().reshape(passive.sum(), -1)
+        factorization = self._factorize(passive)
+        if factorization is None:
+            # singular matrix, solved in the least-squares sense
+            sub_gram = self._sub_gram(np.flatnonzero(passive))
+            if self._banded:
+                upper, m = sub_gram.shape[0] - 1, sub_gram.shape[1]
+                sub_gram = BandedMatrix(np.vstack([sub_gram, np.zeros((upper, m))]), upper, upper)
+                for d in range(1, upper + 1):
+                    sub_gram.bands[upper + d, :m - d] = sub_gram.bands[upper - d, d:]
+                sub_gram = sub_gram.toarray()
+            solution = np.linalg.lstsq(sub_gram, rhs, rcond=None)[0]
+        elif self._banded:
+            solution, _ = dpbtrs(factorization, rhs)
+        else:
+            solution, _ = dpotrs(factorization, rhs)
+        z[..., passive] = solution.transpose().reshape(z[..., passive].shape)
+        return z
+
+    def _is_optimal(self, mtb, z, passive):
+        """Return True for the solutions z (one per row) which satisfy the optimality
+        conditions of the NNLS problem, given their passive set."""
+        scale = np.maximum(np.abs(mtb).max(axis=1), np.finfo(float).tiny)
+        w = mtb - self._gram_dot(z)
+        w[:, passive] = -np.inf
+        return (z[:, passive] > 0).all(axis=1) & (w.max(axis=1) / scale <= self.tol)
+
+    def _solve_mtb(self, mtb, passive=None):
+        """Return the NNLS solution for a sample, given M^T.v_mes.
+
+        The algorithm starts from the solution restricted to the passive set
+        provided (e.g. the passive set of the solution of a similar sample), if it
+        is feasible, and from zero otherwise.
+        """
+        n = len(mtb)
+        x = np.zeros(n)
+        if passive is not None and passive.any():
+            z = self._solve_passive(mtb, passive)
+            if (z[passive] > 0).all():
+                x = z
+            else:
+                passive = None
+        passive = np.zeros(n, dtype=bool) if passive is None else passive.copy()
+        scale = max(np.abs(mtb).max(), np.finfo(float).tiny)
+        w = mtb - self._gram_dot(x[np.newaxis, :])[0]
+        n_iter = 0
+        while not passive.all() and (w[~passive] / scale).max() > self.tol:
+            j = np.argmax(np.where(passive, -np.inf, w))
+            passive[j] = True
+            z = self._solve_passive(mtb, passive)
+            # move back towards the previous feasible point and remove the
+            # variables which became negative from the passive set
+            while (z[passive] <= 0).any() and n_iter <= self.max_iter:
+                n_iter += 1
+                mask = passive & (z <= 0)
+                step = x[mask] - z[mask]
+                alpha = np.min(np.where(step > 0, x[mask] / np.where(step > 0, step, 1.), 0.))
+                x += alpha * (z - x)
+                passive &= x > 0
+                x[~passive] = 0.
+                z = self._solve_passive(mtb, passive)
+            x = np.maximum(z, 0.)
+            w = mtb - self._gram_dot(x[np.newaxis, :])[0]
+            n_iter += 1
+            if n_iter > self.max_iter:
+                break
+        return x
+
+    def solve(self, v_mes):
+        """Return the NNLS solution for a measurement vector.
+
+        Args:
+            v_mes (array): measurement vector
+
+        Returns:
+            array: non-negative vector x minimizing ||v_mes - M.x||
+        """
+        return self._solve_mtb(self._mt_dot(np.asarray(v_mes, dtype=float)[np.newaxis, :])[0])
+
+    def solve_many(self, v_mes):
+        """Return the NNLS solutions for several measurement vectors.
+
+        Samples are grouped by candidate passive set (all the variables at first),
+        and the samples of each group are solved at once (a single multi-RHS solve).
+        Variables which are not positive in the solution of a sample which is not
+        optimal are removed from its candidate passive set, and samples are grouped
+        again (for at most :attr:`~MAX_ROUNDS` rounds). The active-set algorithm is
+        then run for each remaining sample, starting from its candidate passive set.
+
+        Args:
+            v_mes (array): measurement vectors (one per row)
+
+        Returns:
+            array: solutions (one per row)
+        """
+        v_mes = np.asarray(v_mes, dtype=float)
+        mtb = self._mt_dot(v_mes)
+        x = np.zeros(mtb.shape)
+        passive = np.ones(mtb.shape, dtype=bool)
+        todo = np.arange(mtb.shape[0])
+        for _ in range(self.MAX_ROUNDS):
+            if not todo.size:
+                break
+            _, groups = np.unique(np.packbits(passive[todo], axis=1), axis=0, return_inverse=True)
+            groups = groups.reshape(-1)
+            order = np.argsort(groups, kind="mergesort")
+            solved = np.zeros(todo.size, dtype=bool)
+            for members in np.split(order, np.flatnonzero(np.diff(groups[order])) + 1):
+                rows = todo[members]
+                group_passive = passive[rows[0]]
+                z = self._solve_passive(mtb[rows], group_passive)
+                optimal = self._is_optimal(mtb[rows], z, group_passive)
+                x[rows[optimal]] = z[optimal]
+                solved[members[optimal]] = True
+                passive[rows] &= z > 0
+            todo = todo[~solved]
+        for i in todo:
+            x[i] = self._solve_mtb(mtb[i], passive[i])
+        return x
+
+
+# the unconstrained solution is not used if the matrix is too ill-conditioned
+# (cond * eps above this value), since round-off errors may then dominate it
+MAX_COND_EPS = 1e-8
+
+
+def _clip_solutions(x, v_mes, dot):
+    """Set round-off components of unconstrained solutions to zero, and check the solutions.
+
+    Components smaller than the forward error of a well-conditioned solve
+    (n * eps * max|x|) are set to zero. A solution is only accepted if it is finite,
+    non-negative, and if clipping did not degrade its residual norm.
+
+    Args:
+        x (array): unconstrained solutions (one per row), clipped in place
+        v_mes (array): measurement vectors (one per row)
+        dot (callable): product of the correction matrix with solutions (one per row)
+
+    Returns:
+        tuple:
+            - (array) solutions (one per row)
+            - (array) boolean mask of the solutions which are accepted
+    """
+    eps = np.finfo(float).eps
+    finite = np.isfinite(x).all(axis=1)
+    x[~finite] = 0.
+    residuum = np.linalg.norm(dot(x) - v_mes, axis=1)
+    noise = 10 * max(x.shape[1], 1) * eps * np.abs(x).max(axis=1, initial=0.)
+    x[np.abs(x) <= noise[:, np.newaxis]] = 0.
+    clipped_residuum = np.linalg.norm(dot(x) - v_mes, axis=1)
+    valid = clipped_residuum <= residuum + np.sqrt(eps) * np.linalg.norm(v_mes, axis=1)
+    return x, finite & valid & (x >= 0).all(axis=1)
+
+
+class UnconstrainedLeastSquares(object):
+    """Unconstrained least-squares solver based on the pseudo-inverse of the correction matrix.
+
+    For most samples, the unconstrained least-squares solution is already
+    non-negative, in which case it is also the solution of the NNLS problem. Samples
+    can thus be corrected with a single matrix product, and only those with a negative
+    component need to be corrected with a constrained solver.
+
+    Components smaller than the round-off error of the product are set to zero, so
+    that isotopologues which are absent are not reported as slightly positive or
+    negative round-off values (see :py:func:`~_clip_solutions`). Solutions are never
+    accepted if the matrix is singular or ill-conditioned (see :py:data:`~MAX_COND_EPS`),
+    all samples being then corrected by the constrained solver.
+
+    If the correction matrix is a (non-singular) :py:class:`~BandedMatrix`, its LU
+    factorization is used instead of the pseudo-inverse.
+
+    Args:
+        matrix (array or BandedMatrix): the correction matrix (M)
+    """
+
+    def __init__(self, matrix):
+        self.matrix = matrix
+        self.pinv = None
+        self._lu = None
+        cond = np.inf
+        if isinstance(matrix, BandedMatrix):
+            self._lu, cond = matrix.lu_factor()
+        elif matrix.size:
+            singular_values = np.linalg.svd(matrix, compute_uv=False)
+            if singular_values[-1] > 0:
+                cond = singular_values[0] / singular_values[-1]
+        #: bool: False if the matrix is too ill-conditioned to use unconstrained solutions
+        self.well_conditioned = cond * np.finfo(float).eps <= MAX_COND_EPS
+        if self.well_conditioned and self._lu is None:
+            self.pinv = np.linalg.pinv(matrix)
+
+    def _dot(self, x):
+        return self.matrix.dot(x.transpose()).transpose()
+
+    def solve_many(self, v_mes):
+        """Return the unconstrained least-squares solutions for several measurement vectors.
+
+        Args:
+            v_mes (array): measurement vectors (one per row)
+
+        Returns:
+            tuple:
+                - (array) solutions (one per row)
+                - (array) boolean mask of the solutions which are non-negative (and
+                  accepted, see :py:func:`~_clip_solutions`)
+        """
+        if not self.well_conditioned:
+            return np.zeros((v_mes.shape[0], self.matrix.shape[1])), np.zeros(v_mes.shape[0], dtype=bool)
+        if self._lu is not None:
+            x = self.matrix.lu_solve(self._lu, v_mes.transpose()).transpose()
+        else:
+            x = np.dot(v_mes, self.pinv.transpose())
+        return _clip_solutions(x, v_mes, self._dot)
+
+
+def kronecker_dot(factors, x):
+    """Return the product of a Kronecker-structured matrix with vectors, without forming the matrix.
+
+    The matrix is the Kronecker product of the factors (the index of the last factor
+    varies fastest, as in `numpy.kron`). Each factor is applied in turn to the
+    corresponding axis of the vectors reshaped as tensors, hence the cost is
+    proportional to the sum (instead of the product) of the factor dimensions.
+
+    Args:
+        factors (list): factor matrices (the first one being the left-most)
+        x (array): vectors (one per row)
+
+    Returns:
+        array: products (one per row)
+    """
+    shape = tuple(factor.shape[1] for factor in factors)
+    tensor = x.reshape((x.shape[0],) + shape)
+    for axis, factor in enumerate(factors, 1):
+        tensor = np.moveaxis(np.tensordot(factor, tensor, axes=([1], [axis])), 0, axis)
+    return tensor.reshape(x.shape[0], int(np.prod(tensor.shape[1:])))
+
+
+class KroneckerLeastSquares(object):
+    """Unconstrained least-squares solver for a correction matrix which is a Kronecker product.
+
+    The pseudo-inverse of a Kronecker product is the Kronecker product of the
+    pseudo-inverses of its factors, hence only the (small) factors are inverted and
+    the unconstrained solutions are computed with :py:func:`~kronecker_dot`. Small
+    components are set to zero, and solutions are checked, as in
+    :py:class:`~UnconstrainedLeastSquares`.
+
+    Args:
+        factors (list): factors of the correction matrix
+    """
+
+    def __init__(self, factors):
+        self.factors = factors
+        cond = 1.
+        for factor in factors:
+            singular_values = np.linalg.svd(factor, compute_uv=False)
+            if singular_values.size and singular_values[-1] > 0:
+                cond *= singular_values[0] / singular_values[-1]
+            else:
+                cond = np.inf
+        #: bool: False if the matrix is too ill-conditioned to use unconstrained solutions
+        self.well_conditioned = cond * np.finfo(float).eps <= MAX_COND_EPS
+        self.pinvs = [np.linalg.pinv(factor) for factor in factors] if self.well_conditioned else None
+
+    def solve_many(self, v_mes):
+        """Return the unconstrained least-squares solutions for several measurement vectors.
+
+        Args:
+            v_mes (array): measurement vectors (one per row)
+
+        Returns:
+            tuple:
+                - (array) solutions (one per row)
+                - (array) boolean mask of the solutions which are non-negative (and
+                  accepted, see :py:func:`~_clip_solutions`)
+        """
+        if not self.well_conditioned:
+            n_cols = int(np.prod([factor.shape[1] for factor in self.factors]))
+            return np.zeros((v_mes.shape[0], n_cols)), np.zeros(v_mes.shape[0], dtype=bool)
+        x = kronecker_dot(self.pinvs, v_mes)
+        return _clip_solutions(x, v_mes, lambda x: kronecker_dot(self.factors, x))
+
+
+class KroneckerNNLS(ActiveSetNNLS):
+    """Exact active-set NNLS solver for a correction matrix which is a Kronecker product.
+
+    Same algorithm as :py:class:`~ActiveSetNNLS`, but neither the correction matrix
+    nor its Gram matrix are formed: the Gram matrix of a Kronecker product is the
+    Kronecker product of the Gram matrices of its factors, hence products are
+    computed with :py:func:`~kronecker_dot`, and only the restrictions of the Gram
+    matrix to the passive sets are built (and factorized). These restrictions are
+    dense, hence the number of variables is limited to :attr:`~MAX_VARIABLES`.
+
+    Args:
+        factors (list): factors of the correction matrix
+
+    Raises:
+        ValueError: too many variables
+    """
+
+    #: int: maximal number of variables (i.e. of columns of the correction matrix)
+    MAX_VARIABLES = 1024
+    #: int: maximal number of factorizations (i.e. of passive sets) kept in memory
+    MAX_FACTORIZATIONS = 32
+
+    def __init__(self, factors):
+        self.factors = factors
+        self._factors_t = [factor.transpose() for factor in factors]
+        self._banded = False
+        self.grams = [np.dot(factor.transpose(), factor) for factor in factors]
+        self.shape = tuple(gram.shape[0] for gram in self.grams)
+        n = int(np.prod(self.shape))
+        if n > self.MAX_VARIABLES:
+            raise ValueError("Too many variables for the NNLS solver ({}, at most {}).".format(
+                n, self.MAX_VARIABLES))
+        gram_max = float(np.prod([np.abs(gram).max() if gram.size else 0. for gram in self.grams]))
+        self.tol = 10 * max(n, 1) * np.finfo(float).eps * max(gram_max, 1.)
+        self.max_iter = 3 * n
+        self._factorizations = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _mt_dot(self, v_mes):
+        """Return M^T.v_mes for several measurement vectors (one per row)."""
+        return kronecker_dot(self._factors_t, v_mes)
+
+    def _gram_dot(self, x):
+        """Return M^T.M.x for several vectors (one per row)."""
+        return kronecker_dot(self.grams, x)
+
+    def _sub_gram(self, indices):
+        """Return the Gram matrix restricted to indices."""
+        sub_gram = np.ones((len(indices), len(indices)))
+        for gram, index in zip(self.grams, np.unravel_index(indices, self.shape)):
+            sub_gram *= gram[np.ix_(index, index)]
+        return sub_gram
@@ -6,9 +6,26 @@ parameter for all test functions. The test's parameter name must be the same as
 the fixture function's name.
 """
 
+import os
 import pytest
 from decimal import Decimal as D
 import numpy as np
+import isocor.cache
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "benchmark: time and memory benchmark, only run if"
+                                       " the environment variable ISOCOR_BENCHMARK is set")
+
+
+def pytest_collection_modifyitems(config, items):
+    """Skip benchmarks (their targets depend on the machine) unless ISOCOR_BENCHMARK is set."""
+    if os.environ.get("ISOCOR_BENCHMARK"):
+        return
+    skip_benchmark = pytest.mark.skip(reason="benchmark, set ISOCOR_BENCHMARK=1 to run it")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip_benchmark)
 
 
 @pytest.fixture
@@ -25,6 +42,14 @@ def data_iso():
             "O": {"abundance": [0.6, 0.3, 0.1],
                   "mass": [D('15.9949146221'), D('16.9991315'), D('17.9991604')]}}
 
+@pytest.fixture
+def empty_cache():
+    """Empty the correction matrices cache before and after the test."""
+    isocor.cache.correction_matrix_cache.clear()
+    yield isocor.cache.correction_matrix_cache
+    isocor.cache.correction_matrix_cache.clear()
+
+
 @pytest.fixture
 def usr_tolerance():
     """Platform-dependent tolerance."""
@@ -0,0 +1,107 @@
+"""Test the asynchronous interface of correctors."""
+
+import asyncio
+import threading
+import numpy as np
+import pytest
+import isocor as hrcor
+import isocor.aio
+from isocor.aio import acorrect, acorrect_many
+
+
+def run(coroutine):
+    """Run a coroutine in a new event loop."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+def build_corrector(data_iso, **kwargs):
+    return hrcor.MetaboliteCorrectorFactory("C10H20O6P", "13C", data_isotopes=data_iso,
+                                            resolution=1e4, mz_of_resolution=400, charge=1,
+                                            **kwargs)
+
+
+@pytest.mark.parametrize("tracer", ["13C", "13C,18O"])
+def test_acorrect(tracer, data_iso, empty_cache):
+    """Asynchronous corrections return the same results as synchronous ones."""
+    corrector = hrcor.MetaboliteCorrectorFactory("C3H7O6P", tracer, data_isotopes=data_iso)
+    measurements = np.random.RandomState(0).rand(3, corrector.correction_matrix.shape[0])
+    expected = corrector.correct_many(measurements)
+    del corrector.correction_matrix
+    empty_cache.clear()
+
+    async def main():
+        return await asyncio.gather(acorrect(corrector, measurements[0]),
+                                    acorrect_many(corrector, measurements, return_paths=True))
+    result, result_many = run(main())
+    np.testing.assert_allclose(result[0], expected[0][0], atol=1e-10)
+    np.testing.assert_allclose(result_many[0], expected[0], atol=1e-10)
+    assert len(result_many) == 5
+
+
+def test_coalesced_requests(data_iso, empty_cache, monkeypatch):
+    """Concurrent requests for the same correction matrix share a single computation."""
+    calls = []
+    precompute = isocor.aio.precompute_correction_matrices
+
+    def counting_precompute(correctors):
+        calls.append(correctors)
+        return precompute(correctors)
+    monkeypatch.setattr(isocor.aio, "precompute_correction_matrices", counting_precompute)
+    correctors = [build_corrector(data_iso) for _ in range(4)]
+    measurement = np.random.RandomState(1).rand(11)
+
+    async def main():
+        return await asyncio.gather(*[acorrect(corrector, measurement) for corrector in correctors])
+    results = run(main())
+    # a single computation, then the matrix is taken from the cache by the other correctors
+    assert len(calls) == 1
+    assert all(corrector._correction_matrix is correctors[0]._correction_matrix
+               for corrector in correctors)
+    np.testing.assert_allclose(results[1][0], results[0][0])
+
+
+def test_cancelled_request(data_iso, empty_cache, monkeypatch):
+    """A cancelled request does not cancel the computation of the matrix for other requests."""
+    release = threading.Event()
+    compute = hrcor.HighResMetaboliteCorrector.compute_correction_matrix
+
+    def blocking_compute(self):
+        release.wait(5)
+        return compute(self)
+    monkeypatch.setattr(hrcor.HighResMetaboliteCorrector, "compute_correction_matrix",
+                        blocking_compute)
+    corrector = build_corrector(data_iso)
+    other = build_corrector(data_iso)
+    measurement = np.random.RandomState(2).rand(11)
+
+    async def main():
+        cancelled = asyncio.ensure_future(acorrect(corrector, measurement))
+        waiting = asyncio.ensure_future(acorrect(other, measurement))
+        await asyncio.sleep(0.05)
+        cancelled.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+        release.set()
+        return await waiting
+    result = run(main())
+    assert result[0].shape == (11,)
+    assert other._correction_matrix is not None
+
+
+def test_cache_statistics(data_iso, empty_cache):
+    """Checking for cached matrices does not count as cache lookups."""
+    corrector = build_corrector(data_iso)
+    assert not isocor.aio._has_correction_matrix(corrector, use_cache=True)
+    assert empty_cache.cache_info().misses == 0
+    corrector.compact_correction_matrix
+    info = empty_cache.cache_info()
+    other = build_corrector(data_iso)
+    assert isocor.aio._has_correction_matrix(other, use_cache=True)
+    assert other._correction_matrix is corrector._correction_matrix
+    assert empty_cache.cache_info() == info
@@ -0,0 +1,141 @@
+"""Test the caches shared by all correctors of a process."""
+
+import pickle
+import numpy as np
+import pytest
+import isocor
+import isocor as hrcor
+import isocor.cache
+from isocor.cache import LRUCache, correction_matrix_cache
+from isocor.solvers import BandedMatrix
+
+
+def test_lru_cache():
+    """Least recently used items are evicted first, and statistics are updated."""
+    cache = LRUCache(maxsize=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert "b" not in cache
+    assert cache.get("b") is None
+    assert cache.cache_info() == (1, 1, 2, 2)
+    cache.maxsize = 1
+    assert len(cache) == 1 and "c" in cache
+    with pytest.raises(ValueError):
+        cache.maxsize = -1
+
+
+@pytest.mark.parametrize("kwargs", [{},
+                                    {"resolution": 1e4, "mz_of_resolution": 400, "charge": 1}])
+def test_shared_correction_matrix(kwargs, data_iso, empty_cache):
+    """Correctors with the same parameters share the same (read-only) correction matrix."""
+    x = hrcor.MetaboliteCorrectorFactory("C3H7O6P", "13C", data_isotopes=data_iso,
+                                         derivative_formula="H2O", label="x", **kwargs)
+    y = hrcor.MetaboliteCorrectorFactory("C3H7O6P", "13C", data_isotopes=data_iso,
+                                         derivative_formula="H2O", label="y", **kwargs)
+    assert x.correction_matrix is y.correction_matrix
+    assert not x.correction_matrix.flags.writeable
+    assert empty_cache.cache_info().hits == 1
+    assert empty_cache.cache_info().misses == 1
+
+
+@pytest.mark.parametrize("kwargs", [{"derivative_formula": "H3O"},
+                                    {"tracer_purity": [0.1, 0.9]},
+                                    {"correct_NA_tracer": True},
+                                    {"resolution": 1e4, "mz_of_resolution": 400, "charge": 1},
+                                    {"resolution": 1e4, "mz_of_resolution": 200, "charge": 1}])
+def test_different_correction_matrix(kwargs, data_iso, empty_cache):
+    """Correctors with different parameters do not share their correction matrix."""
+    x = hrcor.MetaboliteCorrectorFactory("C3H7O6P", "13C", data_isotopes=data_iso,
+                                         derivative_formula="H2O")
+    params = {"data_isotopes": data_iso, "derivative_formula": "H2O"}
+    params.update(kwargs)
+    y = hrcor.MetaboliteCorrectorFactory("C3H7O6P", "13C", **params)
+    assert x.correction_matrix is not y.correction_matrix
+    assert empty_cache.cache_info().misses == 2
+
+
+def test_threshold_in_fingerprint(data_iso, empty_cache):
+    """Changing the probability threshold and resetting the matrix does not return the previous one."""
+    x = hrcor.HighResMetaboliteCorrector("C3H7O6P", "13C", 1e4, 400, "orbitrap", 1,
+                                         data_isotopes=data_iso, derivative_formula=None,
+                                         tracer_purity=None, correct_NA_tracer=False)
+    matrix = x.correction_matrix
+    x.threshold_p = 1e-3
+    del x.correction_matrix
+    assert x.correction_matrix is not matrix
+
+
+@pytest.fixture
+def matrix_store(tmp_path, empty_cache):
+    """Enable a persistent store of correction matrices in a temporary directory."""
+    yield isocor.cache.set_correction_matrix_store(tmp_path)
+    isocor.cache.set_correction_matrix_store(None)
+
+
+def test_matrix_store(matrix_store, data_iso, monkeypatch):
+    """Correction matrices are saved on disk, and loaded instead of being recomputed."""
+    x = hrcor.MetaboliteCorrectorFactory("C3H7O6P", "13C", data_isotopes=data_iso,
+                                         resolution=1e4, mz_of_resolution=400, charge=1)
+    matrix = x.correction_matrix
+    assert matrix_store.cache_info() == (0, 1, None, 1)
+    # new process: empty memory cache, and the matrix should not be computed
+    isocor.cache.correction_matrix_cache.clear()
+    y = hrcor.MetaboliteCorrectorFactory("C3H7O6P", "13C", data_isotopes=data_iso,
+                                         resolution=1e4, mz_of_resolution=400, charge=1)
+    def fail(self):
+        raise AssertionError("The correction matrix should not be recomputed.")
+    monkeypatch.setattr(type(y), "compute_correction_matrix", fail)
+    np.testing.assert_array_equal(y.correction_matrix, matrix)
+    assert matrix_store.cache_info().hits == 1
+    assert not y.correction_matrix.flags.writeable
+
+
+def test_matrix_store_version(matrix_store, monkeypatch):
+    """Matrices are identified by both the fingerprint and the IsoCor version."""
+    key = matrix_store.get_key(("C3",))
+    assert key == matrix_store.get_key(("C3",))
+    assert key != matrix_store.get_key(("C4",))
+    monkeypatch.setattr(isocor, "__version__", "0.0.0")
+    assert key != matrix_store.get_key(("C3",))
+
+
+def test_banded_matrix_store(matrix_store, empty_cache):
+    """Banded correction matrices are cached and saved in their compact representation."""
+    kwargs = dict(resolution=7e4, mz_of_resolution=400, charge=1)
+    x = hrcor.MetaboliteCorrectorFactory("C40H60N5O10", "13C", **kwargs)
+    compact = x.compact_correction_matrix
+    assert isinstance(compact, BandedMatrix)
+    assert correction_matrix_cache.get(x._fingerprint()).matrix is compact
+    isocor.cache.correction_matrix_cache.clear()
+    y = hrcor.MetaboliteCorrectorFactory("C40H60N5O10", "13C", **kwargs)
+    assert isinstance(y.compact_correction_matrix, BandedMatrix)
+    assert matrix_store.cache_info().hits == 1
+    np.testing.assert_array_equal(y.correction_matrix, x.correction_matrix)
+    assert not y.correction_matrix.flags.writeable
+    assert not y.compact_correction_matrix.bands.flags.writeable
+
+
+
+@pytest.mark.parametrize("kwargs", [{"resolution": 7e4, "mz_of_resolution": 400, "charge": 1},
+                                    {"threshold_p": 1e-6}])
+def test_discarded_p(kwargs, matrix_store, empty_cache):
+    """The probability discarded by the threshold is restored with cached, saved and
+    pickled correction matrices."""
+    x = hrcor.MetaboliteCorrectorFactory("C40H60N5O10", "13C", **kwargs)
+    x.compact_correction_matrix
+    assert x.discarded_p > 0
+    # cache hit
+    y = hrcor.MetaboliteCorrectorFactory("C40H60N5O10", "13C", **kwargs)
+    y.compact_correction_matrix
+    assert empty_cache.cache_info().hits == 1
+    assert y.discarded_p == x.discarded_p
+    # store hit
+    empty_cache.clear()
+    z = hrcor.MetaboliteCorrectorFactory("C40H60N5O10", "13C", **kwargs)
+    z.compact_correction_matrix
+    assert matrix_store.cache_info().hits == 1
+    assert z.discarded_p == x.discarded_p
+    # pickle round-trip
+    assert pickle.loads(pickle.dumps(x)).discarded_p == x.discarded_p
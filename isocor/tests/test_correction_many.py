@@ -0,0 +1,77 @@
+"""Test the batch correction of several samples at once.
+
+Results of :py:meth:`~isocor.mscorrectors.LowResMetaboliteCorrector.correct_many`
+should be the same as those obtained by correcting each sample independently.
+"""
+
+import numpy as np
+import pytest
+import isocor as hrcor
+
+
+@pytest.fixture
+def measurements():
+    """Measurements of several samples (including a null one) for a C3 metabolite."""
+    return np.array([[0.5, 0.2, 0.2, 0.1],
+                     [1e6, 2e5, 3e5, 5e6],
+                     [0.0, 0.0, 0.0, 0.0],
+                     [0.9, 0.05, 0.03, 0.02],
+                     [12., 0., 3., 1.]])
+
+
+@pytest.mark.parametrize("resolution", [None, 1e4])
+def test_correct_many_vs_correct(measurements, resolution, data_iso):
+    """Batch correction gives the same results as sample-by-sample correction."""
+    kwargs = {"resolution": resolution, "mz_of_resolution": 400, "charge": 1} if resolution else {}
+    metabolite = hrcor.MetaboliteCorrectorFactory("C3H7O6P", "13C", data_isotopes=data_iso,
+                                                  derivative_formula="H2O", tracer_purity=[0.1, 0.9],
+                                                  correct_NA_tracer=True, **kwargs)
+    areas, fractions, residuums, enrichments = metabolite.correct_many(measurements)
+    assert areas.shape == fractions.shape == residuums.shape == measurements.shape
+    assert enrichments.shape == (measurements.shape[0],)
+    for i, measurement in enumerate(measurements):
+        area, fraction, residuum, enrichment = metabolite.correct(measurement)
+        scale = max(measurement.sum(), 1.)
+        np.testing.assert_allclose(areas[i] / scale, area / scale, atol=1e-6)
+        np.testing.assert_allclose(fractions[i], fraction, atol=1e-6)
+        np.testing.assert_allclose(residuums[i], residuum, atol=1e-6)
+        np.testing.assert_allclose(enrichments[i], enrichment, atol=1e-6)
+
+
+def test_correct_many_null_sample(measurements, data_iso):
+    """Fractions, residuum and enrichment are NaN for a null measurement vector."""
+    metabolite = hrcor.LowResMetaboliteCorrector("C3H7O6P", "13C", data_isotopes=data_iso,
+                                                 derivative_formula=None, tracer_purity=None,
+                                                 correct_NA_tracer=False)
+    _, fractions, residuums, enrichments = metabolite.correct_many(measurements)
+    assert np.all(np.isnan(fractions[2]))
+    assert np.all(np.isnan(residuums[2]))
+    assert np.isnan(enrichments[2])
+
+
+@pytest.mark.parametrize("bad_measurements", [[0.5, 0.2, 0.2, 0.1],
+                                              [[0.5, 0.2, 0.2]]])
+def test_correct_many_bad_shape(bad_measurements, data_iso):
+    """An error is raised if measurements are not a n_samples x n_isotopologues array."""
+    metabolite = hrcor.LowResMetaboliteCorrector("C3H7O6P", "13C", data_isotopes=data_iso,
+                                                 derivative_formula=None, tracer_purity=None,
+                                                 correct_NA_tracer=False)
+    with pytest.raises(ValueError):
+        metabolite.correct_many(bad_measurements)
+
+
+@pytest.mark.parametrize("tracer, kwargs", [("13C", {"fast_path": False}),
+                                            ("13C", {"fast_path": False, "solver": "nnls"}),
+                                            ("13C", {"fast_path": True}),
+                                            ("13C", {"fast_path": False, "resolution": 1e4,
+                                                     "mz_of_resolution": 400, "charge": 1}),
+                                            ("13C,18O", {"fast_path": False}),
+                                            ("13C,18O", {"fast_path": False, "solver": "nnls"}),
+                                            ("13C,18O", {"fast_path": True})])
+def test_correct_many_empty(tracer, kwargs, data_iso):
+    """An empty batch of samples is corrected."""
+    metabolite = hrcor.MetaboliteCorrectorFactory("C3H7O6P", tracer, data_isotopes=data_iso, **kwargs)
+    n_isotopologues = metabolite.correction_matrix.shape[0]
+    areas, fractions, residuums, enrichments = metabolite.correct_many(np.zeros((0, n_isotopologues)))
+    assert areas.shape == fractions.shape == residuums.shape == (0, n_isotopologues)
+    assert len(enrichments) == 0
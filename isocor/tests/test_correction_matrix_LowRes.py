@@ -89,3 +89,37 @@ def test_low_res_cor_matrix(data, data_iso, usr_tolerance):
     expected_matrix = eval(data["expected_matrix"])
     np.testing.assert_allclose(
         correction_matrix, expected_matrix, rtol=usr_tolerance)
+
+
+def get_cor_matrix_by_column(metabolite):
+    """Return the low resolution correction matrix by convolving the correction vector column by column."""
+    correction_vector = metabolite.get_mass_distribution_vector()
+    n_isotopologues = metabolite.formula[metabolite._tracer_el] + 1
+    mask = [n * metabolite._idx_tracer for n in range(n_isotopologues)]
+    correction_matrix = np.zeros((n_isotopologues, n_isotopologues))
+    for i in range(n_isotopologues):
+        column = correction_vector
+        for _ in range(i):
+            column = np.convolve(column, metabolite.tracer_purity)
+        if metabolite.correct_NA_tracer:
+            for _ in range(n_isotopologues-i-1):
+                column = np.convolve(column, metabolite.data_isotopes[metabolite._tracer_el]["abundance"])
+        column = np.concatenate((column, [0.]*max(0, max(mask)-len(column)+1)))
+        correction_matrix[:, i] = column[mask]
+    return correction_matrix
+
+
+@pytest.mark.parametrize("correct_NA_tracer", [False, True])
+@pytest.mark.parametrize("formula, tracer, purity", [("C16H32O2", "13C", [0.01, 0.99]),
+                                                     ("C60H110O6", "13C", [0.02, 0.98]),
+                                                     ("C6H12O6", "18O", [0.01, 0.02, 0.97]),
+                                                     ("C5H11NO2S", "34S", [0.02, 0.01, 0.95, 0., 0.02]),
+                                                     ("CH4", "13C", [0.01, 0.99])])
+def test_low_res_cor_matrix_by_column(formula, tracer, purity, correct_NA_tracer):
+    """Check the correction matrix (computed for all columns at once) against a column by column construction."""
+    metabolite = hrcor.LowResMetaboliteCorrector(formula, tracer, data_isotopes=None,
+                                                 correct_NA_tracer=correct_NA_tracer,
+                                                 tracer_purity=purity,
+                                                 derivative_formula="C3H9Si")
+    np.testing.assert_allclose(metabolite.compute_correction_matrix(), get_cor_matrix_by_column(metabolite),
+                               rtol=1e-12, atol=1e-300)
@@ -0,0 +1,79 @@
+"""Test the construction of correctors.
+
+Correctors are instantiated by thousands (e.g. one per metabolite, derivative and
+resolution of a datafile), hence their construction should be cheap. The
+micro-benchmark checks that allocating correctors takes less than 100 µs and 1 kB
+each (i.e. less than 10 seconds and 100 MB for 10^5 correctors). It depends on
+the machine, hence it only runs if the environment variable ISOCOR_BENCHMARK is set.
+"""
+
+import logging
+import time
+import tracemalloc
+import pytest
+import isocor as hrcor
+
+N_CORRECTORS = 10**5
+N_TRACED = 10**3  # correctors allocated while tracing memory
+TIME_TARGET = 100e-6  # seconds per corrector
+MEMORY_TARGET = 1000  # bytes per corrector
+
+
+def build_correctors(n):
+    return [hrcor.LowResMetaboliteCorrector("C6H12O6", "13C", derivative_formula="C2H6Si",
+                                            tracer_purity=None, correct_NA_tracer=False,
+                                            data_isotopes=None)
+            for _ in range(n)]
+
+
+def test_construction():
+    """Correction matrices are not computed when correctors are constructed."""
+    correctors = build_correctors(N_TRACED)
+    assert len(correctors) == N_TRACED
+    assert all(corrector._correction_matrix is None for corrector in correctors)
+    assert correctors[0].formula == correctors[-1].formula
+    assert correctors[0].correction_matrix.shape == (7, 7)
+
+
+@pytest.mark.benchmark
+def test_construction_benchmark():
+    """Check time and memory needed to allocate many correctors."""
+    start = time.perf_counter()
+    build_correctors(N_CORRECTORS)
+    elapsed = time.perf_counter() - start
+    # measure memory in a second (smaller) run, since tracing allocations slows
+    # down computations
+    tracemalloc.start()
+    try:
+        correctors = build_correctors(N_TRACED)
+        memory = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    assert len(correctors) == N_TRACED
+    assert elapsed / N_CORRECTORS < TIME_TARGET
+    assert memory / N_TRACED < MEMORY_TARGET
+
+
+@pytest.mark.parametrize("kwargs", [{}, {"resolution": 1e4, "mz_of_resolution": 400, "charge": 1}])
+def test_slots(kwargs):
+    """Correctors store their attributes in slots."""
+    corrector = hrcor.MetaboliteCorrectorFactory("C6H12O6", "13C", **kwargs)
+    assert not hasattr(corrector, "__dict__")
+    with pytest.raises(AttributeError):
+        corrector.unknown_attribute = None
+    corrector.label = "Glc"
+    assert corrector.label == "Glc"
+
+
+def test_log_on_init(caplog):
+    """Parameters are only logged if debug messages are enabled."""
+    logger = "isocor.mscorrectors"
+    with caplog.at_level(logging.INFO, logger=logger):
+        build_correctors(1)
+    assert not caplog.records
+    with caplog.at_level(logging.DEBUG, logger=logger):
+        build_correctors(1)
+    messages = [record.getMessage() for record in caplog.records]
+    assert any("('_str_formula', 'C6H12O6')" in message and "_solver" in message
+               for message in messages)
+    assert any("_data_isotopes" in message for message in messages)
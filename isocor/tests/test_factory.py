@@ -1,7 +1,10 @@
 """Test the MetaboliteCorrectorFactory."""
 
+import pickle
+import numpy as np
 import pytest
 import isocor as hrcor
+from isocor.base import LabelledChemical
 
 
 def test_MetaboliteCorrectorFactory(data_iso):
@@ -57,3 +60,122 @@ def test_badinput(kwargs, data_iso):
     kwargs["data_isotopes"] = data_iso
     with pytest.raises(ValueError):
         hrcor.MetaboliteCorrectorFactory(**kwargs)
+
+@pytest.mark.parametrize("kwargs, expected", [
+    ({}, None),
+    ({"threshold_p": 1e-6}, 1e-6),
+    ({"resolution": 7e4, "mz_of_resolution": 400, "charge": 1}, None),
+    ({"resolution": 7e4, "mz_of_resolution": 400, "charge": 1, "threshold_p": 1e-8}, 1e-8),
+    ({"resolution": 7e4, "mz_of_resolution": 400, "charge": 1, "derivative_formula": "C30H60Si10"}, 1e-10),
+    ({"resolution": 7e4, "mz_of_resolution": 400, "charge": 1, "derivative_formula": "C30H60Si10",
+      "threshold_p": None}, None)
+])
+def test_threshold_factory(kwargs, expected):
+    """Test the probability threshold set by the factory ("auto" by default)."""
+    corrector = hrcor.MetaboliteCorrectorFactory("C3H7O6P", "13C", **kwargs)
+    assert corrector.threshold_p == expected
+
+@pytest.mark.parametrize("threshold_p", [-1e-6, 2., "1e-6x"])
+def test_bad_threshold(threshold_p):
+    """Test a probability threshold outside [0, 1] (Factory)."""
+    with pytest.raises(ValueError):
+        hrcor.MetaboliteCorrectorFactory("C3H7O6P", "13C", threshold_p=threshold_p)
+
+
+def test_isotope_table(data_iso, monkeypatch):
+    """Isotopic data are checked once per table, and tables can be used as cache keys."""
+    table = hrcor.IsotopeTable(data_iso)
+    assert table == hrcor.IsotopeTable(data_iso)
+    assert table.key == hrcor.IsotopeTable(data_iso).key
+    assert {table: 1}[hrcor.IsotopeTable(data_iso)] == 1
+    assert table.to_dict() == data_iso
+    assert pickle.loads(pickle.dumps(table)) == table
+    assert list(table.abundances("O")) == data_iso["O"]["abundance"]
+    assert list(table.masses("C")) == [float(m) for m in data_iso["C"]["mass"]]
+    with pytest.raises(TypeError):
+        table["C"]["mass"] = []
+    with pytest.raises(ValueError):
+        table.abundances("C")[0] = 1.
+    # different data, different key
+    other = dict(data_iso, P={"abundance": [1.], "mass": [30]})
+    assert hrcor.IsotopeTable(other).key != table.key
+    # correctors do not check the table again, and share the matrix of correctors
+    # built with the same data
+    def fail(data_isotopes):
+        raise AssertionError("Isotopic data should not be checked again.")
+    reference = hrcor.MetaboliteCorrectorFactory("C3H7O6P", "13C", data_isotopes=data_iso)
+    monkeypatch.setattr(hrcor.IsotopeTable, "_check", staticmethod(fail))
+    x = hrcor.MetaboliteCorrectorFactory("C3H7O6P", "13C", data_isotopes=table)
+    assert x.data_isotopes is table
+    assert x._fingerprint() == reference._fingerprint()
+
+
+def test_bad_isotope_table():
+    """Invalid isotopic data are detected when the table is built."""
+    with pytest.raises(ValueError):
+        hrcor.IsotopeTable({'C': {'mass': [12, 13], 'abundance': [1., 1.]}})
+
+
+def test_corrector_pool(data_iso):
+    """Correctors with the same canonical parameters are shared by the pool."""
+    pool = hrcor.CorrectorPool(maxsize=2)
+    x = pool("C3H7O6P", "13C", data_isotopes=data_iso, label="G3P")
+    assert isinstance(x, hrcor.LowResMetaboliteCorrector)
+    # equivalent parameters
+    assert pool("O6C3H7P", "13C", data_isotopes=hrcor.IsotopeTable(data_iso), label="G3P",
+                derivative_formula="", correct_NA_tracer=False, solver="bfgs") is x
+    # different parameters
+    y = pool("C3H7O6P", "13C", data_isotopes=data_iso, label="G3P", resolution=1e4,
+             mz_of_resolution=400, charge=1)
+    assert isinstance(y, hrcor.HighResMetaboliteCorrector)
+    assert pool("C3H7O6P", "13C", data_isotopes=data_iso, label="G3P",
+                tracer_purity=[0.1, 0.9]) is not x
+    # least recently used correctors are evicted
+    assert pool("C3H7O6P", "13C", data_isotopes=data_iso, label="G3P") is not x
+    assert pool.cache_info() == (1, 4, 2, 2)
+    pool.clear()
+    assert len(pool) == 0
+    with pytest.raises(ValueError):
+        pool("C3H7O6P", "13C", data_isotopes=data_iso, typo=None)
+
+
+@pytest.mark.parametrize("kwargs", [{},
+                                    {"resolution": 1e4, "mz_of_resolution": 400, "charge": 1},
+                                    {"tracer": "13C,15N", "tracer_purity": {"13C": [0.05, 0.95]}}])
+def test_pickle_corrector(kwargs, data_iso):
+    """Correctors are pickled with their parameters and their correction matrix."""
+    kwargs = dict({"tracer": "13C", "tracer_purity": [0.05, 0.95]}, **kwargs)
+    x = hrcor.MetaboliteCorrectorFactory("C3H7NO2", data_isotopes=data_iso, label="Ala",
+                                         derivative_formula="C2H6N", correct_NA_tracer=True,
+                                         **kwargs)
+    y = pickle.loads(pickle.dumps(x))
+    assert type(y) is type(x)
+    assert y.get_parameters() == x.get_parameters()
+    assert y._correction_matrix is None
+    matrix = x.correction_matrix
+    y = pickle.loads(pickle.dumps(x))
+    # the correction matrix is not computed again
+    assert y._correction_matrix is not None
+    assert not y.correction_matrix.flags.writeable
+    np.testing.assert_array_equal(y.correction_matrix, matrix)
+    assert y.label == "Ala" and y.data_isotopes == x.data_isotopes
+    assert x.from_dict(x.to_dict(include_matrix=False))._correction_matrix is None
+
+
+def test_pickle_resolution_formula(data_iso):
+    """Correctors with a custom resolution formula (e.g. a lambda) can be pickled."""
+    x = hrcor.HighResMetaboliteCorrector("C3H7O6P", "13C", 1e4, 400, "custom", 2,
+                                         resolution_formula=lambda mw, res, at_mz: 1.66 * mw / res,
+                                         data_isotopes=data_iso, derivative_formula=None,
+                                         tracer_purity=None, correct_NA_tracer=False)
+    y = pickle.loads(pickle.dumps(x))
+    assert y.correction_limit == pytest.approx(x.correction_limit, rel=1e-15)
+    np.testing.assert_array_equal(y.correction_matrix, x.correction_matrix)
+
+
+def test_check_data_isotopes(data_iso):
+    """Isotopic data can still be checked with LabelledChemical._check_data_isotopes."""
+    LabelledChemical._check_data_isotopes(data_iso)
+    LabelledChemical._check_data_isotopes(hrcor.IsotopeTable(data_iso))
+    with pytest.raises(ValueError):
+        LabelledChemical._check_data_isotopes(dict(data_iso, P={"abundance": [0.9], "mass": [30]}))
@@ -0,0 +1,57 @@
+"""Test the parsing and the arithmetic of elemental formulas."""
+
+import pickle
+import pytest
+import isocor as hrcor
+from isocor.base import Formula
+
+
+@pytest.mark.parametrize("str_formula, expected", [("C6H12O6", {"C": 6, "H": 12, "O": 6}),
+                                                    ("H2O", {"H": 2, "O": 1}),
+                                                    ("CH3CH2OH", {"C": 2, "H": 6, "O": 1}),
+                                                    ("C3H9Si", {"C": 3, "H": 9, "Si": 1}),
+                                                    ("C0H2", {"H": 2}),
+                                                    ("", {})])
+def test_parse_formula(str_formula, expected):
+    """Formulas are parsed as counters of atoms."""
+    formula = Formula.parse(str_formula)
+    assert formula == expected
+    assert dict(formula.items()) == expected
+    assert formula["N"] == 0
+    assert "N" not in formula
+    assert bool(formula) == bool(expected)
+
+
+def test_interned_formula():
+    """Equal formulas are the same object, whatever the order of the elements."""
+    formula = Formula.parse("C6H12O6")
+    assert Formula.parse("C6H12O6") is formula
+    assert Formula.parse("O6C6H12") is formula
+    assert Formula({"O": 6, "H": 12, "C": 6}) is formula
+    assert pickle.loads(pickle.dumps(formula)) is formula
+    assert {formula: 1}[Formula.parse("H12C6O6")] == 1
+    assert str(formula) == "C6H12O6"
+    assert list(formula) == ["C", "H", "O"]
+
+
+def test_formula_arithmetic():
+    """Formulas can be added and subtracted."""
+    formula = Formula.parse("C6H12O6")
+    assert formula + Formula.parse("C3H9Si") is Formula.parse("C9H21O6Si")
+    assert formula - Formula.parse("C6") is Formula.parse("H12O6")
+    assert formula - formula is Formula.parse("")
+    with pytest.raises(ValueError):
+        formula - Formula.parse("N")
+
+
+def test_correction_formula(data_iso):
+    """The correction formula is a Formula, shared by correctors of the same metabolite."""
+    x = hrcor.LowResMetaboliteCorrector("C3H7O6P", "13C", data_isotopes=data_iso,
+                                        derivative_formula="C2H6Si", tracer_purity=None,
+                                        correct_NA_tracer=False)
+    y = hrcor.LowResMetaboliteCorrector("C3H7O6P", "13C", data_isotopes=data_iso,
+                                        derivative_formula="C2H6Si", tracer_purity=None,
+                                        correct_NA_tracer=True)
+    assert x.correction_formula is Formula.parse("C2H13O6PSi")
+    assert y.correction_formula is x.correction_formula
+    assert y.formula is x.formula
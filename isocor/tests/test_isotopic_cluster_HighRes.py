@@ -4,6 +4,7 @@ different number of elements and isotopes) against a brute force implementation.
 
 import math
 import itertools as it
+from decimal import Decimal as D
 import pytest
 import numpy as np
 import isocor as hrcor
@@ -67,8 +68,10 @@ def get_isoclust_bruteforce(formula, data_iso):
                                      {"C": 1, "O": 2},
                                      {"C": 1, "N": 20, "H": 20, "O": 20, "P": 4},
                                      {"C": 20, "N": 20, "H": 20, "O": 20, "P": 4}])
-def test_isoclust_against_bruteforce(formula, data_iso, usr_tolerance):
+@pytest.mark.parametrize("mass_engine", ["fixed", "decimal"])
+def test_isoclust_against_bruteforce(formula, mass_engine, data_iso, usr_tolerance):
     """Check the high-resolution isotopic clusters generation against a brute force implementation."""
+    formula = dict(formula)
     str_formula = "".join(["{}{}".format(k, v) for k, v in formula.items()])
     # Get the clusters (without tracers)
     try:
@@ -82,6 +85,7 @@ def test_isoclust_against_bruteforce(formula, data_iso, usr_tolerance):
                                                   tracer_purity=None,
                                                   data_isotopes=data_iso,
                                                   correct_NA_tracer=False,
+                                                  mass_engine=mass_engine,
                                                   charge=1)
     metabolite.threshold_p = None
     ic_optimized = metabolite.get_isotopic_cluster()
@@ -101,3 +105,175 @@ def test_isoclust_against_bruteforce(formula, data_iso, usr_tolerance):
     abun_bruteforce = [float(x) for x in sorted(ic_bruteforce.values())]
     np.testing.assert_allclose(
         abun_optimized, abun_bruteforce, rtol=usr_tolerance)
+
+
+@pytest.mark.parametrize("formula, tracer, derivative", [("C6H12O6", "13C", ""),
+                                                         ("C10H16N5O13P3", "15N", "C3H9Si"),
+                                                         ("C5H10N2O3S", "34S", ""),
+                                                         ("C4H6O5", "18O", "C2H6Si")])
+def test_mass_engines(formula, tracer, derivative):
+    """Check that the "fixed" mass engine gives the same clusters and matrices as the "decimal" reference.
+
+    Masses must be identical (isotopic masses have less than 12 decimals), and
+    abundances may only differ by floating-point summation errors (relative difference < 1e-12).
+    """
+    results = {}
+    for mass_engine in ["fixed", "decimal"]:
+        metabolite = hrcor.HighResMetaboliteCorrector(formula, tracer, 7e4, 400,
+                                                      resolution_formula_code="orbitrap",
+                                                      derivative_formula=derivative,
+                                                      tracer_purity=None,
+                                                      data_isotopes=None,
+                                                      correct_NA_tracer=True,
+                                                      mass_engine=mass_engine,
+                                                      charge=1)
+        results[mass_engine] = (metabolite.get_isotopic_cluster(),
+                                metabolite.get_mass_distribution_vector(),
+                                metabolite.compute_correction_matrix())
+    ic_fixed, mdv_fixed, matrix_fixed = results["fixed"]
+    ic_decimal, mdv_decimal, matrix_decimal = results["decimal"]
+    assert sorted(ic_fixed.keys()) == sorted(ic_decimal.keys())
+    np.testing.assert_allclose([ic_fixed[k] for k in sorted(ic_fixed)],
+                               [ic_decimal[k] for k in sorted(ic_fixed)], rtol=1e-12)
+    np.testing.assert_allclose(mdv_fixed, mdv_decimal, rtol=1e-12, atol=1e-300)
+    np.testing.assert_allclose(matrix_fixed, matrix_decimal, rtol=1e-12, atol=1e-300)
+
+
+def test_unknown_mass_engine():
+    """Check that an unknown mass engine is rejected."""
+    with pytest.raises(NotImplementedError):
+        hrcor.HighResMetaboliteCorrector("C6H12O6", "13C", 7e4, 400, resolution_formula_code="orbitrap",
+                                         derivative_formula=None, tracer_purity=None,
+                                         data_isotopes=None, correct_NA_tracer=False,
+                                         mass_engine="float", charge=1)
+
+
+@pytest.mark.parametrize("mass_engine", ["fixed", "decimal"])
+def test_threshold_pruning(mass_engine):
+    """Check that peaks below the probability threshold are discarded and that the discarded probability is reported."""
+    kwargs = {"resolution_formula_code": "orbitrap", "derivative_formula": "",
+              "tracer_purity": None, "data_isotopes": None, "correct_NA_tracer": False,
+              "mass_engine": mass_engine, "charge": 1}
+    full = hrcor.HighResMetaboliteCorrector("C6H12N2O6S", "13C", 7e4, 400, threshold_p=None, **kwargs)
+    pruned = hrcor.HighResMetaboliteCorrector("C6H12N2O6S", "13C", 7e4, 400, threshold_p=1e-8, **kwargs)
+    ic_full = full.get_isotopic_cluster()
+    assert full.discarded_p == 0.
+    ic_pruned = pruned.get_isotopic_cluster()
+    assert len(ic_pruned) < len(ic_full)
+    assert min(ic_pruned.values()) > 1e-8
+    assert set(ic_pruned) <= set(ic_full)
+    # peaks are pruned before being merged, hence kept peaks may be slightly lower
+    # than in the full cluster, by at most the discarded probability
+    discarded = 1. - sum(ic_pruned.values())
+    np.testing.assert_allclose(pruned.discarded_p, discarded, rtol=1e-6)
+    assert 0. < pruned.discarded_p < 1e-4
+    for mass, abundance in ic_pruned.items():
+        assert 0. <= ic_full[mass] - abundance <= pruned.discarded_p
+    # the correction matrix is not affected beyond the discarded probability
+    matrix_full = full.compute_correction_matrix()
+    matrix_pruned = pruned.compute_correction_matrix()
+    assert pruned.discarded_p > 0.
+    np.testing.assert_allclose(matrix_pruned, matrix_full, atol=pruned.discarded_p)
+
+
+@pytest.mark.parametrize("element, n_atoms", [("O", 1), ("O", 7), ("O", 40), ("S", 6), ("Si", 12)])
+def test_multinomial_blocks(element, n_atoms, usr_tolerance):
+    """Check the vectorized generation of blocks against the enumeration of isotopes combinations."""
+    data = hrcor.LowResMetaboliteCorrector.DEFAULT_ISODATA[element]
+    metabolite = hrcor.HighResMetaboliteCorrector("C6H12O6", "13C", 7e4, 400,
+                                                  resolution_formula_code="orbitrap",
+                                                  derivative_formula=None,
+                                                  tracer_purity=None,
+                                                  data_isotopes=None,
+                                                  correct_NA_tracer=False,
+                                                  charge=1)
+    reference = metabolite._get_block_n([metabolite._to_fixed(m) for m in data["mass"]],
+                                        data["abundance"], n_atoms, len(data["mass"]))
+    masses, abundances = metabolite._get_array_block(data["mass"], data["abundance"], n_atoms)
+    assert len(masses) == len(reference)
+    reference = sorted(reference)
+    order = np.argsort(masses, kind="stable")
+    assert masses[order].tolist() == [x[0] for x in reference]
+    np.testing.assert_allclose(abundances[order], [x[1] for x in reference], rtol=usr_tolerance)
+
+
+def test_multinomial_no_overflow():
+    """Check that probabilities of blocks with many atoms are computed without overflow."""
+    compositions = hrcor.HighResMetaboliteCorrector._get_compositions(400, 3)
+    assert len(compositions) == 401 * 402 // 2
+    assert (compositions.sum(axis=1) == 400).all()
+    probabilities = hrcor.HighResMetaboliteCorrector._get_multinomial_probabilities(compositions, [0.99757, 0.00038, 0.00205])
+    assert np.isfinite(probabilities).all()
+    np.testing.assert_allclose(probabilities.sum(), 1., rtol=1e-12)
+
+
+@pytest.mark.parametrize("mass_engine", ["fixed", "decimal"])
+def test_peaks_pooling(mass_engine, usr_tolerance):
+    """Check the pooling of unresolved peaks against a scan of the full isotopic cluster."""
+    metabolite = hrcor.HighResMetaboliteCorrector("C5H10N2O3S", "13C", 2e4, 400,
+                                                  resolution_formula_code="orbitrap",
+                                                  derivative_formula="C3H9Si",
+                                                  tracer_purity=None,
+                                                  data_isotopes=None,
+                                                  correct_NA_tracer=False,
+                                                  mass_engine=mass_engine,
+                                                  charge=1)
+    cluster = metabolite.get_isotopic_cluster()
+    limit = metabolite.correction_limit
+    targets = metabolite.get_tracershifted_peaks_between(min(cluster), max(cluster))
+    # include targets just within and just beyond the correction limit of a peak
+    isolated_peak = max(cluster) + 5
+    cluster[isolated_peak] = 0.5
+    targets += [isolated_peak + D(limit) * D("0.999"), isolated_peak + 3 - D(limit) * D("1.001")]
+    expected = [sum(a for m, a in cluster.items() if abs(m - peak) <= limit) for peak in sorted(targets)]
+    pooled = metabolite.get_peaks_around(cluster, targets)
+    assert pooled[-2:] == [0.5, 0.]
+    np.testing.assert_allclose(pooled, expected, rtol=usr_tolerance)
+    # same result with float masses
+    float_cluster = {float(m): a for m, a in cluster.items()}
+    pooled = metabolite.get_peaks_around(float_cluster, [float(m) for m in targets])
+    np.testing.assert_allclose(pooled, expected, rtol=usr_tolerance)
+
+
+def explicit_correction_matrix(metabolite):
+    """Return the correction matrix computed from the explicit isotopic cluster of each column."""
+    n_tracers = metabolite.formula[metabolite._tracer_el]
+    data_tracer = metabolite.data_isotopes[metabolite._tracer_el]
+    n_isotopes = len(data_tracer["mass"])
+    cluster = metabolite.get_isotopic_cluster()
+    main_peaks = metabolite.get_tracershifted_peaks_between(
+        metabolite.molecular_weight, metabolite.molecular_weight + metabolite.mzshift_tracer * n_tracers + D(0.5))
+    matrix = np.zeros((n_tracers + 1, n_tracers + 1))
+    for n_traced_atoms in range(n_tracers + 1):
+        blocks = {"cluster_notracer": list(cluster.items())}
+        if n_traced_atoms:
+            blocks["purity_tracer"] = metabolite._get_block_n(data_tracer["mass"], metabolite.tracer_purity,
+                                                              n_traced_atoms, n_isotopes)
+        if n_tracers - n_traced_atoms:
+            if metabolite.correct_NA_tracer:
+                blocks["NA_tracer"] = metabolite._get_block_n(data_tracer["mass"], data_tracer["abundance"],
+                                                              n_tracers - n_traced_atoms, n_isotopes)
+            else:
+                blocks["NA_tracer"] = metabolite._get_block_1(data_tracer["mass"][0], n_tracers - n_traced_atoms)
+        matrix[:, n_traced_atoms] = metabolite.get_peaks_around(metabolite._combine_blocks(blocks), main_peaks)
+    return matrix
+
+
+@pytest.mark.parametrize("correct_NA_tracer", [False, True])
+@pytest.mark.parametrize("formula, tracer, purity", [("C6H12O6", "18O", [0.01, 0.02, 0.97]),
+                                                     ("C5H11NO2S", "34S", [0.02, 0.01, 0.95, 0., 0.02]),
+                                                     ("C2H6O", "18O", [0., 0., 1.])])
+def test_incremental_columns(formula, tracer, purity, correct_NA_tracer):
+    """Check the incremental construction of correction matrices (tracers with more than 2 isotopes)
+    against the explicit computation of the isotopic cluster of each column."""
+    for mass_engine in ["fixed", "decimal"]:
+        metabolite = hrcor.HighResMetaboliteCorrector(formula, tracer, 7e4, 400,
+                                                      resolution_formula_code="orbitrap",
+                                                      derivative_formula="C3H9Si",
+                                                      tracer_purity=purity,
+                                                      data_isotopes=None,
+                                                      correct_NA_tracer=correct_NA_tracer,
+                                                      mass_engine=mass_engine,
+                                                      charge=1)
+        np.testing.assert_allclose(metabolite.compute_correction_matrix(),
+                                   explicit_correction_matrix(metabolite), rtol=1e-12, atol=1e-300)
@@ -42,3 +42,29 @@ def test_isoclust_against_bruteforce(formula, data_iso, usr_tolerance):
     assert len(ic_bruteforce) == len(ic_optimized)
     # Finally, check each abundance
     np.testing.assert_allclose(ic_bruteforce, ic_optimized, rtol=usr_tolerance)
+
+
+@pytest.mark.parametrize("n_atoms", [0, 1, 2, 3, 7, 16, 61])
+def test_distribution_power(n_atoms, data_iso, usr_tolerance):
+    """Check the distribution of n atoms computed by repeated squaring against n convolutions."""
+    abundances = data_iso["O"]["abundance"]
+    expected = get_isoclust_bruteforce({"O": n_atoms}, data_iso)
+    result = hrcor.LowResMetaboliteCorrector._get_distribution_power(abundances, n_atoms)
+    assert len(result) == len(expected)
+    np.testing.assert_allclose(result, expected, rtol=usr_tolerance, atol=1e-300)
+
+
+def test_trimmed_isoclust(data_iso):
+    """Trailing peaks below the probability threshold are removed, others are kept unchanged."""
+    metabolite = hrcor.LowResMetaboliteCorrector("C2H60O20", '13C',
+                                                 data_isotopes=data_iso,
+                                                 derivative_formula=None,
+                                                 tracer_purity=None,
+                                                 correct_NA_tracer=False)
+    ic_full = metabolite.get_mass_distribution_vector()
+    metabolite.threshold_p = 1e-8
+    ic_trimmed = metabolite.get_mass_distribution_vector()
+    assert len(ic_trimmed) < len(ic_full)
+    assert ic_trimmed[-1] > 1e-8
+    assert max(ic_full[len(ic_trimmed):]) <= 1e-8
+    np.testing.assert_allclose(ic_trimmed, ic_full[:len(ic_trimmed)], atol=1e-6)
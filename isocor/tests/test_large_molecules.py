@@ -0,0 +1,100 @@
+"""Test the construction of high-resolution correction matrices for large molecules.
+
+The benchmark checks the documented target: the correction matrix of C200H400N50O80S5
+is built in less than 5 seconds with less than 200 MB of memory, with the default
+settings or with limits on the size of isotopic clusters (and no probability threshold).
+It depends on the machine, hence it only runs if the environment variable
+ISOCOR_BENCHMARK is set.
+"""
+
+import time
+import tracemalloc
+import numpy as np
+import pytest
+import isocor as hrcor
+
+TIME_TARGET = 5.  # seconds
+MEMORY_TARGET = 200e6  # bytes
+
+
+def get_large_corrector(tracer, **kwargs):
+    return hrcor.HighResMetaboliteCorrector("C200H400N50O80S5", tracer, 1e5, 400,
+                                            resolution_formula_code="orbitrap",
+                                            derivative_formula="",
+                                            tracer_purity=None,
+                                            data_isotopes=None,
+                                            correct_NA_tracer=True,
+                                            charge=1,
+                                            **kwargs)
+
+
+LARGE_SETTINGS = [{}, {"threshold_p": None, "max_heavy_isotopes": 20, "max_cluster_size": 10000}]
+LARGE_TRACERS = {"13C": 200, "15N": 50, "2H": 400, "34S": 5, "18O": 80}
+
+
+@pytest.mark.parametrize("settings", LARGE_SETTINGS)
+@pytest.mark.parametrize("tracer", sorted(LARGE_TRACERS))
+def test_large_molecule(tracer, settings):
+    """The correction matrix of a large molecule has one column per isotopologue,
+    and valid probabilities."""
+    corrector = get_large_corrector(tracer, **settings)
+    matrix = corrector.compute_correction_matrix()
+    n_isotopologues = LARGE_TRACERS[tracer] + 1
+    assert matrix.shape == (n_isotopologues, n_isotopologues)
+    assert np.isfinite(matrix).all()
+    assert (matrix >= 0).all() and (np.diag(matrix) > 0).all()
+    assert (matrix.sum(axis=0) <= 1. + 1e-12).all()
+    assert corrector.discarded_p < 1e-6
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("settings", LARGE_SETTINGS)
+@pytest.mark.parametrize("tracer", sorted(LARGE_TRACERS))
+def test_large_molecule_benchmark(tracer, settings):
+    """Check time and memory needed to build the correction matrix of a large molecule."""
+    start = time.perf_counter()
+    get_large_corrector(tracer, **settings).compute_correction_matrix()
+    elapsed = time.perf_counter() - start
+    # measure memory in a second run (tracing allocations slows down computations)
+    tracemalloc.start()
+    try:
+        get_large_corrector(tracer, **settings).compute_correction_matrix()
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert elapsed < TIME_TARGET
+    assert peak_memory < MEMORY_TARGET
+
+
+@pytest.mark.parametrize("limits", [{"max_heavy_isotopes": 2},
+                                    {"max_cluster_size": 50},
+                                    {"max_heavy_isotopes": 3, "max_cluster_size": 200}])
+@pytest.mark.parametrize("tracer", ["13C", "18O"])
+def test_cluster_limits(tracer, limits):
+    """Check that limits on the size of isotopic clusters only neglect the probability reported."""
+    kwargs = {"resolution_formula_code": "orbitrap", "derivative_formula": "C3H9Si",
+              "tracer_purity": None, "data_isotopes": None, "correct_NA_tracer": True,
+              "threshold_p": None, "charge": 1}
+    full = hrcor.HighResMetaboliteCorrector("C6H12N2O6S", tracer, 7e4, 400, **kwargs)
+    limited = hrcor.HighResMetaboliteCorrector("C6H12N2O6S", tracer, 7e4, 400, **kwargs, **limits)
+    cluster = limited.get_isotopic_cluster()
+    if "max_cluster_size" in limits:
+        assert len(cluster) <= limits["max_cluster_size"]
+    assert len(cluster) < len(full.get_isotopic_cluster())
+    assert 0. < limited.discarded_p < 0.1
+    matrix_full = full.compute_correction_matrix()
+    matrix_limited = limited.compute_correction_matrix()
+    assert limited.discarded_p > 0.
+    assert (matrix_limited <= matrix_full + 1e-15).all()
+    np.testing.assert_allclose(matrix_limited, matrix_full, atol=limited.discarded_p)
+
+
+@pytest.mark.parametrize("limits", [{"max_heavy_isotopes": -1},
+                                    {"max_cluster_size": 0},
+                                    {"max_cluster_size": 1.5},
+                                    {"max_heavy_isotopes": 10, "mass_engine": "decimal"}])
+def test_bad_cluster_limits(limits):
+    """Check that invalid limits on the size of isotopic clusters are rejected."""
+    with pytest.raises(ValueError):
+        hrcor.MetaboliteCorrectorFactory("C6H12O6", "13C", resolution=7e4, mz_of_resolution=400,
+                                         charge=1, **limits)
@@ -0,0 +1,187 @@
+"""Test the correction of experiments with several isotopic tracers.
+
+The correction matrix is the Kronecker product of the correction matrices of each
+tracer, which is checked against the dense matrix.
+"""
+
+import numpy as np
+import pytest
+from scipy.optimize import nnls
+import isocor as hrcor
+from isocor.solvers import kronecker_dot, KroneckerLeastSquares, KroneckerNNLS
+
+
+@pytest.fixture
+def metabolite(data_iso):
+    """Dual-labeled (13C and 15N) metabolite."""
+    return hrcor.MetaboliteCorrectorFactory("C3H7NO2", "13C,15N", data_isotopes=data_iso,
+                                            derivative_formula="C2H6N", correct_NA_tracer=True,
+                                            tracer_purity={"13C": [0.05, 0.95]})
+
+
+@pytest.mark.parametrize("tracers", ["13C,15N", "13C, 15N", ["13C", "15N"]])
+def test_multi_tracer_factory(tracers, data_iso):
+    """The factory returns a multi-tracer corrector for several tracers."""
+    metabolite = hrcor.MetaboliteCorrectorFactory("C3H7NO2", tracers, data_isotopes=data_iso)
+    assert isinstance(metabolite, hrcor.MultiTracerMetaboliteCorrector)
+    assert metabolite.tracers == ("13C", "15N")
+    assert metabolite.shape == (4, 2)
+
+
+@pytest.mark.parametrize("tracers, kwargs", [("13C,13C", {}),
+                                             ("13C,2H", {}),
+                                             ("13C,", {}),
+                                             ("13C,15N", {"tracer_purity": {"2H": [0., 1.]}}),
+                                             ("13C,15N", {"tracer_purity": {"15N": [1.]}})])
+def test_bad_multi_tracer(tracers, kwargs, data_iso):
+    """Duplicated or absent tracers and invalid purities raise an error."""
+    with pytest.raises(ValueError):
+        hrcor.MetaboliteCorrectorFactory("C3NO2", tracers, data_isotopes=data_iso, **kwargs)
+
+
+@pytest.mark.parametrize("kwargs", [{"resolution": 1e4, "mz_of_resolution": 400, "charge": 1},
+                                    {"mz_of_resolution": 400},
+                                    {"resolution_formula_code": "constant"},
+                                    {"max_cluster_size": 100}])
+def test_multi_tracer_high_resolution(kwargs, data_iso):
+    """High-resolution parameters are not silently ignored with several tracers."""
+    with pytest.raises(ValueError, match="not supported with several tracers"):
+        hrcor.MetaboliteCorrectorFactory("C3H7NO2", "13C,15N", data_isotopes=data_iso, **kwargs)
+
+
+def test_singular_factor(data_iso):
+    """Unconstrained solutions are not used if a factor is singular."""
+    factors = [np.array([[1., 1.], [1., 1.]]), np.eye(2)]
+    solver = KroneckerLeastSquares(factors)
+    assert not solver.well_conditioned
+    corrected, is_fast = solver.solve_many(np.ones((3, 4)))
+    assert corrected.shape == (3, 4) and not is_fast.any()
+    kwargs = {"data_isotopes": data_iso, "tracer_purity": {"13C": [0.6, 0.4]}, "correct_NA_tracer": True}
+    metabolite = hrcor.MetaboliteCorrectorFactory("C30H16N5O13P3", "13C,15N", **kwargs)
+    reference = hrcor.MetaboliteCorrectorFactory("C30H16N5O13P3", "13C,15N", fast_path=False, **kwargs)
+    matrix = np.asarray(metabolite.correction_matrix)
+    measurement = np.dot(matrix, np.random.RandomState(0).rand(matrix.shape[1]))
+    result = metabolite.correct(measurement, return_path=True)
+    assert result[4] == "bfgs"
+    assert np.isfinite(result[1]).all()
+    np.testing.assert_allclose(result[0], reference.correct(measurement)[0])
+
+
+def test_kronecker_factors(metabolite, data_iso):
+    """The factors are the correction matrices of each tracer element, and their Kronecker
+    product is the dense correction matrix."""
+    carbon = hrcor.LowResMetaboliteCorrector("C3", "13C", data_isotopes=data_iso,
+                                             derivative_formula="C2",
+                                             tracer_purity=[0.05, 0.95],
+                                             correct_NA_tracer=True)
+    nitrogen = hrcor.LowResMetaboliteCorrector("N", "15N", data_isotopes=data_iso,
+                                               derivative_formula="N",
+                                               tracer_purity=None,
+                                               correct_NA_tracer=True)
+    factors = metabolite.factors
+    np.testing.assert_allclose(factors[0], carbon.correction_matrix)
+    np.testing.assert_allclose(factors[1], nitrogen.correction_matrix)
+    # H and O are not traced
+    assert metabolite.nontracer_abundance == pytest.approx(0.8**13 * 0.6**2)
+    np.testing.assert_allclose(metabolite.correction_matrix,
+                               np.kron(factors[0], factors[1]) * metabolite.nontracer_abundance)
+    v = np.random.RandomState(0).rand(5, 8)
+    np.testing.assert_allclose(kronecker_dot(factors, v) * metabolite.nontracer_abundance,
+                               np.dot(v, metabolite.correction_matrix.T))
+
+
+def test_nontracer_abundance():
+    """The natural abundance of the elements which are not traced (including those of the
+    derivative) is corrected as by a high-resolution corrector at ultra-high resolution."""
+    metabolite = hrcor.MultiTracerMetaboliteCorrector("C3H7NO2", ["13C"], derivative_formula="C2H6Si",
+                                                      correct_NA_tracer=True, data_isotopes=None)
+    reference = hrcor.MetaboliteCorrectorFactory("C3H7NO2", "13C", derivative_formula="C2H6Si",
+                                                 correct_NA_tracer=True, resolution=1e7,
+                                                 mz_of_resolution=400, charge=1)
+    assert metabolite.nontracer_abundance < 0.95
+    np.testing.assert_allclose(metabolite.correction_matrix, reference.correction_matrix, atol=1e-6)
+
+
+def test_kronecker_least_squares():
+    """The unconstrained solution computed with the factors is the one of the dense matrix."""
+    rng = np.random.RandomState(1)
+    factors = [np.tril(rng.rand(n, n)) + np.eye(n) for n in (3, 4, 2)]
+    v_mes = rng.rand(6, 24)
+    x, _ = KroneckerLeastSquares(factors).solve_many(v_mes)
+    dense = np.kron(np.kron(factors[0], factors[1]), factors[2])
+    np.testing.assert_allclose(x, np.linalg.lstsq(dense, v_mes.T, rcond=None)[0].T, atol=1e-10)
+
+
+def test_kronecker_nnls():
+    """The NNLS solution computed with the factors is the one of the dense matrix."""
+    rng = np.random.RandomState(3)
+    factors = [np.tril(rng.rand(n, n)) + np.eye(n) for n in (3, 4, 2)]
+    dense = np.kron(np.kron(factors[0], factors[1]), factors[2])
+    x = rng.rand(20, 24)
+    x[:, rng.rand(24) < 0.5] = 0.
+    v_mes = np.dot(x, dense.T) + rng.randn(20, 24) * 0.05
+    solver = KroneckerNNLS(factors)
+    reference = np.array([nnls(dense, v)[0] for v in v_mes])
+    np.testing.assert_allclose(solver.solve_many(v_mes), reference, atol=1e-10)
+    np.testing.assert_allclose(solver.solve(v_mes[0]), reference[0], atol=1e-10)
+    assert solver.solve_many(np.zeros((0, 24))).shape == (0, 24)
+
+
+@pytest.mark.parametrize("fast_path", [False, True])
+def test_multi_tracer_solvers(fast_path, data_iso):
+    """Correctors return the same results with the "bfgs" and "nnls" solvers."""
+    kwargs = {"data_isotopes": data_iso, "derivative_formula": "C2H6N", "fast_path": fast_path,
+              "correct_NA_tracer": True, "tracer_purity": {"13C": [0.05, 0.95]}}
+    bfgs = hrcor.MetaboliteCorrectorFactory("C3H7NO2", "13C,15N", solver="bfgs", **kwargs)
+    nnls_corrector = hrcor.MetaboliteCorrectorFactory("C3H7NO2", "13C,15N", solver="nnls", **kwargs)
+    measurements = np.random.RandomState(4).rand(10, 8)
+    results = nnls_corrector.correct_many(measurements)
+    for result, reference in zip(results, bfgs.correct_many(measurements)):
+        np.testing.assert_allclose(result, reference, atol=1e-6 * max(np.abs(reference).max(), 1.))
+    np.testing.assert_allclose(results[0], [nnls(nnls_corrector.correction_matrix, v)[0]
+                                            for v in measurements], atol=1e-10)
+
+
+def test_multi_tracer_nnls_too_large():
+    """The "nnls" solver is rejected for molecules with too many isotopologues."""
+    with pytest.raises(ValueError, match="bfgs"):
+        hrcor.MetaboliteCorrectorFactory("C60H100N20O20", "13C,15N", solver="nnls")
+    with pytest.raises(ValueError):
+        KroneckerNNLS([np.eye(61), np.eye(21)])
+
+
+def test_multi_tracer_correction(metabolite):
+    """Corrected distributions are recovered, and samples with a negative unconstrained
+    solution are solved as a NNLS problem."""
+    distribution = np.array([[0.4, 0.1, 0.05, 0.05, 0.1, 0.1, 0.0, 0.2]])
+    measurements = np.vstack([np.dot(distribution, metabolite.correction_matrix.T),
+                              [[1., 0., 0., 0., 0., 0., 0., 0.5]]])
+    corrected_area, fraction, residuum, enrichment, paths = metabolite.correct_many(
+        measurements, return_paths=True)
+    assert list(paths) == ["fast", "bfgs"]
+    np.testing.assert_allclose(fraction[0], distribution[0], atol=1e-12)
+    np.testing.assert_allclose(corrected_area[1], nnls(metabolite.correction_matrix,
+                                                      measurements[1])[0], atol=1e-6)
+    np.testing.assert_allclose(residuum[0], 0., atol=1e-12)
+    # mean enrichment of each tracer, from the marginal distributions
+    marginals = distribution.reshape(4, 2)
+    np.testing.assert_allclose(enrichment[0], [np.dot(marginals.sum(1), np.arange(4)) / 3,
+                                               marginals.sum(0)[1]])
+    # a single sample, given as a tensor
+    result = metabolite.correct(measurements[0].reshape(metabolite.shape), return_path=True)
+    np.testing.assert_allclose(result[1], fraction[0], atol=1e-12)
+    assert result[4] == "fast"
+    with pytest.raises(ValueError):
+        metabolite.correct_many(measurements[:, :7])
+
+
+def test_multi_tracer_large():
+    """Large multi-labeled molecules are corrected without forming the dense matrix."""
+    metabolite = hrcor.MetaboliteCorrectorFactory("C60H100N20O20", "13C,15N,2H",
+                                                  correct_NA_tracer=True)
+    assert metabolite.shape == (61, 21, 101)
+    distribution = np.random.RandomState(2).rand(2, 61 * 21 * 101)
+    measurements = kronecker_dot(metabolite.factors, distribution) * metabolite.nontracer_abundance
+    corrected_area, _, _, _, paths = metabolite.correct_many(measurements, return_paths=True)
+    assert list(paths) == ["fast", "fast"]
+    np.testing.assert_allclose(corrected_area, distribution, rtol=1e-6)
@@ -0,0 +1,123 @@
+"""Test the parallel computation of correction matrices and corrections."""
+
+import collections
+import threading
+import time
+import numpy as np
+import pytest
+import isocor as hrcor
+from isocor.parallel import precompute_correction_matrices, estimate_cost, correct_series, correct_many
+
+
+def build_correctors(data_iso):
+    correctors = [hrcor.MetaboliteCorrectorFactory("C{}H{}O6P".format(n, 2 * n), "13C",
+                                                   data_isotopes=data_iso, resolution=1e4,
+                                                   mz_of_resolution=400, charge=1)
+                  for n in (3, 10, 6)]
+    correctors.append(hrcor.MetaboliteCorrectorFactory("C3H7NO2", "13C,15N", data_isotopes=data_iso))
+    correctors.append(hrcor.MetaboliteCorrectorFactory("C3H7O6P", "13C", data_isotopes=data_iso))
+    # same correction matrix as the first corrector
+    correctors.append(hrcor.MetaboliteCorrectorFactory("C3H6O6P", "13C", data_isotopes=data_iso,
+                                                       resolution=1e4, mz_of_resolution=400,
+                                                       charge=1, label="other"))
+    return correctors + [None]
+
+
+@pytest.mark.parametrize("jobs", [1, 2, np.int64(2)])
+def test_precompute_correction_matrices(jobs, data_iso, empty_cache):
+    """Matrices computed by the workers are the ones computed at first use, and are cached."""
+    expected = [corrector.correction_matrix for corrector in build_correctors(data_iso)[:-1]]
+    empty_cache.clear()
+    correctors = build_correctors(data_iso)
+    assert precompute_correction_matrices(correctors, jobs=jobs) == 6
+    assert len(empty_cache) == 6
+    for corrector, matrix in zip(correctors, expected):
+        assert corrector._correction_matrix is not None or \
+            isinstance(corrector, hrcor.MultiTracerMetaboliteCorrector)
+        np.testing.assert_allclose(corrector.correction_matrix, matrix, rtol=1e-12)
+    assert correctors[0].compact_correction_matrix is correctors[-2].compact_correction_matrix
+    # matrices are not computed again
+    assert precompute_correction_matrices(build_correctors(data_iso), jobs=jobs) == 0
+
+
+def test_estimate_cost(data_iso):
+    """Larger metabolites have a larger estimated cost."""
+    costs = [estimate_cost(corrector) for corrector in build_correctors(data_iso)[:3]]
+    assert costs[0] < costs[2] < costs[1]
+
+
+@pytest.mark.parametrize("jobs, backend", [(1, "process"), (2, "process"), (2, "thread")])
+def test_correct_series(jobs, backend, data_iso):
+    """Samples are corrected in the order of the tasks, errors are returned and
+    solver statistics are gathered."""
+    correctors = build_correctors(data_iso)[:5]
+    rng = np.random.RandomState(0)
+    tasks = [(corrector, [("s{}".format(i), rng.rand(corrector.correction_matrix.shape[0]))
+                          for i in range(n)])
+             for n, corrector in zip((3, 1, 4, 2, 2), correctors)]
+    tasks[4][1][1] = ("bad", [1., 2.])
+    expected = [[corrector.correct(measurement) for _, measurement in series[:4]]
+                for corrector, series in tasks[:4]]
+    for corrector in correctors:
+        corrector.solver_stats.clear()
+    results = correct_series(tasks, jobs=jobs, backend=backend)
+    assert [[sample for sample, _, _ in result] for result in results] == \
+        [[sample for sample, _ in series] for _, series in tasks]
+    for result, values in zip(results, expected):
+        for (_, corrected, err), value in zip(result, values):
+            assert err is None
+            np.testing.assert_allclose(corrected[0], value[0])
+            assert corrected[4] in ("fast", "bfgs")
+    assert results[4][1][1] is None and results[4][1][2]
+    assert sum(correctors[0].solver_stats.values()) == 3
+
+
+@pytest.mark.parametrize("jobs", [0, -1, 1.5, True, np.int64(0), np.float64(2.)])
+def test_bad_jobs(jobs):
+    """The number of jobs must be a positive integer."""
+    with pytest.raises(ValueError):
+        precompute_correction_matrices([], jobs=jobs)
+
+
+@pytest.mark.parametrize("backend, solver", [("thread", "bfgs"), ("thread", "nnls"), ("process", "bfgs")])
+def test_correct_many(backend, solver, data_iso):
+    """Chunks of samples corrected by several workers give the same results as a single batch."""
+    corrector = hrcor.MetaboliteCorrectorFactory("C10H20O6P", "13C", data_isotopes=data_iso,
+                                                 resolution=1e4, mz_of_resolution=400,
+                                                 charge=1, solver=solver)
+    rng = np.random.RandomState(1)
+    measurements = np.dot(corrector.correction_matrix, rng.rand(11, 50)).T
+    measurements[:5] = rng.rand(5, 11)
+    expected = corrector.correct_many(measurements, return_paths=True)
+    corrector.solver_stats.clear()
+    result = correct_many(corrector, measurements, jobs=3, backend=backend, return_paths=True)
+    assert len(result) == len(expected)
+    np.testing.assert_allclose(result[0], expected[0], atol=1e-6)
+    assert list(result[4]) == list(expected[4])
+    assert corrector.solver_stats == collections.Counter(expected[4])
+    with pytest.raises(NotImplementedError):
+        correct_many(corrector, measurements, jobs=3, backend="mpi")
+
+
+def test_concurrent_correction_matrix(data_iso, empty_cache, monkeypatch):
+    """Correction matrices accessed concurrently by several threads are computed once."""
+    correctors = [hrcor.MetaboliteCorrectorFactory("C10H20O6P", "13C", data_isotopes=data_iso,
+                                                   resolution=1e4, mz_of_resolution=400, charge=1)
+                  for _ in range(4)]
+    compute = hrcor.HighResMetaboliteCorrector.compute_correction_matrix
+    calls = []
+
+    def slow_compute(self):
+        calls.append(self)
+        time.sleep(0.05)
+        return compute(self)
+    monkeypatch.setattr(hrcor.HighResMetaboliteCorrector, "compute_correction_matrix", slow_compute)
+    threads = [threading.Thread(target=lambda corrector=corrector: corrector.correction_matrix)
+               for corrector in correctors]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert all(corrector.compact_correction_matrix is correctors[0].compact_correction_matrix
+               for corrector in correctors)
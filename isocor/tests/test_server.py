@@ -0,0 +1,155 @@
+"""Test the local correction server and its client."""
+
+import argparse
+import io
+import logging
+import threading
+import urllib.request
+from pathlib import Path
+import pandas as pd
+import pytest
+import isocor
+import isocor.ui.isocorcli as isocorcli
+import isocor.ui.isocorclient as isocorclient
+import isocor.ui.isocorserver as isocorserver
+
+DATA = Path(isocor.__file__).parent / "data"
+DATABASES = argparse.Namespace(M=str(DATA / "Metabolites.dat"), D=str(DATA / "Derivatives.dat"),
+                               I=str(DATA / "Isotopes.dat"))
+DATAFILE = DATA / "Data_example.tsv"
+
+
+def serve(server):
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+@pytest.fixture(scope="module")
+def server():
+    """Correction server listening on an ephemeral port."""
+    server = serve(isocorserver.CorrectionServer(("127.0.0.1", 0), DATABASES))
+    server.url = "http://127.0.0.1:{}".format(server.server_address[1])
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def expected_result(arguments):
+    """Results of the command line interface (without the server)."""
+    args = isocorcli.parseArgs().parse_args([str(DATAFILE)] + arguments)
+    df = isocorcli.correct(isocorcli.create_env(DATABASES), args, logging.getLogger("test"))
+    return df.to_csv(sep='\t')
+
+
+@pytest.mark.parametrize("arguments", [["-t", "13C"],
+                                       ["-t", "13C", "-r", "70000", "-m", "400", "-f", "orbitrap"],
+                                       ["-t", "13C", "-r", "70000", "-m", "400", "-f", "datafile", "-n"]])
+def test_correct_file(arguments, server):
+    """The server returns the results of the command line interface, and logs."""
+    response = isocorclient.submit_file(str(DATAFILE), arguments, url=server.url)
+    assert response["result"] == expected_result(arguments)
+    assert "Data_example.tsv" in response["log"]
+    assert "errors: 0" in response["log"]
+
+
+def test_correct_records(server):
+    """Measurements can be sent and received as JSON records."""
+    records = pd.read_csv(DATAFILE, delimiter='\t', keep_default_na=False).to_dict(orient="records")
+    response = isocorclient.submit(records, parameters={"tracer": "13C", "correct_NA_tracer": True},
+                                   result_format="json", url=server.url)
+    expected = pd.read_csv(io.StringIO(expected_result(["-t", "13C", "-n"])), delimiter='\t',
+                           keep_default_na=False)
+    result = pd.DataFrame(response["result"])
+    assert list(result.columns) == list(expected.columns)
+    assert len(result) == len(records)
+    pd.testing.assert_series_equal(result["corrected_area"], expected["corrected_area"])
+
+
+def test_null_derivatives(server):
+    """Null derivatives of JSON records are missing derivatives."""
+    records = pd.read_csv(DATAFILE, delimiter='\t', keep_default_na=False).to_dict(orient="records")
+    for record in records:
+        if not record["derivative"]:
+            record["derivative"] = None
+    response = isocorclient.submit(records, ["-t", "13C"], result_format="json", url=server.url)
+    assert "errors: 0" in response["log"]
+    result = pd.DataFrame(response["result"])
+    assert "None" not in set(result["derivative"])
+    expected = pd.read_csv(io.StringIO(expected_result(["-t", "13C"])), delimiter='\t',
+                           keep_default_na=False)
+    pd.testing.assert_series_equal(result["corrected_area"], expected["corrected_area"])
+
+
+def test_correct_tsv(server):
+    """Measurements files can be sent as is, with parameters in the query string."""
+    request = urllib.request.Request(server.url + "/correct?tracer=13C&correct_NA_tracer=1",
+                                     data=DATAFILE.read_bytes(),
+                                     headers={"Content-Type": "text/tab-separated-values"})
+    with urllib.request.urlopen(request) as response:
+        assert response.read().decode("utf-8") == expected_result(["-t", "13C", "-n"])
+
+
+def test_warm_correctors(server):
+    """Correctors (and their correction matrices) are reused by later requests."""
+    isocorclient.submit_file(str(DATAFILE), ["-t", "13C", "-p", "0.01,0.99"], url=server.url)
+    before = isocorclient.status(url=server.url)
+    isocorclient.submit_file(str(DATAFILE), ["-t", "13C", "-p", "0.01,0.99"], url=server.url)
+    after = isocorclient.status(url=server.url)
+    assert after["requests"] == before["requests"] + 1
+    assert after["correctors pool"]["misses"] == before["correctors pool"]["misses"]
+    assert after["correctors pool"]["hits"] == before["correctors pool"]["hits"] + 12
+
+
+def test_summary(server):
+    """Corrections are counted for each request, even if correctors are reused."""
+    arguments = ["-t", "13C", "-p", "0.02,0.98"]
+    logs = [isocorclient.submit_file(str(DATAFILE), arguments, url=server.url)["log"] for _ in range(2)]
+    summaries = [[line.split(" - ")[-1] for line in log.splitlines() if "corrections by path" in line]
+                 for log in logs]
+    assert len(summaries[0]) == 1
+    assert summaries[0] == summaries[1]
+
+
+@pytest.mark.parametrize("arguments, message", [(["-t", "13X"], "Can't find tracer"),
+                                                (["-t", "13C", "-M", "other.dat"], "Option 'M'"),
+                                                (["-t", "13C", "-j", "2"], "Option 'jobs'"),
+                                                (["-t", "13C", "--solver", "lsq"], "invalid choice"),
+                                                (["-h"], "wrong parameters"),
+                                                (["-t", "13C", "-r", "1e4"], "'mz_of_resolution' should be provided")])
+def test_bad_request(arguments, message, server):
+    """Errors are returned to the client, and the server goes on."""
+    with pytest.raises(ValueError, match=message):
+        isocorclient.submit_file(str(DATAFILE), arguments, url=server.url)
+    assert isocorclient.submit_file(str(DATAFILE), ["-t", "13C"], url=server.url)["result"]
+
+
+def test_bad_measurements(server):
+    """Invalid measurements are reported."""
+    with pytest.raises(ValueError, match="Column 'area' not found"):
+        isocorclient.submit([{"sample": "s1", "metabolite": "Fum", "derivative": "",
+                              "isotopologue": 0}], ["-t", "13C"], url=server.url)
+    with pytest.raises(ValueError, match="Unknown format"):
+        isocorclient.submit(DATAFILE.read_text(), ["-t", "13C"], result_format="xml", url=server.url)
+
+
+def test_unix_socket(tmp_path):
+    """The server can listen on a Unix socket."""
+    path = str(tmp_path / "isocor.sock")
+    server = serve(isocorserver.UnixCorrectionServer(path, DATABASES))
+    try:
+        response = isocorclient.submit_file(str(DATAFILE), ["-t", "13C"], socket_path=path)
+        assert response["result"] == expected_result(["-t", "13C"])
+        assert isocorclient.status(socket_path=path)["requests"] == 1
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert not Path(path).exists()
+
+
+def test_parameters_to_arguments():
+    """Correction parameters are converted to command line options."""
+    assert isocorserver.parameters_to_arguments(
+        {"tracer": "13C", "tracer_purity": [0.1, 0.9], "correct_NA_tracer": True,
+         "no_fast_path": False, "resolution": None, "r": 1e4}) == \
+        ["--tracer", "13C", "--tracer_purity", "0.1,0.9", "--correct_NA_tracer", "-r", "10000.0"]
@@ -0,0 +1,210 @@
+"""Test the solvers used to compute corrected areas.
+
+All solvers should converge to the solution of the non-negative least-squares
+problem, which is compared to the one returned by `scipy.optimize.nnls`.
+"""
+
+import numpy as np
+import pytest
+from scipy.optimize import nnls
+import isocor as hrcor
+from isocor.solvers import ActiveSetNNLS, UnconstrainedLeastSquares, BandedMatrix, compress_matrix
+from isocor.solvers import matrix_to_buffer, matrix_from_buffer
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_active_set_nnls_vs_scipy(seed):
+    """Exact active-set NNLS returns the same solution as scipy (with and without active constraints)."""
+    rng = np.random.RandomState(seed)
+    matrix = np.tril(rng.rand(8, 8)) + np.eye(8) * 0.1
+    solver = ActiveSetNNLS(matrix)
+    v_mes = rng.randn(20, 8)
+    solutions = solver.solve_many(v_mes)
+    for v, x in zip(v_mes, solutions):
+        np.testing.assert_allclose(x, nnls(matrix, v)[0], atol=1e-10)
+        assert np.all(x >= 0)
+
+
+@pytest.mark.parametrize("banded", [False, True])
+def test_active_set_nnls_singular(banded):
+    """A singular correction matrix is solved in the least-squares sense."""
+    matrix = np.array([[1., 0.], [0., 0.]])
+    solver = ActiveSetNNLS(BandedMatrix.from_dense(matrix) if banded else matrix)
+    np.testing.assert_allclose(solver.solve(np.array([2., 1.])), [2., 0.], atol=1e-12)
+    np.testing.assert_allclose(solver.solve_many(np.array([[2., 1.], [3., 0.]])), [[2., 0.], [3., 0.]],
+                               atol=1e-12)
+
+
+@pytest.mark.parametrize("banded", [False, True])
+def test_active_set_nnls_batch(banded):
+    """Samples of a batch (solved by groups sharing a passive set) have the same solutions as with scipy."""
+    rng = np.random.RandomState(0)
+    dense = np.tril(np.triu(rng.rand(12, 12) + np.eye(12), -2), 1)
+    x = rng.rand(300, 12)
+    x[:, [1, 4, 5, 9]] = 0.
+    v_mes = np.dot(x, dense.T) + rng.randn(300, 12) * 0.01
+    solver = ActiveSetNNLS(BandedMatrix.from_dense(dense) if banded else dense)
+    solutions = solver.solve_many(v_mes)
+    np.testing.assert_allclose(solutions, [nnls(dense, v)[0] for v in v_mes], atol=1e-10)
+    # factorizations of the passive sets are cached
+    assert 1 < len(solver._factorizations) <= solver.MAX_FACTORIZATIONS
+    assert solver.solve_many(v_mes[:0]).shape == (0, 12)
+
+
+@pytest.mark.parametrize("resolution", [None, 1e4])
+def test_solvers_give_same_correction(resolution, data_iso):
+    """Correctors return the same results with the "bfgs" and "nnls" solvers."""
+    kwargs = {"resolution": resolution, "mz_of_resolution": 400, "charge": 1} if resolution else {}
+    measurements = np.array([[0.5, 0.2, 0.2, 0.1],
+                             [0.9, 0.05, 0.03, 0.02],
+                             [12., 0., 3., 1.]])
+    results = {}
+    for solver in ["bfgs", "nnls"]:
+        metabolite = hrcor.MetaboliteCorrectorFactory("C3H7O6P", "13C", data_isotopes=data_iso,
+                                                      derivative_formula="H2O", correct_NA_tracer=True,
+                                                      solver=solver, **kwargs)
+        assert metabolite.solver == solver
+        results[solver] = [metabolite.correct(v)[1] for v in measurements]
+        np.testing.assert_allclose(metabolite.correct_many(measurements)[1], results[solver], atol=1e-6)
+    np.testing.assert_allclose(results["bfgs"], results["nnls"], atol=1e-6)
+
+
+def test_unknown_solver(data_iso):
+    """An error is raised for an unknown solver code."""
+    with pytest.raises(NotImplementedError):
+        hrcor.MetaboliteCorrectorFactory("C3H7O6P", "13C", data_isotopes=data_iso, solver="simplex")
+
+
+@pytest.mark.parametrize("solver", ["bfgs", "nnls"])
+def test_fast_path(solver, data_iso):
+    """Samples with a non-negative unconstrained solution are corrected by the fast path.
+
+    The other samples fall back to the solver, and are corrected as without fast path.
+    """
+    metabolite = hrcor.MetaboliteCorrectorFactory("C3H7O6P", "13C", data_isotopes=data_iso,
+                                                  correct_NA_tracer=True, solver=solver)
+    # first sample is simulated from a known distribution, others are not consistent
+    measurements = np.array([np.dot(metabolite.correction_matrix, [0.5, 0.3, 0.15, 0.05]),
+                             [1., 0., 0., 0.],
+                             [0.9, 0.05, 0.03, 0.02]])
+    reference = hrcor.MetaboliteCorrectorFactory("C3H7O6P", "13C", data_isotopes=data_iso,
+                                                 correct_NA_tracer=True, solver=solver,
+                                                 fast_path=False)
+    assert metabolite.fast_path and not reference.fast_path
+    results = metabolite.correct_many(measurements, return_paths=True)
+    expected = reference.correct_many(measurements, return_paths=True)
+    assert list(results[4]) == ["fast", solver, solver]
+    assert list(expected[4]) == [solver] * 3
+    np.testing.assert_allclose(results[1][0], [0.5, 0.3, 0.15, 0.05], atol=1e-12)
+    np.testing.assert_allclose(results[1][1:], expected[1][1:], atol=1e-6)
+    # path of a single sample
+    assert metabolite.correct(measurements[0], return_path=True)[4] == "fast"
+    assert len(metabolite.correct(measurements[0])) == 4
+    assert metabolite.solver_stats == {"fast": 3, solver: 2}
+
+
+def test_fast_path_ill_conditioned():
+    """Unconstrained solutions are not used with singular or ill-conditioned matrices."""
+    singular = np.array([[1., 1., 0.], [1., 1., 0.], [0., 0., 1.]])
+    v_mes = np.array([[1., 1., 0.5], [2., 2., 1.]])
+    for matrix in (singular, BandedMatrix.from_dense(singular), singular + np.eye(3) * 1e-12):
+        solver = UnconstrainedLeastSquares(matrix)
+        assert not solver.well_conditioned
+        assert not solver.solve_many(v_mes)[1].any()
+
+
+def test_fast_path_degenerate_purity():
+    """A degenerate tracer purity (singular correction matrix) falls back to the solver."""
+    metabolite = hrcor.MetaboliteCorrectorFactory("C30H16N5O13P3", "13C", tracer_purity=[0.6, 0.4],
+                                                  correct_NA_tracer=True)
+    reference = hrcor.MetaboliteCorrectorFactory("C30H16N5O13P3", "13C", tracer_purity=[0.6, 0.4],
+                                                 correct_NA_tracer=True, fast_path=False)
+    measurement = np.dot(metabolite.correction_matrix, np.random.RandomState(0).rand(31))
+    result = metabolite.correct(measurement, return_path=True)
+    expected = reference.correct(measurement)
+    assert result[4] == "bfgs"
+    assert np.isfinite(result[1]).all() and result[0].sum() > 0
+    np.testing.assert_allclose(result[0], expected[0])
+
+
+def test_fast_path_small_components():
+    """Small (but significant) components of unconstrained solutions are kept."""
+    matrix = np.eye(5) + np.diag([0.5] * 4, -1)
+    x = np.array([1., 1e-9, 0.5, 1e-12, 0.])
+    corrected, is_fast = UnconstrainedLeastSquares(matrix).solve_many(np.dot(matrix, x)[np.newaxis])
+    assert is_fast.all()
+    np.testing.assert_allclose(corrected[0], x, rtol=1e-6, atol=1e-15)
+    assert corrected[0, 4] == 0.
+
+
+@pytest.mark.parametrize("lower, upper", [(0, 0), (2, 0), (3, 1), (0, 4)])
+def test_banded_matrix(lower, upper):
+    """Banded matrices have the same products and solutions as the dense ones."""
+    rng = np.random.RandomState(lower + upper)
+    n = 12
+    dense = np.tril(np.triu(rng.rand(n, n) + np.eye(n), -lower), upper)
+    banded = compress_matrix(dense)
+    assert isinstance(banded, BandedMatrix)
+    assert (banded.lower, banded.upper) == (lower, upper)
+    np.testing.assert_array_equal(banded.toarray(), dense)
+    np.testing.assert_array_equal(banded.transpose().toarray(), dense.T)
+    np.testing.assert_allclose(banded.gram().toarray(), np.dot(dense.T, dense), atol=1e-12)
+    v = rng.randn(n, 3)
+    np.testing.assert_allclose(banded.dot(v), np.dot(dense, v), atol=1e-12)
+    np.testing.assert_allclose(banded.dot(v[:, 0]), np.dot(dense, v[:, 0]), atol=1e-12)
+    # solvers
+    v_mes = rng.randn(20, n)
+    np.testing.assert_allclose(UnconstrainedLeastSquares(banded).solve_many(v_mes)[0],
+                               UnconstrainedLeastSquares(dense).solve_many(v_mes)[0], atol=1e-10)
+    np.testing.assert_allclose(ActiveSetNNLS(banded).solve_many(v_mes),
+                               ActiveSetNNLS(dense).solve_many(v_mes), atol=1e-10)
+
+
+def test_compress_matrix():
+    """Matrices with a wide band are kept dense, and negligible entries are neglected."""
+    dense = np.tril(np.ones((6, 6)))
+    assert compress_matrix(dense) is dense
+    dense = np.eye(6)
+    dense[5, 0] = 1e-20
+    banded = compress_matrix(dense)
+    assert (banded.lower, banded.upper) == (0, 0)
+    assert BandedMatrix.from_dense(dense).lower == 5
+
+
+def test_matrix_buffer():
+    """Dense and banded matrices are restored (read-only) from their raw buffer."""
+    dense = np.tril(np.triu(np.arange(36.).reshape(6, 6), -2), 1)
+    for matrix in (dense, BandedMatrix.from_dense(dense)):
+        restored = matrix_from_buffer(matrix_to_buffer(matrix))
+        assert type(restored) is type(matrix)
+        np.testing.assert_array_equal(np.asarray(restored), dense)
+        assert not getattr(restored, "bands", restored).flags.writeable
+
+
+def test_banded_gram_wide_band():
+    """The Gram matrix of a matrix whose band is wider than the matrix is computed."""
+    for dense in (np.tril(np.ones((6, 6))), np.tril(np.ones((6, 6))) + np.triu(np.ones((6, 6)), 1) * 0.5):
+        banded = BandedMatrix.from_dense(dense)
+        gram = banded.gram()
+        assert gram.lower == gram.upper == 5
+        np.testing.assert_allclose(gram.toarray(), np.dot(dense.T, dense), atol=1e-12)
+        np.testing.assert_allclose(ActiveSetNNLS(banded).solve_many(np.eye(6)),
+                                   ActiveSetNNLS(dense).solve_many(np.eye(6)), atol=1e-10)
+
+
+@pytest.mark.parametrize("solver", ["bfgs", "nnls"])
+def test_banded_correction(solver):
+    """Correctors with a banded correction matrix return the same results as with the dense matrix."""
+    metabolite = hrcor.MetaboliteCorrectorFactory("C40H60N5O10", "13C", solver=solver,
+                                                  tracer_purity=[0.01, 0.99],
+                                                  resolution=7e4, mz_of_resolution=400, charge=1)
+    assert isinstance(metabolite.compact_correction_matrix, BandedMatrix)
+    dense = metabolite.correction_matrix
+    rng = np.random.RandomState(0)
+    measurements = np.vstack([np.dot(rng.rand(2, 41), dense.T), rng.rand(2, 41)])
+    measurements[2:, 10:] = 0.
+    corrected_area, _, residuum, _, paths = metabolite.correct_many(measurements, return_paths=True)
+    assert list(paths) == ["fast", "fast", solver, solver]
+    for v, x, r in zip(measurements, corrected_area, residuum):
+        np.testing.assert_allclose(x, nnls(dense, v)[0], atol=1e-6)
+        np.testing.assert_allclose(r * v.sum(), v - np.dot(dense, x), atol=1e-12)
@@ -1,6 +1,9 @@
 import argparse
 import isocor as hr
 import isocor.ui.isocordb
+import isocor.cache
+import isocor.parallel
+import numpy as np
 import pandas as pd
 import io
 import logging
@@ -8,22 +11,12 @@ from pathlib import Path
 import sys
 
 
-def process(args):
-    # create logger (should be root to catch all 'mscorrectors' loggers)
-    logger = logging.getLogger()
-    formatter = logging.Formatter(
-        '%(asctime)s - %(name)s - %(levelname)s - %(message)s', "%Y-%m-%d %H:%M:%S")
-    # sends logging output to sys.stderr
-    strm_hdlr = logging.StreamHandler()
-    strm_hdlr.setFormatter(formatter)
-    logger.addHandler(strm_hdlr)
+class CorrectorConstructionError(ValueError):
+    """Raised when a (metabolite, derivative) corrector cannot be constructed."""
 
-    if hasattr(args, 'verbose'):
-        logger.setLevel(logging.DEBUG)
-    else:
-        logger.setLevel(logging.INFO)
 
-    # create environment
+def create_env(args):
+    """Return the environment with the databases (and matrices store) given in the arguments."""
     baseenv = isocor.ui.isocordb.EnvComputing()
     if hasattr(args, 'I'):
         baseenv.registerIsopotes(Path(args.I))
@@ -37,10 +30,29 @@ def process(args):
         baseenv.registerMetabolitesDB(Path(args.M))
     else:
         baseenv.registerMetabolitesDB()
+    if hasattr(args, 'matrix_store'):
+        baseenv.registerMatrixStore(args.matrix_store or None)
+    return baseenv
+
 
+def correct(baseenv, args, logger, measurements=None, factory=hr.MetaboliteCorrectorFactory):
+    """Correct measurements with the parameters given in the arguments.
+
+    Args:
+        baseenv (EnvComputing): environment with the databases registered
+        args (argparse.Namespace): correction parameters (see :py:func:`parseArgs`)
+        logger (logging.Logger): logger of the correction process
+        measurements (pandas.DataFrame): measurements (default: read from args.inputdata)
+        factory: callable returning the corrector of each (metabolite, derivative),
+            e.g. a :py:class:`~isocor.mscorrectors.CorrectorPool`
+
+    Returns:
+        pandas.DataFrame: corrected measurements
+    """
     try:
         # get correction parameters
-        data_isotopes = baseenv.dictIsotopes
+        # isotopic data are checked once for all correctors
+        data_isotopes = hr.IsotopeTable(baseenv.dictIsotopes)
         tracer = args.tracer
         if not(tracer in baseenv.dfIsotopes['name'].unique()):
             raise ValueError(
@@ -52,6 +64,16 @@ def process(args):
                     "Purity values ({}) should be within the range [0, 1], and their sum should be 1.".format(tracer_purity))
         correct_NA_tracer = True if hasattr(
             args, 'correct_NA_tracer') else False
+        solver = getattr(args, 'solver', 'bfgs')
+        fast_path = False if hasattr(args, 'no_fast_path') else True
+        threshold_p = getattr(args, 'threshold_p', 'auto')
+        jobs = getattr(args, 'jobs', 1)
+        if jobs is not None and jobs < 1:
+            raise ValueError(
+                "Number of jobs '{}' should be a positive integer.".format(jobs))
+        if threshold_p != 'auto' and not 0 <= threshold_p <= 1:
+            raise ValueError(
+                "Probability threshold '{}' should be within the range [0, 1].".format(threshold_p))
         resolution = getattr(args, 'resolution', None)
         mz_of_resolution = getattr(args, 'mz_of_resolution', None)
         resolution_formula_code = getattr(
@@ -78,7 +100,10 @@ def process(args):
                 raise ValueError(
                     "mz at which resolution is measured '{}' should be a positive number.".format(mz_of_resolution))
 
-        baseenv.registerDatafile(Path(args.inputdata), useformula)
+        if measurements is None:
+            baseenv.registerDatafile(Path(args.inputdata), useformula)
+        else:
+            baseenv.registerMeasurements(measurements, useformula, getattr(args, 'inputdata', 'measurements'))
     except Exception as err:
         logger.error(
             "wrong parameters. Check for errors above. {}".format(err))
@@ -89,7 +114,7 @@ def process(args):
     logger.info("Correction process")
     logger.info('------------------------------------------------')
     logger.info("   data files")
-    logger.info("      data file: {}".format(args.inputdata))
+    logger.info("      data file: {}".format(getattr(args, 'inputdata', 'measurements')))
     logger.info("      derivatives database: {}".format(
         getattr(args, 'D', 'Derivatives.dat')))
     logger.info("      metabolites database: {}".format(
@@ -101,6 +126,8 @@ def process(args):
     logger.info("      correct natural abundance of the tracer element: {}".format(
         correct_NA_tracer))
     logger.info("      isotopic purity of the tracer: {}".format(tracer_purity))
+    logger.info("      solver: {} (fast path: {})".format(solver, fast_path))
+    logger.info("      probability threshold: {}".format(threshold_p))
     if HRmode:
         logger.info("      mode: high-resolution")
         logger.info("         formula code: {}".format(
@@ -112,6 +139,9 @@ def process(args):
             logger.info("         at mz: {}".format(mz_of_resolution))
     else:
         logger.info("      mode: low-resolution")
+    if hasattr(args, 'matrix_store'):
+        logger.info("   correction matrices store: {}".format(isocor.cache.correction_matrix_store.path))
+    logger.info("   parallel jobs: {}".format(jobs or "all processors"))
     logger.info("   natural abundance of isotopes")
     logger.info("   {}".format(data_isotopes))
     logger.info("   IsoCor version: {}".format(hr.__version__))
@@ -131,61 +161,87 @@ def process(args):
                 if not useformula:
                     resolution = label[2]
                     resolution_formula_code = 'constant'
-                dictMetabolites[label] = hr.MetaboliteCorrectorFactory(
+                dictMetabolites[label] = factory(
                     formula=baseenv.getMetaboliteFormula(label[0]), tracer=tracer, resolution=resolution, label=label[0],
                     data_isotopes=data_isotopes, mz_of_resolution=mz_of_resolution,
                     derivative_formula=baseenv.getDerivativeFormula(label[1]), tracer_purity=tracer_purity,
                     correct_NA_tracer=correct_NA_tracer, resolution_formula_code=resolution_formula_code,
-                    charge=baseenv.getMetaboliteCharge(label[0]))
+                    charge=baseenv.getMetaboliteCharge(label[0]), solver=solver, fast_path=fast_path,
+                    threshold_p=threshold_p)
             else:
-                dictMetabolites[label] = hr.MetaboliteCorrectorFactory(
+                dictMetabolites[label] = factory(
                     formula=baseenv.getMetaboliteFormula(label[0]), tracer=tracer, label=label[0],
                     data_isotopes=data_isotopes,
                     derivative_formula=baseenv.getDerivativeFormula(label[1]), tracer_purity=tracer_purity,
-                    correct_NA_tracer=correct_NA_tracer)
+                    correct_NA_tracer=correct_NA_tracer, solver=solver, fast_path=fast_path,
+                    threshold_p=threshold_p)
             logger.info("{} successfully constructed.".format(label))
         except Exception as err:
             dictMetabolites[label] = None
             errors['labels'] = errors['labels'] + [label]
             logger.error("cannot construct {}: {}".format(label, err))
-            sys.exit(2)
+            raise CorrectorConstructionError("cannot construct {}: {}".format(label, err))
+
+    if jobs != 1:
+        logger.info('------------------------------------------------')
+        logger.info('Computing correction matrices...')
+        logger.info('------------------------------------------------')
+        nb_matrices = isocor.parallel.precompute_correction_matrices(dictMetabolites.values(), jobs=jobs)
+        logger.info("{} correction matrices computed.".format(nb_matrices))
 
     logger.info('------------------------------------------------')
     logger.info('Correcting raw MS data...')
     logger.info('------------------------------------------------')
-    df = pd.DataFrame()
+    # correctors may be shared with previous corrections (e.g. in a pool)
+    summary = isocor.ui.isocordb.CorrectionSummary(dictMetabolites.values())
+    # gather measurements of each (metabolite, derivative), and correct them
+    # (on several processes if required)
+    all_series = []
     for label in labels:
-        metabo = dictMetabolites[label]
         series, series_err = baseenv.getDataSerie(label, useformula)
         for s_err in series_err:
             errors['measurements'] = errors['measurements'] + \
                 ["{} - {}".format(s_err, label)]
             logger.error(
                 "{} - {}: Measurement vector is incomplete, some isotopologues are not provided.".format(s_err, label))
-        for serie in series:
-            if metabo:
+        all_series.append(series)
+    tasks = [(dictMetabolites[label], [(serie[0], serie[1]) for serie in series])
+             for label, series in zip(labels, all_series) if dictMetabolites[label]]
+    results = iter(isocor.parallel.correct_series(tasks, jobs=jobs))
+    # results are gathered row by row, then assembled once (concatenating each row is slow)
+    rows, index = [], []
+    for label, series in zip(labels, all_series):
+        metabo = dictMetabolites[label]
+        label_results = next(results) if metabo else [(serie[0], None, None) for serie in series]
+        for serie, (_, valuesCorrected, err) in zip(series, label_results):
+            if metabo and err is None:
                 try:
                     isotopic_inchi = metabo.isotopic_inchi
-                    valuesCorrected = metabo.correct(serie[1])
-                    logger.info("{} - {}: processed".format(serie[0], label))
-                except Exception as err:
-                    isotopic_inchi = ['']*len(serie[1])
-                    valuesCorrected = ([pd.np.nan]*len(serie[1]), [pd.np.nan]
-                                       * len(serie[1]), [pd.np.nan]*len(serie[1]), pd.np.nan)
-                    logger.error("{} - {}: {}".format(serie[0], label, err))
-                    errors['measurements'] = errors['measurements'] + \
-                        ["{} - {}".format(serie[0], label)]
-            else:
+                    logger.info("{} - {}: processed ({} path)".format(serie[0], label, valuesCorrected[4]))
+                except Exception as inchi_err:
+                    err = inchi_err
+            if metabo and err is not None:
+                isotopic_inchi = ['']*len(serie[1])
+                valuesCorrected = ([np.nan]*len(serie[1]), [np.nan]
+                                   * len(serie[1]), [np.nan]*len(serie[1]), np.nan)
+                logger.error("{} - {}: {}".format(serie[0], label, err))
+                errors['measurements'] = errors['measurements'] + \
+                    ["{} - {}".format(serie[0], label)]
+            elif not metabo:
                 isotopic_inchi = ['']*len(serie[1])
-                valuesCorrected = ([pd.np.nan]*len(serie[1]), [pd.np.nan]
-                                   * len(serie[1]), [pd.np.nan]*len(serie[1]), pd.np.nan)
+                valuesCorrected = ([np.nan]*len(serie[1]), [np.nan]
+                                   * len(serie[1]), [np.nan]*len(serie[1]), np.nan)
                 errors['measurements'] = errors['measurements'] + \
                     ["{} - {}".format(serie[0], label)]
                 logger.error(
                     "{} - {}: (metabolite, derivative) corrector could not be constructed.".format(serie[0], label))
             for i, line in enumerate(zip(*(serie[1], valuesCorrected[0], valuesCorrected[1], valuesCorrected[2], [valuesCorrected[3]]*len(valuesCorrected[0])))):
-                df = pd.concat((df, pd.DataFrame([line], index=pd.MultiIndex.from_tuples([[serie[0], label[0], label[1], i, isotopic_inchi[i]]], names=[
-                    'sample', 'metabolite', 'derivative', 'isotopologue', 'isotopic_inchi']), columns=['area', 'corrected_area', 'isotopologue_fraction', 'residuum', 'mean_enrichment'])))
+                rows.append(line)
+                index.append((serie[0], label[0], label[1], i, isotopic_inchi[i]))
+    df = pd.DataFrame()
+    if rows:
+        df = pd.DataFrame(rows, index=pd.MultiIndex.from_tuples(index, names=[
+            'sample', 'metabolite', 'derivative', 'isotopologue', 'isotopic_inchi']), columns=['area', 'corrected_area', 'isotopologue_fraction', 'residuum', 'mean_enrichment'])
 
     # summary results for logs
     logger.info('------------------------------------------------')
@@ -199,6 +255,10 @@ def process(args):
     else:
         logger.info(
             "   number of (metabolite, derivative, resolution): {}".format(len(labels)))
+    summary.log(logger)
+    logger.info("   correction matrices cache: {}".format(isocor.cache.correction_matrix_cache.cache_info()))
+    if isocor.cache.correction_matrix_store is not None:
+        logger.info("   correction matrices store: {}".format(isocor.cache.correction_matrix_store.cache_info()))
     nb_errors = len(errors['labels']) + len(errors['measurements'])
     logger.info("   errors: {}".format(nb_errors))
     if nb_errors:
@@ -207,6 +267,30 @@ def process(args):
         logger.info("      {} errors during correction of measurements".format(
             len(errors['measurements'])))
         logger.info("      detailed information on errors are provided above.")
+    return df
+
+
+def process(args):
+    # create logger (should be root to catch all 'mscorrectors' loggers)
+    logger = logging.getLogger()
+    formatter = logging.Formatter(
+        '%(asctime)s - %(name)s - %(levelname)s - %(message)s', "%Y-%m-%d %H:%M:%S")
+    # sends logging output to sys.stderr
+    strm_hdlr = logging.StreamHandler()
+    strm_hdlr.setFormatter(formatter)
+    logger.addHandler(strm_hdlr)
+
+    if hasattr(args, 'verbose'):
+        logger.setLevel(logging.DEBUG)
+    else:
+        logger.setLevel(logging.INFO)
+
+    # create environment
+    baseenv = create_env(args)
+    try:
+        df = correct(baseenv, args, logger)
+    except CorrectorConstructionError:
+        sys.exit(2)
 
     output = io.StringIO()
     df.to_csv(output, sep='\t')
@@ -235,12 +319,35 @@ def parseArgs():
                         help="purity vector of the tracer")
     parser.add_argument("-n", "--correct_NA_tracer",
                         help="flag to correct tracer natural abundance", action='store_true')
+    parser.add_argument("--solver", type=str, choices=hr.LowResMetaboliteCorrector.SOLVERS,
+                        help="solver used to correct measurements (default: bfgs)")
+    parser.add_argument("--matrix_store", type=str, nargs='?', const='',
+                        help="save correction matrices on disk and reuse them in later runs"
+                             " (in the directory provided, default: ~/isocordb/matrices)")
+    parser.add_argument("--threshold_p", type=float,
+                        help="probability threshold under which isotopic species are neglected"
+                             " (default: 1e-10 for molecules heavier than 500 Da at high resolution, none otherwise)")
+    parser.add_argument("-j", "--jobs", type=int, nargs='?', const=None,
+                        help="number of processes used to compute correction matrices (before correcting"
+                             " measurements) and to correct measurements (default: 1, correction matrices"
+                             " are computed at first use; all processors if no number is provided)")
+    parser.add_argument("--no_fast_path", action='store_true',
+                        help="flag to always use the solver, without trying the unconstrained solution first")
     parser.add_argument("-v", "--verbose",
                         help="flag to enable verbose logs", action='store_true')
     return parser
 
 
 def start_cli():
+    # local correction server and its client
+    if sys.argv[1:2] == ['serve']:
+        import isocor.ui.isocorserver
+        isocor.ui.isocorserver.start_server(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ['client']:
+        import isocor.ui.isocorclient
+        isocor.ui.isocorclient.start_client(sys.argv[2:])
+        return
     parser = parseArgs()
     args = parser.parse_args()
     process(args)
@@ -0,0 +1,142 @@
+"""Thin client of the local correction server (:py:mod:`isocor.ui.isocorserver`).
+
+The client only depends on the standard library: it can be used on computers
+where IsoCor (or its dependencies) are not installed, e.g. by copying this file::
+
+    python isocorclient.py Data_example.tsv -t 13C -r 70000 -m 400 -f orbitrap > results.tsv
+
+Options which are not options of the client are correction parameters, sent to
+the server as is (see the command line interface). Corrected measurements are
+written to the standard output, and the logs of the correction process to the
+standard error (as the command line interface does).
+"""
+
+import argparse
+import http.client
+import json
+import os
+import socket
+import sys
+import urllib.parse
+
+DEFAULT_URL = "http://127.0.0.1:8787"
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP connection to a server listening on a Unix socket."""
+
+    def __init__(self, path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+def _connect(url=DEFAULT_URL, socket_path=None, timeout=None):
+    if socket_path:
+        return UnixHTTPConnection(socket_path, timeout=timeout)
+    url = urllib.parse.urlsplit(url)
+    return http.client.HTTPConnection(url.hostname, url.port, timeout=timeout)
+
+
+def _request(connection, method, path, body=None):
+    headers = {"Content-Type": "application/json"} if body is not None else {}
+    try:
+        connection.request(method, path, body=body, headers=headers)
+        response = connection.getresponse()
+        content = json.loads(response.read().decode("utf-8"))
+    finally:
+        connection.close()
+    if response.status != 200:
+        raise ValueError("{}\n\n{}".format(content.get("error"), content.get("log", "")).strip())
+    return content
+
+
+def submit(data, arguments=None, parameters=None, name="measurements", result_format="tsv",
+           url=DEFAULT_URL, socket_path=None, timeout=None):
+    """Correct measurements on a correction server.
+
+    Args:
+        data (str or list): content of a measurements file, or list of records
+        arguments (list): correction parameters as command line options
+            (e.g. ``["-t", "13C"]``)
+        parameters (dict): correction parameters (e.g. ``{"tracer": "13C"}``),
+            used if arguments are not provided
+        name (str): name of the measurements (reported in logs)
+        result_format (str): format of the results ('tsv' or 'json')
+        url (str): url of the server
+        socket_path (str): path to the Unix socket of the server (instead of url)
+        timeout (float): timeout of the connection, in seconds
+
+    Returns:
+        dict: results ('result') and logs of the correction process ('log')
+
+    Raises:
+        ValueError: if the correction failed
+    """
+    request = {"data": data, "name": name, "format": result_format}
+    if arguments is not None:
+        request["arguments"] = list(arguments)
+    else:
+        request["parameters"] = parameters or {}
+    connection = _connect(url, socket_path, timeout)
+    return _request(connection, "POST", "/correct", json.dumps(request).encode("utf-8"))
+
+
+def submit_file(datafile, arguments=None, parameters=None, **kwargs):
+    """Correct the measurements of a file on a correction server (see :py:func:`submit`)."""
+    with open(datafile, "r", encoding="utf-8") as fp:
+        data = fp.read()
+    return submit(data, arguments, parameters, name=os.path.basename(datafile), **kwargs)
+
+
+def status(url=DEFAULT_URL, socket_path=None, timeout=None):
+    """Return the state of a correction server and of its caches."""
+    return _request(_connect(url, socket_path, timeout), "GET", "/status")
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description='submit MS data to a local IsoCor correction server',
+                                     epilog='other options are correction parameters (see isocorcli)')
+
+    parser.add_argument("inputdata", nargs='?', help="measurements file to process (before correction parameters)")
+    parser.add_argument("--url", type=str, default=DEFAULT_URL,
+                        help="url of the server (default: {})".format(DEFAULT_URL))
+    parser.add_argument("--socket", type=str,
+                        help="path to the Unix socket of the server (instead of url)")
+    parser.add_argument("--json", action='store_true',
+                        help="flag to write results as JSON records (default: TSV)")
+    parser.add_argument("--status", action='store_true',
+                        help="flag to print the state of the server (no measurements are processed)")
+    parser.add_argument("--timeout", type=float,
+                        help="timeout of the connection to the server, in seconds")
+    return parser
+
+
+def start_client(argv=None):
+    parser = parseArgs()
+    args, arguments = parser.parse_known_args(argv)
+    try:
+        if args.status:
+            print(json.dumps(status(args.url, args.socket, args.timeout), indent=2))
+            return
+        if not args.inputdata:
+            parser.error("the measurements file is required")
+        response = submit_file(args.inputdata, arguments, result_format="json" if args.json else "tsv",
+                               url=args.url, socket_path=args.socket, timeout=args.timeout)
+    except (OSError, ValueError) as err:
+        sys.stderr.write("{}\n".format(err))
+        sys.exit(1)
+    sys.stderr.write(response["log"])
+    if args.json:
+        print(json.dumps(response["result"], indent=2))
+    else:
+        print(response["result"])
+
+
+if __name__ == "__main__":
+    start_client()
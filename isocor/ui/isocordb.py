@@ -1,3 +1,4 @@
+import collections
 import pandas as pd
 from pathlib import Path
 from os.path import expanduser
@@ -7,6 +8,7 @@ from distutils.dir_util import copy_tree
 import shutil
 import numpy as np
 import pkg_resources
+import isocor.cache
 
 
 class EnvComputing(object):
@@ -19,6 +21,7 @@ class EnvComputing(object):
         self.home = Path(home)
         self.default_db = Path(self.home, 'isocordb')
         self.db_path = self.default_db
+        self.default_matrix_store = Path(self.default_db, 'matrices')
         self.example_db = pkg_resources.resource_filename('isocor', 'data/')
 
     def initializeDB(self):
@@ -30,6 +33,19 @@ class EnvComputing(object):
         else:
             copy_tree(str(self.example_db), str(self.default_db))
 
+    def registerMatrixStore(self, path=None):
+        """Enable the persistent store of correction matrices.
+
+        Matrices are saved in 'isocordb/matrices' by default, and reused by later
+        runs with the same correction parameters and IsoCor version.
+        """
+        path = self.default_matrix_store if path is None else Path(path)
+        try:
+            return isocor.cache.set_correction_matrix_store(path)
+        except OSError as err:
+            raise ValueError("Cannot use the directory '{}' to store correction matrices.\n\n"
+                             "Traceback for debugging:\n{}".format(path, err))
+
     def initializeEnv(self):
         self.home = self.home
 
@@ -140,6 +156,14 @@ class EnvComputing(object):
                 self.dfDatafile = pd.read_csv(fp, delimiter='\t', keep_default_na=False)
         except Exception as err:
             raise ValueError("An unknown error has occurred opening the measurements file ('{}').\n\nPlease check this file (details on the expected format can be found in the documentation) and correct the issue.\n\nTraceback for debugging:\n{}".format(datafile, err))
+        self.registerMeasurements(self.dfDatafile, useformula, datafile)
+
+    def registerMeasurements(self, df, useformula=True, datafile="measurements"):
+        """Register measurements provided as a DataFrame (same columns as the measurements file).
+
+        'datafile' is the name of the measurements reported in error messages.
+        """
+        self.dfDatafile = df
         tocheck = ['sample', 'metabolite', 'derivative', 'area', 'isotopologue']
         if not useformula:
             tocheck.append('resolution')
@@ -157,6 +181,8 @@ class EnvComputing(object):
                 int(item)
             except:
                 raise ValueError("Error in measurements file ('{}') at line {}:\nisotopologue={!r}".format(datafile, i+2, item))
+        # missing derivatives (e.g. null values of JSON records) are empty strings
+        self.dfDatafile['derivative'] = self.dfDatafile['derivative'].fillna('')
         self.dfDatafile[['sample']] = self.dfDatafile[['sample']].astype(str)
         self.dfDatafile[['metabolite']] = self.dfDatafile[['metabolite']].astype(str)
         self.dfDatafile[['derivative']] = self.dfDatafile[['derivative']].astype(str)
@@ -170,7 +196,6 @@ class EnvComputing(object):
                     raise ValueError("Error in measurements file ('{}') at line {}:\nresolution={!r}".format(datafile, i+2, item))
             self.dfDatafile[['resolution']] = self.dfDatafile[['resolution']].astype(str)
 
-        self.dfDatafile['derivative'].fillna('', inplace=True)
         if self.dfDatafile.empty:
             raise ValueError("Measurements file ('{}') is empty.".format(datafile))
         self._stripColNames(self.dfDatafile)
@@ -254,3 +279,31 @@ class EnvComputing(object):
                 except:
                     l_err.append(i[length])
         return l, l_err
+
+
+class CorrectionSummary(object):
+    """Statistics of the correctors used by a correction process, for the summary of logs.
+
+    Correctors may be shared with previous corrections (e.g. in a pool), hence
+    corrections are counted from the instantiation of the summary.
+
+    Args:
+        correctors (list): correctors (None for correctors which could not be constructed)
+    """
+
+    def __init__(self, correctors):
+        # a corrector may be used for several labels
+        self.correctors = list({id(metabo): metabo for metabo in correctors if metabo}.values())
+        self._solver_stats_init = self.solver_stats()
+
+    def solver_stats(self):
+        """Return the number of corrections by path of all the correctors."""
+        return sum((metabo.solver_stats for metabo in self.correctors), collections.Counter())
+
+    def log(self, logger):
+        """Log the number of corrections by path since the instantiation of the summary,
+        and the maximal probability discarded by the threshold."""
+        logger.info("   number of corrections by path: {}".format(
+            dict(self.solver_stats() - self._solver_stats_init)))
+        discarded_p = max([metabo.discarded_p for metabo in self.correctors] + [0.])
+        logger.info("   maximal probability discarded by the threshold: {}".format(discarded_p))
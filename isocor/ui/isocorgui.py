@@ -3,7 +3,7 @@ from tkinter import ttk
 from tkinter import scrolledtext
 from tkinter import filedialog
 from tkinter import messagebox
-from isocor.ui.isocordb import EnvComputing
+from isocor.ui.isocordb import EnvComputing, CorrectionSummary
 import logging
 import pandas as pd
 import isocor as hr
@@ -241,6 +241,8 @@ class GUIinterface(ttk.Frame):
         self.addSubcriptingName()
         self.cleanListTracer()
         self.log_level = 'INFO'
+        # correctors are shared between successive runs with the same parameters
+        self.corrector_pool = hr.CorrectorPool()
         self.createWidgets()
         self._thread, self._stop = None, True
 
@@ -273,7 +275,13 @@ class GUIinterface(ttk.Frame):
         tracer = self.baseenv.dfIsotopes[self.baseenv.dfIsotopes['subscriptName']
                                          == self.isotopictracerCBB.get()]['name'].values[0]
         correct_NA_tracer = self.chVarNatAbTracer.get()
-        data_isotopes = self.baseenv.dictIsotopes
+        # isotopic data are checked once for all correctors
+        try:
+            data_isotopes = hr.IsotopeTable(self.baseenv.dictIsotopes)
+        except ValueError as err:
+            self.stop_process()
+            messagebox.showerror("Error", "Invalid isotopic data: {}".format(err))
+            return
         # check critical parameters and cancel processing if errors
         try:
             tracer_purity = [float(i.get()) for i in self.purityManager.tracer_purity]
@@ -307,6 +315,18 @@ class GUIinterface(ttk.Frame):
                 self.stop_process()
                 messagebox.showerror("Error", "mz at which resolution is measured should be a positive number.")
                 return
+            threshold_p = self.varThreshold.get().strip()
+            if threshold_p != 'auto':
+                try:
+                    threshold_p = float(threshold_p)
+                    if not 0 <= threshold_p <= 1:
+                        raise ValueError
+                except:
+                    self.stop_process()
+                    messagebox.showerror("Error", "Probability threshold should be 'auto' or a number within the range [0, 1].")
+                    return
+        else:
+            threshold_p = 'auto'
 
         try:
             derivativesfile=Path(self.varDatabasePath.get(), "Derivatives.dat")
@@ -360,6 +380,7 @@ class GUIinterface(ttk.Frame):
         if self.chVarHR.get():
             self.logger.info("      mode: high-resolution")
             self.logger.info("         formula code: {}".format(resolution_formula_code))
+            self.logger.info("         probability threshold: {}".format(threshold_p))
             if useformula:
                 self.logger.info("         instrument resolution: {}".format(resolution))
             if resolution_formula_code not in ['datafile', 'constant']:
@@ -386,14 +407,15 @@ class GUIinterface(ttk.Frame):
                     if not useformula:
                         resolution = label[2]
                         resolution_formula_code = 'constant'
-                    dictMetabolites[label] = hr.MetaboliteCorrectorFactory(
+                    dictMetabolites[label] = self.corrector_pool(
                             formula=self.baseenv.getMetaboliteFormula(label[0]), tracer=tracer, resolution=resolution, label=label[0],
                             data_isotopes=data_isotopes, mz_of_resolution=mz_of_resolution,
                             derivative_formula=self.baseenv.getDerivativeFormula(label[1]), tracer_purity=tracer_purity,
                             correct_NA_tracer=correct_NA_tracer, resolution_formula_code=resolution_formula_code,
-                            charge=self.baseenv.getMetaboliteCharge(label[0]), inchi=self.baseenv.getMetaboliteInChI(label[0]))
+                            charge=self.baseenv.getMetaboliteCharge(label[0]), threshold_p=threshold_p,
+                            inchi=self.baseenv.getMetaboliteInChI(label[0]))
                 else:
-                    dictMetabolites[label] = hr.MetaboliteCorrectorFactory(
+                    dictMetabolites[label] = self.corrector_pool(
                             formula=self.baseenv.getMetaboliteFormula(label[0]), tracer=tracer, label=label[0],
                             data_isotopes=data_isotopes,
                             derivative_formula=self.baseenv.getDerivativeFormula(label[1]), tracer_purity=tracer_purity,
@@ -404,6 +426,9 @@ class GUIinterface(ttk.Frame):
                 errors['labels'] = errors['labels'] + [label]
                 self.logger.error("cannot construct {}: {}".format(label, err))
 
+        # pooled correctors may have been used by previous runs
+        summary = CorrectionSummary(dictMetabolites.values())
+
         # correct measurements for naturally occuring isotopes
         # note: the correction matrix is constructed only once (at first correction of a (metabolite, derivative))
         self.logger.info('------------------------------------------------')
@@ -420,8 +445,8 @@ class GUIinterface(ttk.Frame):
                 if metabo:
                     try:
                          isotopic_inchi = metabo.isotopic_inchi
-                         valuesCorrected = metabo.correct(serie[1])
-                         self.logger.info("{} - {}: processed".format(serie[0], label))
+                         valuesCorrected = metabo.correct(serie[1], return_path=True)
+                         self.logger.info("{} - {}: processed ({} path)".format(serie[0], label, valuesCorrected[4]))
                     except Exception as err:
                          isotopic_inchi = ['']*len(serie[1])
                          valuesCorrected = ([np.nan]*len(serie[1]), [np.nan]*len(serie[1]), [np.nan]*len(serie[1]), np.nan)
@@ -450,6 +475,9 @@ class GUIinterface(ttk.Frame):
             self.logger.info("   number of (metabolite, derivative): {}".format(len(labels)))
         else:
             self.logger.info("   number of (metabolite, derivative, resolution): {}".format(len(labels)))
+        summary.log(self.logger)
+        self.logger.info("   correctors pool: {}".format(self.corrector_pool.cache_info()))
+        self.logger.info("   correction matrices cache: {}".format(hr.cache.correction_matrix_cache.cache_info()))
         nb_errors = len(errors['labels']) + len(errors['measurements'])
         self.logger.info("   errors: {}".format(nb_errors))
         if nb_errors:
@@ -633,6 +661,10 @@ class GUIinterface(ttk.Frame):
             self.highResFrame, textvariable=self.varMass)
         self.mzlbl = ttk.Label(self.highResFrame, text="at m/z")
         self.mzEntry = ttk.Entry(self.highResFrame, textvariable=self.varMZ)
+        self.varThreshold = tk.StringVar()
+        self.varThreshold.set('auto')
+        self.thresholdlbl = ttk.Label(self.highResFrame, text="probability threshold (*)")
+        self.thresholdEntry = ttk.Entry(self.highResFrame, textvariable=self.varThreshold)
 
         self.chVarVerboseLog = tk.IntVar()
         self.chVarNatAbTracer = tk.IntVar()
@@ -685,6 +717,8 @@ class GUIinterface(ttk.Frame):
         self.massEntry.grid(column=0, row=3, sticky='NW')
         self.mzlbl.grid(column=1, row=2, sticky='NW')
         self.mzEntry.grid(column=1, row=3, sticky='NW')
+        self.thresholdlbl.grid(column=0, row=4, sticky='NW')
+        self.thresholdEntry.grid(column=0, row=5, sticky='NW')
         purityLblFrame.grid(column=0, row=5, sticky='NW')
         self.purityManager.grid(column=0, row=1, sticky='NW')
         self.scrollPurity.grid(column=1, row=1, sticky='NS')
@@ -706,6 +740,7 @@ class GUIinterface(ttk.Frame):
         Tooltip(self.R1, text="For measurements collected at unitary resolution (e.g. on quadrupole instruments).")
         Tooltip(self.R2, text="For measurements collected at high or ultrahigh resolution (e.g. on Orbitrap or FT-ICR instruments).")
         Tooltip(tr_lab, text="Correct for the contribution of isotopic impurities of the tracer at labeled positions. The isotopic purity is typically obtained from the manufacturer.\ne.g. for \u00B9\u00B3C-substates with purity of 99%, use 0.01 for \u00B9\u00B2C and 0.99 for \u00B9\u00B3C.")
+        Tooltip(self.thresholdlbl, text="Isotopic species less abundant than this probability are neglected, which speeds up the construction of correction matrices of large molecules.\n'auto': 1e-10 for molecules heavier than 500 Da, no threshold otherwise.")
         Tooltip(self.chVerboseLog, text="Useful in case of trouble. Join it to the issue on github.")
         Tooltip(self.databasePathSubmit, text="Folder containing all database files.")
 
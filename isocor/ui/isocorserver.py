@@ -0,0 +1,327 @@
+"""Local correction server.
+
+The server keeps the databases and the correctors (with their correction matrices)
+in memory, hence repeated corrections of small batches of measurements do not pay
+for loading the databases and computing the correction matrices again::
+
+    isocorcli serve -M Metabolites.dat -D Derivatives.dat -I Isotopes.dat
+
+(or ``python -m isocor serve ...``).
+
+Measurements are submitted to ``POST /correct`` with the thin client
+(:py:mod:`isocor.ui.isocorclient`), or directly:
+
+- as a JSON object with the measurements (``"data"``, either the content of a
+  measurements file or a list of records with the same columns), the correction
+  parameters (``"parameters"``, a dict of command line options, e.g.
+  ``{"tracer": "13C", "resolution": 70000}``, or ``"arguments"``, a list of command
+  line options) and optionally the name of the measurements (``"name"``) and the
+  format of the results (``"format"``: ``"tsv"``, the default, or ``"json"``). The
+  response is a JSON object with the results (``"result"``) and the logs of the
+  correction process (``"log"``);
+- as a measurements file (TSV), with the correction parameters in the query string
+  (e.g. ``/correct?tracer=13C&correct_NA_tracer=1``). The response is the TSV file of
+  the results.
+
+``GET /status`` returns the state of the server and of its caches. Options of the
+databases, the matrices store and the logs are set when the server is started.
+"""
+
+import argparse
+import copy
+import http.server
+import io
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+import time
+import urllib.parse
+import pandas as pd
+import isocor as hr
+import isocor.cache
+import isocor.ui.isocorcli as isocorcli
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8787
+
+# command line options set when the server is started
+SERVER_OPTIONS = ("M", "D", "I", "matrix_store", "verbose")
+
+logger = logging.getLogger(__name__)
+
+
+def parameters_to_arguments(parameters):
+    """Return the command line options corresponding to a dict of correction parameters.
+
+    Flags are set by any true value, and lists (e.g. the tracer purity) are
+    joined with commas.
+    """
+    arguments = []
+    for name, value in parameters.items():
+        option = "-{}".format(name) if len(name) == 1 else "--{}".format(name)
+        if value is None or value is False:
+            continue
+        if value is True:
+            arguments.append(option)
+        elif isinstance(value, (list, tuple)):
+            arguments += [option, ",".join(str(i) for i in value)]
+        else:
+            arguments += [option, str(value)]
+    return arguments
+
+
+def parse_arguments(arguments, name="measurements"):
+    """Return the correction parameters (as parsed by the command line interface).
+
+    Raises:
+        ValueError: if the arguments are invalid, or are options set when the
+            server is started
+    """
+    def error(message):
+        raise ValueError("wrong parameters: {}".format(message))
+    parser = isocorcli.parseArgs()
+    parser.error = error
+    try:
+        args = parser.parse_args(list(arguments) + ["--", name])
+    except SystemExit:
+        # e.g. help requested
+        raise ValueError("wrong parameters: {}".format(" ".join(arguments)))
+    for option in SERVER_OPTIONS:
+        if hasattr(args, option):
+            raise ValueError("Option '{}' is set when the server is started.".format(option))
+    if hasattr(args, 'jobs'):
+        raise ValueError("Option 'jobs' is not available on the server (requests are corrected concurrently).")
+    return args
+
+
+def read_measurements(data, name="measurements"):
+    """Return measurements (the content of a measurements file, or a list of
+    records) as a DataFrame."""
+    if isinstance(data, list):
+        return pd.DataFrame.from_records(data)
+    try:
+        return pd.read_csv(io.StringIO(data), delimiter='\t', keep_default_na=False)
+    except Exception as err:
+        raise ValueError("An unknown error has occurred reading the measurements ('{}').\n\nTraceback for debugging:\n{}".format(name, err))
+
+
+class CorrectionRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Handle the requests of a :py:class:`CorrectionServer`."""
+
+    server_version = "IsoCor/{}".format(hr.__version__)
+
+    def address_string(self):
+        # clients connected to a Unix socket have no address
+        return self.client_address[0] if self.client_address else self.server.server_address
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+    def send_body(self, code, body, content_type):
+        body = body.encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "{}; charset=utf-8".format(content_type))
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, code, content):
+        self.send_body(code, json.dumps(content), "application/json")
+
+    def do_GET(self):
+        if urllib.parse.urlsplit(self.path).path != "/status":
+            self.send_json(404, {"error": "Unknown path '{}'.".format(self.path)})
+            return
+        self.send_json(200, self.server.status())
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != "/correct":
+            self.send_json(404, {"error": "Unknown path '{}'.".format(self.path)})
+            return
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8")
+        if self.headers.get_content_type() == "application/json":
+            self.correct_json(body)
+        else:
+            self.correct_tsv(body, dict(urllib.parse.parse_qsl(url.query)))
+
+    def correct_json(self, body):
+        try:
+            request = json.loads(body)
+            if not isinstance(request, dict):
+                raise ValueError("The request should be a JSON object.")
+            name = request.get("name", "measurements")
+            if "arguments" in request:
+                arguments = request["arguments"]
+            else:
+                arguments = parameters_to_arguments(request.get("parameters", {}))
+            result_format = request.get("format", "tsv")
+            if result_format not in ("tsv", "json"):
+                raise ValueError("Unknown format of results '{}'.".format(result_format))
+            args = parse_arguments(arguments, name)
+            measurements = read_measurements(request.get("data", ""), name)
+        except ValueError as err:
+            self.send_json(400, {"error": str(err), "log": ""})
+            return
+        df, log, err = self.server.correct(args, measurements)
+        if err is not None:
+            self.send_json(400, {"error": str(err), "log": log})
+        elif result_format == "json":
+            self.send_json(200, {"result": json.loads(df.reset_index().to_json(orient="records")),
+                                 "log": log})
+        else:
+            self.send_json(200, {"result": df.to_csv(sep='\t'), "log": log})
+
+    def correct_tsv(self, body, parameters):
+        name = parameters.pop("name", "measurements")
+        # flags are enabled unless their value is false (e.g. 'correct_NA_tracer=0')
+        for flag in ("correct_NA_tracer", "no_fast_path"):
+            if flag in parameters:
+                parameters[flag] = parameters[flag].lower() not in ("", "0", "false", "no")
+        try:
+            args = parse_arguments(parameters_to_arguments(parameters), name)
+            measurements = read_measurements(body, name)
+        except ValueError as err:
+            self.send_body(400, "{}\n".format(err), "text/plain")
+            return
+        df, log, err = self.server.correct(args, measurements)
+        if err is not None:
+            self.send_body(400, "{}\n\n{}".format(err, log), "text/plain")
+        else:
+            self.send_body(200, df.to_csv(sep='\t'), "text/tab-separated-values")
+
+
+class CorrectionServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """HTTP server correcting measurements with warm databases and correctors.
+
+    Args:
+        server_address (tuple): (host, port) of the server
+        args (argparse.Namespace): databases, matrices store and logs options
+            (see :py:func:`parseArgs`)
+        pool_size (int): maximal number of correctors kept in memory
+    """
+
+    daemon_threads = True
+
+    def __init__(self, server_address, args=None, pool_size=1024):
+        self.args = argparse.Namespace() if args is None else args
+        self.baseenv = isocorcli.create_env(self.args)
+        self.corrector_pool = hr.CorrectorPool(pool_size)
+        self.formatter = logging.Formatter(
+            '%(asctime)s - %(name)s - %(levelname)s - %(message)s', "%Y-%m-%d %H:%M:%S")
+        self.start_time = time.time()
+        self.nb_requests = 0
+        # requests are handled by concurrent threads
+        self._lock = threading.Lock()
+        super().__init__(server_address, CorrectionRequestHandler)
+
+    def correct(self, args, measurements):
+        """Correct measurements (DataFrame) with the correction parameters given in args.
+
+        Returns:
+            tuple: the corrected measurements (DataFrame, None on error), the logs
+            of the correction process and the error raised (None on success)
+        """
+        with self._lock:
+            self.nb_requests += 1
+        for option in SERVER_OPTIONS:
+            if hasattr(self.args, option):
+                setattr(args, option, getattr(self.args, option))
+        # each request logs in its own logger (not propagated to the root logger)
+        log = io.StringIO()
+        request_logger = logging.Logger("isocor.server.request")
+        request_logger.setLevel(logging.DEBUG if hasattr(args, 'verbose') else logging.INFO)
+        handler = logging.StreamHandler(log)
+        handler.setFormatter(self.formatter)
+        request_logger.addHandler(handler)
+        # the measurements are registered in a copy of the environment shared by requests
+        baseenv = copy.copy(self.baseenv)
+        try:
+            df = isocorcli.correct(baseenv, args, request_logger, measurements=measurements,
+                                   factory=self.corrector_pool)
+            err = None
+        except Exception as error:
+            df, err = None, error
+        logger.info("%s corrected (%s)", getattr(args, 'inputdata', 'measurements'),
+                    "error: {}".format(err) if err is not None else "success")
+        return df, log.getvalue(), err
+
+    def status(self):
+        """Return the state of the server and of its caches."""
+        return {"version": hr.__version__,
+                "uptime": time.time() - self.start_time,
+                "requests": self.nb_requests,
+                "correctors pool": self.corrector_pool.cache_info()._asdict(),
+                "correction matrices cache": isocor.cache.correction_matrix_cache.cache_info()._asdict()}
+
+
+class UnixCorrectionServer(CorrectionServer):
+    """:py:class:`CorrectionServer` listening on a Unix socket (server_address is its path)."""
+
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = "localhost"
+        self.server_port = 0
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(argument_default=argparse.SUPPRESS,
+                                     description='local server correcting MS data for naturally occurring isotopes'
+                                                 ' (databases and correction matrices are kept in memory)')
+
+    parser.add_argument("-M", type=str, help="path to metabolites database")
+    parser.add_argument("-D", type=str, help="path to derivatives database")
+    parser.add_argument("-I", type=str, help="path to isotopes database")
+    parser.add_argument("--matrix_store", type=str, nargs='?', const='',
+                        help="save correction matrices on disk and reuse them in later runs"
+                             " (in the directory provided, default: ~/isocordb/matrices)")
+    parser.add_argument("--host", type=str, default=DEFAULT_HOST,
+                        help="address of the server (default: {})".format(DEFAULT_HOST))
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT,
+                        help="port of the server (default: {})".format(DEFAULT_PORT))
+    parser.add_argument("--socket", type=str,
+                        help="path to a Unix socket to listen on (instead of host and port)")
+    parser.add_argument("--pool_size", type=int, default=1024,
+                        help="maximal number of correctors kept in memory (default: 1024)")
+    parser.add_argument("-v", "--verbose",
+                        help="flag to enable verbose logs", action='store_true')
+    return parser
+
+
+def start_server(argv=None):
+    parser = parseArgs()
+    args = parser.parse_args(argv)
+    # server logs are sent to sys.stderr
+    root_logger = logging.getLogger()
+    strm_hdlr = logging.StreamHandler()
+    strm_hdlr.setFormatter(logging.Formatter(
+        '%(asctime)s - %(name)s - %(levelname)s - %(message)s', "%Y-%m-%d %H:%M:%S"))
+    root_logger.addHandler(strm_hdlr)
+    root_logger.setLevel(logging.DEBUG if hasattr(args, 'verbose') else logging.INFO)
+
+    # correction parameters of the server (the others are used to start it)
+    server_args = argparse.Namespace(**{option: getattr(args, option) for option in SERVER_OPTIONS
+                                        if hasattr(args, option)})
+    if hasattr(args, 'socket'):
+        server = UnixCorrectionServer(args.socket, server_args, args.pool_size)
+        logger.info("IsoCor %s server listening on %s", hr.__version__, args.socket)
+    else:
+        server = CorrectionServer((args.host, args.port), server_args, args.pool_size)
+        logger.info("IsoCor %s server listening on http://%s:%s", hr.__version__,
+                    *server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -21,13 +21,11 @@ setuptools.setup(
     long_description_content_type="text/markdown",
     url="https://github.com/MetaSys-LISBP/IsoCor/",
     packages=setuptools.find_packages(),
-    python_requires='>=3.5',
-    install_requires=['pandas>=0.17.1', 'scipy>=0.12.1'],
+    python_requires='>=3.7',
+    install_requires=['pandas>=0.17.1', 'numpy>=1.16.5', 'scipy>=1.6.0'],
     package_data={'': ['data/*.dat', ], },
     include_package_data=True,
     classifiers=[
-        "Programming Language :: Python :: 3.5",
-        "Programming Language :: Python :: 3.6",
         "Programming Language :: Python :: 3.7",
         "Programming Language :: Python :: 3.8",
         "License :: OSI Approved :: GNU General Public License v3 or later (GPLv3+)",